@@ -6,27 +6,68 @@ Script Purpose:
     3. Use that mapping to batch-rename matching .raw files in the folder.
 
 Prerequisites:
-    - pandas installed (with openpyxl or xlrd to read Excel).
+    - NumPy and PIL installed, and openpyxl to read Excel (see labels.py).
+      Both are only imported once a conversion starts, so --check, --version,
+      --resume and --rollback work without them.
     - Directory path and Excel file location correctly set.
     - The Excel file must contain columns:
-        Study participant ID, Instrument, Retinal Layer, Image size [mm], Image ID.
+        Study participant ID, Instrument, Retinal Layer, Image size [mm],
+        Image size [scans], Image ID.
 
 Usage:
     - Update FOLDER_PATH and LABELS_XLSX with your paths.
     - Run the script. All .png files in the folder will be removed, 
       and .raw files will be renamed according to the Excel data.
+    - From Python, call run() (or pipeline.run('angiovue')); importing the
+      module does not touch any file.
+    - python angiovue.py --dry-run prints what would be deleted, converted
+      and renamed without changing any file.
+    - --format selects the outputs (bmp, tiff, png16, npz; see OUTPUT_FORMATS),
+      e.g. python angiovue.py --format tiff --format npz
+    - --dedup skips .raw files converted before (see DEDUPLICATE).
+    - --check only looks over the folder and workbook (see preflight.py);
+      --version prints the version.
+    - --quiet drops the line printed per file; --metrics FILE writes the stage
+      timings and counts as JSON (see metrics.py).
+    - If renaming stops part way, run with --resume or --rollback
+      (see renamer.py).
+    - .bmp files renamed by an earlier run are skipped (see history.py);
+      --full checks every file again.
 
 Note:
     - Files without a matching record in Excel will be skipped with a warning.
     - If you need to retain any .png files, back them up before running the script.
 """
 
+from __future__ import annotations
+
+import io
 import os
+import sys
 import glob
-import pandas as pd
-from PIL import Image
-import numpy as np
-# import tifffile
+import itertools
+import queue
+import argparse
+import threading
+import contextlib
+import warnings
+import zipfile
+import importlib.util
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+import metrics
+import preflight
+from history import ContentStore, ProcessedLog, file_digest
+from labels import LabelIndex, LabelStore
+from rawgeometry import RAW_DTYPE, RAW_GEOMETRIES, RawGeometry, find_geometries
+from renamer import Cancelled, Rename, RenamePlan, execute, journal_path, resume, rollback
+from tags import parse_tag_name
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Optional: writes 'tiff' output with more compression choices; PIL is used without it.
+# Only looked up here: importing it would load NumPy.
+HAVE_TIFFFILE = importlib.util.find_spec('tifffile') is not None
 
 # -----------------------
 # Configuration
@@ -35,21 +76,51 @@ import numpy as np
 FOLDER_PATH = './AVANTI'
 LABELS_XLSX = './2025_OCTA_HARMONISATION_LABELS.xlsx'
 
-COL_PARTICIPANT_ID = 'Study participant ID'
-COL_INSTRUMENT     = 'Instrument'
-COL_LAYER          = 'Retinal Layer'
-COL_SIZE           = 'Image size [mm]'
-COL_IMAGE_ID       = 'Image ID'
+# Number of threads scaling and encoding images in parallel.
+# Threads are enough: NumPy and PIL release the GIL while reading, scaling and encoding.
+CONVERT_WORKERS = os.cpu_count() or 1
+
+# Images waiting between the read, encode and write stages of batch_convert.
+# At most about 2 × CONVERT_QUEUE_DEPTH + CONVERT_WORKERS images are in memory at once.
+CONVERT_QUEUE_DEPTH = 8
+
+# Rows normalised per step; bounds the float32 scratch buffer to NORMALISE_CHUNK_ROWS × width.
+NORMALISE_CHUNK_ROWS = 64
+
+# Same-geometry scans normalised together as one (n, height, width) stack by batch_convert (1 = one at a time).
+# Off by default: the step is bound by memory bandwidth, and scaling one image while it is
+# still in cache measured faster than stacking 16 (about 180 vs 245 µs per 400x400 scan).
+NORMALISE_BATCH_SIZE = 1
+
+# Intensity window as (low, high) percentiles, e.g. (0.5, 99.5) to clip outliers; None scales min to max.
+NORMALISE_PERCENTILES: Optional[Tuple[float, float]] = None
 
-INSTRUMENT_MAP = {'A': 'Angiovue'}
-LAYER_MAP = {'S': 'Superficial', 'D': 'Deep', 'R': 'Retina'}
-SIZE_MAP = {'3': '3x3', '6': '6x6'}
+# Files each .raw scan is converted to, any of:
+#   'bmp'    8-bit BMP scaled per scan (the harmonisation format)
+#   'tiff'   float32 TIFF, lossless
+#   'png16'  16-bit PNG scaled per scan, lossless compression
+#   'npz'    float32 scans of one participant in a compressed <Study participant ID>.npz, keyed by base name
+# Per-scan images are renamed to <Image ID>.<extension>; archives keep their name.
+OUTPUT_FORMATS = ('bmp',)
+OUTPUT_EXTENSIONS = {'bmp': 'bmp', 'tiff': 'tiff', 'png16': 'png', 'npz': 'npz'}
+
+# Compression of 'tiff' output: 'zlib' (deflate) or None. With tifffile installed,
+# any of its codecs can be named (e.g. 'zstd'); PIL only supports 'zlib'.
+TIFF_COMPRESSION = 'zlib'
+
+# Hash every .raw before converting it and keep the hashes in the history database
+# (see history.ContentStore). A redelivered .raw whose outputs are still there is
+# deleted without converting it again, and a .raw with the same content as another
+# scan is reported and left alone.
+DEDUPLICATE = False
+
+INSTRUMENT = 'Angiovue'
 
 # -----------------------
 # Step 1: Remove .png Files
 # -----------------------
 
-def remove_png_files(folder_path: str) -> None:
+def remove_png_files(folder_path: str, dry_run: bool = False, files: Optional[List[str]] = None) -> None:
     """
     Removes all .png files in the specified folder.
 
@@ -57,25 +128,67 @@ def remove_png_files(folder_path: str) -> None:
     ----------
     folder_path : str
         Path to the folder where .png files will be removed.
+    dry_run : bool
+        Only list the files that would be removed.
+    files : list of str, optional
+        Paths of the .png files to remove; by default every .png in the folder.
     """
-    png_files = glob.glob(os.path.join(folder_path, '*.png'))
+    if files is None:
+        files = glob.glob(os.path.join(folder_path, '*.png'))
+    # 16-bit .png files are converted scans ('png16' output), not exports
+    png_files = [p for p in files if not is_converted_png(p)]
     
     for png_file in png_files:
+        if dry_run:
+            metrics.progress(f"{png_file} would be deleted")
+            continue
         os.remove(png_file)
-        print(f"{png_file} has been deleted")
+        metrics.count('deleted')
+        metrics.progress(f"{png_file} has been deleted")
     
-    print("[INFO] All .png files removed. Only .raw files remain.")
+    if not dry_run:
+        print("[INFO] All .png files removed. Only .raw files remain.")
 
-remove_png_files(FOLDER_PATH)
+def is_converted_png(path: str) -> bool:
+    """
+    Returns True for a 16-bit .png written by batch_convert; Angiovue's own .png exports are 8-bit RGBA.
+
+    Most files are told apart by name: '<scan>_OCT.png' and '<scan>.png' next to
+    its '<scan>.raw' are exports, '<Image ID>.png' is a renamed output. Only the
+    others are opened to read their mode.
+    """
+    base_name = os.path.splitext(os.path.basename(path))[0]
+    if base_name.endswith('_OCT'):
+        tag = parse_tag_name(base_name[:-len('_OCT')])
+        if tag is not None and tag.instrument == INSTRUMENT:
+            return False
+    elif base_name.isdigit():
+        return True
+    else:
+        tag = parse_tag_name(base_name)
+        # The .raw is deleted once it is converted
+        if (tag is not None and tag.instrument == INSTRUMENT
+                and os.path.exists(os.path.join(os.path.dirname(path), base_name + '.raw'))):
+            return False
+
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            return img.mode.startswith('I')
+    except OSError:
+        return False
 
 # -----------------------
 # Step 2: Convert .raw Files to .BMP
 # -----------------------
 
-def read_raw_image(raw_path: str, width: int, height: int, offset: int = 0) -> np.ndarray:
+def read_raw_image(raw_path: str, width: int, height: int, offset: int = 0,
+                   use_mmap: bool = False, dtype: str = RAW_DTYPE) -> np.ndarray:
     """
     Reads a .raw file and returns a NumPy array (32-bit float), shaped as (height, width).
 
+    The file length is checked against width × height × pixel size before any data is read.
+
     Parameters:
     ----------
     raw_path : str
@@ -86,162 +199,1023 @@ def read_raw_image(raw_path: str, width: int, height: int, offset: int = 0) -> n
         Image height.
     offset : int
         Byte offset (default: 0).
+    use_mmap : bool
+        Return a read-only np.memmap of the file instead of a copy of its bytes.
+        Pages are only loaded as the array is used.
+    dtype : str or np.dtype
+        Pixel format (default: little-endian float32, see rawgeometry.RAW_DTYPE).
 
     Returns:
     ----------
     np.ndarray
         The image data as a 32-bit float NumPy array.
+
+    Raises:
+    ----------
+    ValueError
+        If the file size does not match the requested dimensions.
     """
+    import numpy as np
+
+    dtype = np.dtype(dtype)
+    expected = width * height * dtype.itemsize
+    actual = os.path.getsize(raw_path) - offset
+    if actual != expected:
+        raise ValueError(f"expected {expected} bytes for {width}x{height} {dtype.name}, found {actual}")
+
+    if use_mmap:
+        return np.memmap(raw_path, dtype=dtype, mode='r', offset=offset, shape=(height, width))
+
     with open(raw_path, 'rb') as f:
         f.seek(offset)
         raw_data = f.read()
 
-    # Interpret as 32-bit float (little-endian)
-    array = np.frombuffer(raw_data, dtype=np.float32)
+    # Interpret as 32-bit float (little-endian) unless told otherwise
+    array = np.frombuffer(raw_data, dtype=dtype)
 
     # Reshape to (height, width)
     array = array.reshape((height, width))
 
     return array
 
-def save_as_bmp(array: np.ndarray, bmp_path: str) -> None:
+# Per-thread buffers reused across files, so a batch does not allocate a new image per file
+_buffers = threading.local()
+
+def _thread_buffer(name: str, shape: Tuple[int, ...], dtype) -> np.ndarray:
+    """Returns this thread's buffer called `name`, reallocating it only when the shape changes."""
+    import numpy as np
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        setattr(_buffers, name, buffer)
+    return buffer
+
+def intensity_window(flat: np.ndarray, percentiles: Optional[Tuple[float, float]] = None
+                     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Converts a float32 NumPy array to uint8 and saves as BMP image.
-    
+    Returns the per-image (low, high) intensities of a (n, pixels) array, ignoring NaN pixels.
+
+    Parameters:
+    ----------
+    flat : np.ndarray
+        One flattened image per row.
+    percentiles : (float, float), optional
+        Window percentiles; by default the minimum and maximum.
+
+    Returns:
+    ----------
+    (low, high, has_nan)
+        float32 arrays of length n (NaN for an image with no finite pixel), and
+        whether each image contains NaN pixels.
+    """
+    import numpy as np
+
+    # min returns NaN as soon as one pixel is NaN, so it doubles as the NaN check
+    lo = flat.min(axis=1)
+    has_nan = np.isnan(lo)
+    with warnings.catch_warnings():
+        # All-NaN images are handled by the caller
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if percentiles is not None:
+            lo, hi = np.nanpercentile(flat, percentiles, axis=1)
+        elif has_nan.any():
+            lo, hi = np.nanmin(flat, axis=1), np.nanmax(flat, axis=1)
+        else:
+            hi = flat.max(axis=1)
+    return lo.astype(np.float32), hi.astype(np.float32), has_nan
+
+def _flat_safe(lo: np.ndarray, hi: np.ndarray, has_nan: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns (lo, span, has_nan) with flat and all-NaN images mapped to span = 1, so they scale to 0."""
+    import numpy as np
+    span = hi - lo
+    flat = ~(span > 0)
+    lo[np.isnan(lo)] = 0
+    span[flat] = 1
+    return lo, span, has_nan
+
+def _scale_image(array: np.ndarray, lo, span, out: np.ndarray, clip: bool, has_nan: bool) -> None:
+    """
+    Writes (array - lo) / span * top into `out`, NORMALISE_CHUNK_ROWS rows at a time,
+    where top is the largest value of out's integer dtype (255 for uint8).
+
+    With `has_nan`, NaN pixels become 0; with `clip`, values outside the window saturate at 0 and top.
+    """
+    import numpy as np
+
+    top = np.iinfo(out.dtype).max
+    rows = min(NORMALISE_CHUNK_ROWS, array.shape[0])
+    scratch = _thread_buffer('scratch', (rows, array.shape[1]), np.float32)
+
+    for start in range(0, array.shape[0], rows):
+        stop = min(start + rows, array.shape[0])
+        chunk = scratch[:stop - start]
+        np.subtract(array[start:stop], lo, out=chunk)
+        np.divide(chunk, span, out=chunk)
+        np.multiply(chunk, top, out=chunk)
+        if clip:
+            np.clip(chunk, 0, top, out=chunk)
+        if has_nan:
+            # Casting NaN to an integer is undefined; nan_to_num is slow, so only pay for it when needed
+            np.nan_to_num(chunk, copy=False, nan=0.0)
+        np.copyto(out[start:stop], chunk, casting='unsafe')
+
+def normalise(array: np.ndarray, out: np.ndarray = None,
+              percentiles: Optional[Tuple[float, float]] = NORMALISE_PERCENTILES,
+              dtype='uint8') -> np.ndarray:
+    """
+    Scales a float32 image to the full range of an unsigned integer type:
+    0–255 for uint8 ('bmp' output), 0–65535 for uint16 ('png16' output).
+
+    The scaling is done NORMALISE_CHUNK_ROWS rows at a time in a small float32
+    scratch buffer, so no full-size float temporaries are created. Without
+    percentiles, the result for a finite, non-flat image is identical to
+    ((array - min) / (max - min) * 255).astype(np.uint8).
+
+    A flat image becomes all 0 instead of dividing by zero, and NaN pixels become 0.
+
     Parameters:
     ----------
     array : np.ndarray
-        Float32 image array.
-    bmp_path : str
-        Path where BMP will be saved.
+        2D float32 image array (may be a memmap).
+    out : np.ndarray, optional
+        uint8 or uint16 array of the same shape to write into; allocated if omitted.
+    percentiles : (float, float), optional
+        Scale this intensity window to the full range and clip values outside it.
+    dtype : np.dtype
+        Integer type of the array allocated when `out` is omitted.
+
+    Returns:
+    ----------
+    np.ndarray
+        The scaled image (`out` if it was given).
+    """
+    import numpy as np
+
+    if out is None:
+        out = np.empty(array.shape, dtype=dtype)
+
+    lo, span, has_nan = _flat_safe(*intensity_window(array.reshape(1, -1), percentiles))
+    _scale_image(array, lo[0], span[0], out, clip=percentiles is not None, has_nan=has_nan[0])
+    return out
+
+def normalise_stack(stack: np.ndarray, out: np.ndarray = None,
+                    percentiles: Optional[Tuple[float, float]] = NORMALISE_PERCENTILES,
+                    dtype='uint8') -> np.ndarray:
     """
-    # bmpfile.imwrite(bmp_path, array, dtype=np.float32, imagej=True)
+    Scales every image of a (n, height, width) float32 stack to 0–255
+    (0–65535 with a uint16 `out` or `dtype`).
 
-    # Normalize float image to 0–255
-    norm = (array - np.min(array)) / (np.max(array) - np.min(array))  # Scale to 0–1
-    img_uint8 = (norm * 255).astype(np.uint8)
+    The per-image windows (min/max or percentiles) of the whole stack are found
+    in one vectorised call; each image is then scaled by its own window, with
+    the same result as normalise() on that image alone. Scaling stays per
+    image: broadcasting one window per row over the whole stack measured
+    slower, as the step is bound by memory bandwidth, not Python overhead.
 
-    # Convert to PIL image and save as BMP
-    img = Image.fromarray(img_uint8)
-    img.save(bmp_path, format='BMP')
+    Parameters:
+    ----------
+    stack : np.ndarray
+        3D float32 array of same-geometry images.
+    out : np.ndarray, optional
+        uint8 or uint16 array of the same shape to write into; allocated if omitted.
+    percentiles : (float, float), optional
+        Scale this intensity window to the full range and clip values outside it.
+    dtype : np.dtype
+        Integer type of the array allocated when `out` is omitted.
+
+    Returns:
+    ----------
+    np.ndarray
+        The scaled stack (`out` if it was given).
+    """
+    import numpy as np
+
+    if out is None:
+        out = np.empty(stack.shape, dtype=dtype)
+
+    lo, span, has_nan = _flat_safe(*intensity_window(stack.reshape(stack.shape[0], -1), percentiles))
+    for i in range(stack.shape[0]):
+        _scale_image(stack[i], lo[i], span[i], out[i], clip=percentiles is not None, has_nan=has_nan[i])
+    return out
+
+def _encode_uint8(img_uint8: np.ndarray) -> bytes:
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.fromarray(img_uint8).save(buffer, format='BMP')
+    return buffer.getvalue()
+
+def encode_png16(img_uint16: np.ndarray) -> bytes:
+    """Returns a uint16 image encoded as a 16-bit greyscale PNG."""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.fromarray(img_uint16).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def encode_tiff(array: np.ndarray, compression: Optional[str] = TIFF_COMPRESSION) -> bytes:
+    """
+    Returns a float32 image encoded as a single-page float32 TIFF, keeping every value as read.
+
+    Raises:
+    ----------
+    ValueError
+        If `compression` is not 'zlib' or None and tifffile is not installed.
+    """
+    import numpy as np
+    from PIL import Image
+
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    buffer = io.BytesIO()
+    if HAVE_TIFFFILE:
+        import tifffile
+        tifffile.imwrite(buffer, array, compression=compression)
+    elif compression in (None, 'zlib'):
+        Image.fromarray(array).save(buffer, format='TIFF',
+                                    compression='tiff_adobe_deflate' if compression else None)
+    else:
+        raise ValueError(f"TIFF compression '{compression}' needs tifffile (pip install tifffile)")
+    return buffer.getvalue()
+
+def encode_outputs(array: np.ndarray, formats=OUTPUT_FORMATS, scaled8: np.ndarray = None,
+                   scaled16: np.ndarray = None) -> List[Tuple[str, bytes]]:
+    """
+    Encodes one scan in every per-scan image format of `formats` ('npz' is written by write_archive).
+
+    Parameters:
+    ----------
+    array : np.ndarray
+        2D float32 image.
+    formats : sequence of str
+        Keys of OUTPUT_EXTENSIONS.
+    scaled8, scaled16 : np.ndarray, optional
+        The image already scaled to uint8 / uint16 (e.g. by normalise_stack);
+        computed here when needed and omitted.
+
+    Returns:
+    ----------
+    list of (extension, file contents)
+        In the order of `formats`.
+    """
+    import numpy as np
+
+    outputs = []
+    for output_format in formats:
+        if output_format == 'bmp':
+            if scaled8 is None:
+                scaled8 = normalise(array, out=_thread_buffer('image', array.shape, np.uint8))
+            outputs.append(('bmp', _encode_uint8(scaled8)))
+        elif output_format == 'png16':
+            if scaled16 is None:
+                scaled16 = normalise(array, out=_thread_buffer('image16', array.shape, np.uint16))
+            outputs.append(('png', encode_png16(scaled16)))
+        elif output_format == 'tiff':
+            outputs.append(('tiff', encode_tiff(array)))
+    return outputs
+
+def archive_name(base_name: str) -> str:
+    """Returns the archive of a scan's participant, e.g. 'OCTA-004_AD3' -> 'OCTA-004.npz'."""
+    return base_name.split("_")[0] + ".npz"
+
+def output_names(filename: str, formats=OUTPUT_FORMATS) -> List[str]:
+    """Returns the files a .raw file is converted to, e.g. ['OCTA-004_AD3.bmp', 'OCTA-004.npz']."""
+    base_name = os.path.splitext(filename)[0]
+    return [archive_name(base_name) if f == 'npz' else base_name + "." + OUTPUT_EXTENSIONS[f] for f in formats]
+
+def write_archive(folder: str, name: str, arrays: Dict[str, np.ndarray]) -> None:
+    """
+    Adds float32 scans to a participant archive, keeping the scans already stored in it.
+
+    The archive is written to a temporary file and moved into place, so an
+    interrupted write never leaves a damaged archive.
+
+    Parameters:
+    ----------
+    folder : str
+        The Angiovue folder.
+    name : str
+        Archive file name (see archive_name).
+    arrays : dict
+        Scans keyed by base name, e.g. {'OCTA-004_AD3': array}.
+    """
+    import numpy as np
+
+    path = os.path.join(folder, name)
+    if os.path.exists(path):
+        with np.load(path) as existing:
+            arrays = {**{key: existing[key] for key in existing.files}, **arrays}
+
+    tmp_path = os.path.join(folder, "." + name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, path)
+
+def identify_raw_file(input_folder: str, filename: str) -> Tuple[Optional[RawGeometry], str, List[str]]:
+    """
+    Identifies the geometry of a .raw file from its length.
+
+    Returns:
+    ----------
+    (geometry, status, messages)
+        geometry is None if the file cannot be converted; status is then
+        'skipped' (unknown size) or 'failed' (ambiguous size).
+    """
+    import numpy as np
+
+    nbytes = os.path.getsize(os.path.join(input_folder, filename))
+    geometries = find_geometries(nbytes)
+    if not geometries:
+        return None, 'skipped', [f"[WARNING] Unable to identify {filename}, {nbytes} bytes is not a known Angiovue size. Skipping."]
+    if len(geometries) > 1:
+        candidates = ", ".join(f"{g.width}x{g.height} {np.dtype(g.dtype).name}" for g in geometries)
+        return None, 'failed', [f"[ERROR] Ambiguous size for {filename}: {nbytes} bytes matches {candidates}"]
+
+    geometry = geometries[0]
+    return geometry, 'converted', [f"Identified {filename} as {geometry.width}x{geometry.height} {np.dtype(geometry.dtype).name}"]
     
 
-def batch_convert(input_folder: str) -> None:
+def describe_conversion(input_folder: str, filename: str, formats=OUTPUT_FORMATS) -> Tuple[str, List[str]]:
     """
-    Batch processes .raw files:
-    - Identifies whether they are 3×3 or 6×6 images.
-    - Converts them to .bmp format.
-    - Deletes the original .raw files.
+    Identifies a single .raw file for a dry run; nothing is read, written or deleted.
 
     Parameters:
     ----------
     input_folder : str
-        The folder containing .raw files to be processed.
+        The folder containing the .raw file.
+    filename : str
+        Name of the .raw file.
+    formats : sequence of str
+        Output formats (see OUTPUT_FORMATS).
+
+    Returns:
+    ----------
+    (status, messages)
+        status is 'converted', 'skipped' or 'failed'; messages are the lines to print for this file.
+    """
+    geometry, status, messages = identify_raw_file(input_folder, filename)
+    if geometry is None:
+        return status, messages
+    names = ", ".join(output_names(filename, formats))
+    return 'converted', messages + [f"{filename} would be converted to {names}"]
+
+
+def outputs_exist(input_folder: str, filename: str, image_id: Optional[str] = None,
+                  formats=OUTPUT_FORMATS) -> bool:
+    """Returns True if an output of the .raw file is in the folder, under its own name or its Image ID."""
+    base_name = os.path.splitext(filename)[0]
+    for output_format in formats:
+        if output_format == 'npz':
+            path = os.path.join(input_folder, archive_name(base_name))
+            # Only the member list is read, not the arrays
+            try:
+                with zipfile.ZipFile(path) as existing:
+                    if base_name + '.npy' in existing.namelist():
+                        return True
+            except (OSError, zipfile.BadZipFile):
+                pass
+            continue
+        extension = OUTPUT_EXTENSIONS[output_format]
+        names = [base_name] + ([image_id] if image_id else [])
+        if any(os.path.exists(os.path.join(input_folder, f"{name}.{extension}")) for name in names):
+            return True
+    return False
+
+def check_contents(input_folder: str, filenames: List[str], store: ContentStore, dry_run: bool = False,
+                   formats=OUTPUT_FORMATS) -> Tuple[List[str], Dict[str, Tuple[str, int]], List[Tuple[str, str, List[str]]]]:
+    """
+    Compares .raw files with the content converted by earlier runs.
+
+    Parameters:
+    ----------
+    input_folder : str
+        The folder containing the .raw files.
+    filenames : list of str
+        Names of the .raw files.
+    store : ContentStore
+        Hashes of the .raw files converted before.
+    dry_run : bool
+        Only report; no .raw file is deleted.
+    formats : sequence of str
+        Output formats (see OUTPUT_FORMATS).
+
+    Returns:
+    ----------
+    (new, digests, results)
+        new lists the files to convert and digests maps them to (hash, size).
+        results has (filename, status, messages) for every other file:
+        'unchanged' if the same file was converted before and its outputs are
+        still there (the .raw is deleted), 'skipped' if the content belongs
+        to another scan, or 'failed' if it could not be read.
+    """
+    new: List[str] = []
+    digests: Dict[str, Tuple[str, int]] = {}
+    results: List[Tuple[str, str, List[str]]] = []
+    batch: Dict[str, str] = {}     # digest -> first file with it in this batch
+
+    for filename in filenames:
+        path = os.path.join(input_folder, filename)
+        try:
+            size = os.path.getsize(path)
+            digest = file_digest(path)
+        except OSError as e:
+            results.append((filename, 'failed', [f"[ERROR] Failed to read: {filename}, Error: {e}"]))
+            continue
+
+        original = batch.get(digest) or store.lookup(digest)
+        if original is not None and original != filename:
+            # The same image delivered under two names, most likely for two participants
+            results.append((filename, 'skipped', [f"[WARNING] {filename} has the same content as {original}; "
+                                                  "leaving it unconverted."]))
+            continue
+
+        image_id = store.image_id(filename) if original is not None else None
+        if original is None or not outputs_exist(input_folder, filename, image_id, formats):
+            batch[digest] = filename
+            digests[filename] = (digest, size)
+            new.append(filename)
+            continue
+
+        done = f"as Image ID {image_id}" if image_id else "before"
+        if dry_run:
+            results.append((filename, 'unchanged', [f"{filename} was converted {done}; it would be deleted"]))
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            results.append((filename, 'failed', [f"[ERROR] Failed to delete: {filename}, Error: {e}"]))
+            continue
+        results.append((filename, 'unchanged', [f"{filename} was converted {done}; it has been deleted"]))
+
+    return new, digests, results
+
+
+def stream_convert(input_folder: str, filenames: List[str], workers: int = CONVERT_WORKERS,
+                   depth: int = CONVERT_QUEUE_DEPTH, batch_size: int = NORMALISE_BATCH_SIZE,
+                   formats=OUTPUT_FORMATS,
+                   cancel: Optional[threading.Event] = None) -> Iterator[Tuple[str, Optional[str], List[str]]]:
+    """
+    Converts .raw files through a three-stage pipeline and yields the results in filename order.
+
+        reader  (1 thread)          identifies each .raw file and reads it into a stack
+                                    of up to `batch_size` same-geometry images
+        encoder (`workers` threads) scales each stack in one call
+                                    (normalise_stack) and encodes the outputs in memory
+        writer  (1 thread)          writes the outputs and deletes the .raw
+
+    The stages are joined by queues holding at most `depth` stacks (reader to
+    encoder) and `depth` images (encoder to writer). A slow stage blocks the one
+    before it, so memory stays bounded on any folder size while disk reads,
+    encoding and disk writes overlap.
+
+    With 'npz' output, the writer holds a participant's scans until the reader
+    has moved on to the next participant and every scan read has arrived, then
+    writes the archive; the .raw files are only deleted once it is written.
+
+    Every stage reports the errors of a file as that file's result. Should a
+    stage thread still die, the files without a result are reported as failed
+    and left in place instead of waiting on it.
+
+    Parameters:
+    ----------
+    input_folder : str
+        The folder containing the .raw files.
+    filenames : list of str
+        Names of the .raw files, in the order results should be yielded.
+    workers : int
+        Number of encoder threads.
+    depth : int
+        Capacity of each queue between stages.
+    batch_size : int
+        Most images normalised together (1 = one at a time).
+    formats : sequence of str
+        Output formats (see OUTPUT_FORMATS).
+    cancel : threading.Event, optional
+        Once set, files not yet read are left alone.
+
+    Yields:
+    ----------
+    (filename, status, messages)
+        status is 'converted', 'skipped' or 'failed', or None for a file left
+        alone because `cancel` was set.
     """
-    for filename in os.listdir(input_folder):
-        if filename.lower().endswith('.raw'):
-            raw_path = os.path.join(input_folder, filename)
+    import numpy as np
+
+    read_queue: queue.Queue = queue.Queue(maxsize=depth)
+    write_queue: queue.Queue = queue.Queue(maxsize=depth)
+    results: queue.Queue = queue.Queue()
+    workers = max(1, workers)
+    batch_size = max(1, batch_size)
+    archive = 'npz' in formats
+
+    # Scans per participant archive sent by the reader and received by the writer;
+    # an archive is complete once it is closed (the reader has moved on) and both counts agree
+    counts_lock = threading.Lock()
+    sent: Dict[str, int] = {}
+    received: Dict[str, int] = {}
+    closed = set()
+
+    # Every stage catches its own errors, so each file produces exactly one result
+    def reader() -> None:
+        # Stacks being filled, one per geometry: ([(filename, messages)], stack)
+        filling: Dict[RawGeometry, Tuple[List[Tuple[str, List[str]]], np.ndarray]] = {}
+
+        def send(geometry: RawGeometry) -> None:
+            items, stack = filling.pop(geometry)
+            read_queue.put((items, stack[:len(items)]))
+
+        try:
+            for filename in filenames:
+                if cancel is not None and cancel.is_set():
+                    results.put((filename, None, []))
+                    continue
+                messages: List[str] = []
+                try:
+                    geometry, status, messages = identify_raw_file(input_folder, filename)
+                    if geometry is None:
+                        results.put((filename, status, messages))
+                        continue
+                    # A plain read, not a memmap, so the disk work happens in this stage
+                    array = read_raw_image(os.path.join(input_folder, filename), geometry.width,
+                                           geometry.height, dtype=geometry.dtype)
+                except Exception as e:
+                    results.put((filename, 'failed', messages + [f"[ERROR] Failed to read: {filename}, Error: {e}"]))
+                    continue
+                participant = archive_name(os.path.splitext(filename)[0])
+                with counts_lock:
+                    # Filenames are sorted, so a new participant closes every earlier one
+                    closed.update(name for name in sent if name != participant)
+                    sent[participant] = sent.get(participant, 0) + 1
+                if batch_size == 1:
+                    # No stack to fill, so no copy
+                    read_queue.put(([(filename, messages)], array[np.newaxis]))
+                    continue
+                if geometry not in filling:
+                    filling[geometry] = ([], np.empty((batch_size, geometry.height, geometry.width), dtype=geometry.dtype))
+                items, stack = filling[geometry]
+                stack[len(items)] = array
+                items.append((filename, messages))
+                if len(items) == batch_size:
+                    send(geometry)
+            for geometry in list(filling):
+                send(geometry)
+        finally:
+            with counts_lock:
+                closed.update(sent)
+            for _ in range(workers):
+                read_queue.put(None)
+
+    def encoder() -> None:
+        try:
+            while True:
+                batch = read_queue.get()
+                if batch is None:
+                    break
+                items, stack = batch
+                try:
+                    scaled8 = scaled16 = None
+                    if 'bmp' in formats:
+                        scaled8 = normalise_stack(stack, out=_thread_buffer('images', stack.shape, np.uint8))
+                    if 'png16' in formats:
+                        scaled16 = normalise_stack(stack, out=_thread_buffer('images16', stack.shape, np.uint16))
+                except Exception as e:
+                    # NumPy raises a variety of errors on bad data; report and carry on
+                    for filename, messages in items:
+                        write_queue.put((filename, messages, e, None))
+                    continue
+                for i, (filename, messages) in enumerate(items):
+                    try:
+                        outputs = encode_outputs(stack[i], formats,
+                                                 None if scaled8 is None else scaled8[i],
+                                                 None if scaled16 is None else scaled16[i])
+                    except Exception as e:
+                        # PIL raises a variety of errors on bad data; report and carry on
+                        outputs = e
+                    write_queue.put((filename, messages, outputs, stack[i] if archive else None))
+        finally:
+            write_queue.put(None)
+
+    def finish(filename: str, messages: List[str]) -> None:
+        try:
+            os.remove(os.path.join(input_folder, filename))
+        except Exception as oe:
+            results.put((filename, 'failed', messages + [f"[ERROR] Converted but failed to delete: {filename}, Error: {oe}"]))
+            return
+        names = ", ".join(output_names(filename, formats))
+        results.put((filename, 'converted', messages + [f"{filename} has been converted to {names}"]))
+
+    def writer() -> None:
+        # Scans waiting for their participant archive: archive name -> [(filename, messages, array)]
+        waiting: Dict[str, List[Tuple[str, List[str], np.ndarray]]] = {}
+
+        def flush(name: str) -> None:
+            scans = waiting.pop(name)
+            try:
+                write_archive(input_folder, name, {os.path.splitext(f)[0]: a for f, _, a in scans})
+            except Exception as e:
+                # e.g. zipfile.BadZipFile from a damaged archive
+                for filename, messages, _ in scans:
+                    results.put((filename, 'failed', messages + [f"[ERROR] Failed to write: {name}, Error: {e}"]))
+                return
+            for filename, messages, _ in scans:
+                finish(filename, messages)
+
+        running = workers
+        while running:
+            item = write_queue.get()
+            if item is None:
+                running -= 1
+                continue
+            filename, messages, outputs, array = item
             base_name = os.path.splitext(filename)[0]
-            last_char = base_name[-1]  # Extract the last character before .raw
-
-            # Determine image dimensions based on last character
-            if last_char == '3':
-                width, height = 304, 304
-                print(f"Identified {filename} as 3×3 (304x304)")
-            elif last_char == '6':
-                width, height = 400, 400
-                print(f"Identified {filename} as 6×6 (400x400)")
+            if isinstance(outputs, Exception):
+                results.put((filename, 'failed', messages + [f"[ERROR] Failed to encode: {filename}, Error: {outputs}"]))
             else:
-                print(f"[WARNING] Unable to identify {filename}, last character is not 3 or 6. Skipping.")
-                continue
+                output_name = base_name
+                try:
+                    for extension, data in outputs:
+                        output_name = base_name + "." + extension
+                        with open(os.path.join(input_folder, output_name), 'wb') as f:
+                            f.write(data)
+                except Exception as oe:
+                    results.put((filename, 'failed', messages + [f"[ERROR] Failed to write: {output_name}, Error: {oe}"]))
+                else:
+                    if archive:
+                        waiting.setdefault(archive_name(base_name), []).append((filename, messages, array))
+                    else:
+                        finish(filename, messages)
+
+            if archive:
+                with counts_lock:
+                    participant = archive_name(base_name)
+                    received[participant] = received.get(participant, 0) + 1
+                    complete = [name for name in waiting
+                                if name in closed and received.get(name) == sent.get(name)]
+                for name in complete:
+                    flush(name)
+
+        # Every scan has arrived
+        for name in list(waiting):
+            flush(name)
 
-            # Read the .raw file
+    def stage(target) -> Callable[[], None]:
+        # A stage that dies anyway posts a None filename, so the loop below never waits on it
+        def run() -> None:
             try:
-                array = read_raw_image(raw_path, width, height)
-            except ValueError as ve:
-                print(f"[ERROR] Failed to read: {filename}, Error: {ve}")
+                target()
+            except BaseException as e:
+                results.put((None, target.__name__, [f"[ERROR] The {target.__name__} stopped: {e!r}"]))
+                raise
+        return run
+
+    threads = ([threading.Thread(target=stage(reader), daemon=True)]
+               + [threading.Thread(target=stage(encoder), daemon=True) for _ in range(workers)]
+               + [threading.Thread(target=stage(writer), daemon=True)])
+    for thread in threads:
+        thread.start()
+
+    # Results arrive in completion order; hold them back until their turn
+    finished: Dict[str, Tuple[Optional[str], List[str]]] = {}
+    stopped: Optional[List[str]] = None
+    for filename in filenames:
+        while filename not in finished and stopped is None:
+            name, status, messages = results.get()
+            if name is None:
+                stopped = messages
+            else:
+                finished[name] = (status, messages)
+        if filename in finished:
+            status, messages = finished.pop(filename)
+            yield filename, status, messages
+        else:
+            # The .raw is left in place, so the next run converts it
+            yield filename, 'failed', stopped
+
+    if stopped is None:
+        # The other stages may be blocked on a queue the dead stage no longer serves
+        for thread in threads:
+            thread.join()
+
+
+def batch_convert(input_folder: str, workers: int = CONVERT_WORKERS, dry_run: bool = False,
+                  cancel: Optional[threading.Event] = None, formats=OUTPUT_FORMATS,
+                  store: Optional[ContentStore] = None, filenames: Optional[List[str]] = None) -> Dict[str, List[str]]:
+    """
+    Batch processes .raw files:
+    - Identifies their geometry from the file length (see rawgeometry.RAW_GEOMETRIES).
+    - Converts them to the output formats (.bmp by default, see OUTPUT_FORMATS).
+    - Deletes the original .raw files.
+
+    Files are streamed through stream_convert, which overlaps reading, encoding
+    and writing. Output is printed in filename order as each file is done, so
+    the log is the same for any worker count.
+
+    Parameters:
+    ----------
+    input_folder : str
+        The folder containing .raw files to be processed.
+    workers : int
+        Number of encoder threads.
+    dry_run : bool
+        Only identify the files that would be converted.
+    cancel : threading.Event, optional
+        Once set, files not yet started are left alone and Cancelled is raised.
+    formats : sequence of str
+        Output formats (see OUTPUT_FORMATS).
+    store : ContentStore, optional
+        Content of earlier conversions; files already converted or duplicating
+        another scan are left out (see check_contents), and the files
+        converted now are added.
+    filenames : list of str, optional
+        Names of the .raw files to convert; by default every .raw in the folder.
+
+    Returns:
+    ----------
+    dict
+        Filenames grouped by status: 'converted', 'skipped', 'failed' and 'unchanged'.
+    """
+    if filenames is None:
+        filenames = [f for f in os.listdir(input_folder) if f.lower().endswith('.raw')]
+    filenames = sorted(filenames)
+    summary: Dict[str, List[str]] = {'converted': [], 'skipped': [], 'failed': [], 'unchanged': []}
+
+    checked: List[Tuple[str, str, List[str]]] = []
+    digests: Dict[str, Tuple[str, int]] = {}
+    todo = filenames
+    if store is not None:
+        with metrics.stage('hash'):
+            todo, digests, checked = check_contents(input_folder, filenames, store, dry_run, formats)
+
+    if dry_run:
+        # Nothing is read, so there is nothing to overlap
+        results = ((filename, *describe_conversion(input_folder, filename, formats))
+                   for filename in todo)
+    else:
+        results = stream_convert(input_folder, todo, workers, formats=formats, cancel=cancel)
+
+    converted = []
+    with metrics.stage('convert'):
+        for filename, status, messages in itertools.chain(checked, results):
+            if status is None:
                 continue
+            summary[status].append(filename)
+            if status == 'converted' and filename in digests and not dry_run:
+                digest, size = digests[filename]
+                converted.append((digest, filename, size))
+            metrics.count('converted' if status == 'converted' else 'convert_' + status)
+            if status == 'failed':
+                metrics.count('errors')
+            for message in messages:
+                # Warnings and errors are printed even in quiet mode
+                if message.startswith('['):
+                    print(message)
+                else:
+                    metrics.progress(message)
 
-            # Save as .bmp
-            bmp_name = base_name + ".bmp"
-            bmp_path = os.path.join(input_folder, bmp_name)
-            save_as_bmp(array, bmp_path)
+    if store is not None:
+        store.record(converted)
 
-            # Delete the original .raw file
-            os.remove(raw_path)
-            print(f"{filename} has been converted to {bmp_name}")
+    verb = "Would convert" if dry_run else "Converted"
+    unchanged = f", {len(summary['unchanged'])} unchanged" if summary['unchanged'] else ""
+    print(f"[INFO] {verb} {len(summary['converted'])} of {len(filenames)} .raw files "
+          f"({len(summary['skipped'])} skipped, {len(summary['failed'])} failed{unchanged}).")
+    for filename in summary['failed']:
+        print(f"[ERROR] Not converted: {filename}")
 
-batch_convert(FOLDER_PATH)
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+    return summary
 
 # -----------------------
-# Step 3: Build Mapping from Excel
+# Step 3: Rename .bmp Files
 # -----------------------
 
-df = pd.read_excel(LABELS_XLSX)
+def scan_size(path: str) -> str:
+    """
+    Returns the image size in scans ('304x304') of a converted image, or of the
+    image a .raw file will be converted to.
+    """
+    if path.lower().endswith('.raw'):
+        geometries = find_geometries(os.path.getsize(path))
+        return f"{geometries[0].width}x{geometries[0].height}" if len(geometries) == 1 else ''
 
-# Invert dictionaries to convert Excel text values back to single-letter codes
-inv_instrument_map = {v: k for k, v in INSTRUMENT_MAP.items()}
-inv_layer_map      = {v: k for k, v in LAYER_MAP.items()}
-inv_size_map       = {v: k for k, v in SIZE_MAP.items()}
+    from PIL import Image
 
-rename_map = {}
+    with Image.open(path) as img:
+        return f"{img.width}x{img.height}"
 
-for _, row in df.iterrows():
-    participant_id = row[COL_PARTICIPANT_ID]
-    instrument_str = row[COL_INSTRUMENT]
-    layer_str      = row[COL_LAYER]
-    size_str       = row[COL_SIZE]
+def plan_renames(folder_path: str, label_index: LabelIndex, dry_run: bool = False,
+                 history: ProcessedLog = None, formats=OUTPUT_FORMATS, ignore=(),
+                 base_names: Optional[List[str]] = None) -> RenamePlan:
+    """
+    Plans the rename of every converted image in the folder to its Image ID.
 
-    # Convert Image ID to a 4-digit string if it's numeric
-    try:
-        numeric_id = int(row[COL_IMAGE_ID])
-        image_id = f"{numeric_id:04d}"
-    except (ValueError, TypeError):
-        image_id = str(row[COL_IMAGE_ID])  # Fallback if not numeric
+    Parameters:
+    ----------
+    folder_path : str
+        Path to the Angiovue folder.
+    label_index : LabelIndex
+        Angiovue rows of the harmonisation workbook.
+    dry_run : bool
+        Also plan for the images that the .raw files would be converted to.
+    history : ProcessedLog, optional
+        Files recorded here as already renamed are skipped.
+    formats : sequence of str
+        Output formats (see OUTPUT_FORMATS); each per-scan image is renamed to
+        <Image ID>.<extension>. Participant archives are not renamed.
+    ignore : collection of str
+        Names of .raw files left out of a dry run's plan.
+    base_names : list of str, optional
+        Only plan these scans (e.g. ['OCTA-004_AD3']) instead of listing the folder.
 
-    try:
-        instrument_letter = inv_instrument_map[instrument_str]
-        layer_letter      = inv_layer_map[layer_str]
-        size_digit        = inv_size_map[size_str]
-    except KeyError:
-        # Skip any row that doesn't match the mapping
-        continue
+    Returns:
+    ----------
+    RenamePlan
+        One rename per matched file; files without a match are reported and left out.
+    """
+    plan = RenamePlan(folder_path)
+    extensions = [OUTPUT_EXTENSIONS[f] for f in formats if f != 'npz']
+
+    files = []
+    with metrics.stage('walk'):
+        for extension in extensions:
+            if base_names is None:
+                matches = glob.glob(os.path.join(folder_path, '*.' + extension))
+            else:
+                matches = [p for p in (os.path.join(folder_path, f"{b}.{extension}") for b in base_names)
+                           if os.path.exists(p)]
+            if extension == 'png':
+                # Angiovue's own .png exports are still there in a dry run
+                matches = [p for p in matches if is_converted_png(p)]
+            files += matches
+        if dry_run:
+            raws = (glob.glob(os.path.join(folder_path, '*.raw')) if base_names is None else
+                    [p for p in (os.path.join(folder_path, b + '.raw') for b in base_names) if os.path.exists(p)])
+            files += [p for p in raws if os.path.basename(p) not in ignore]
 
-    key = (participant_id, instrument_letter, layer_letter, size_digit)
-    rename_map[key] = image_id
+    # Files of one scan in several formats are matched once
+    scans: Dict[str, List[str]] = {}
+    for file_path in sorted(files):
+        if history is not None and history.is_processed(file_path):
+            metrics.count('skipped')
+            continue
+        scans.setdefault(os.path.splitext(os.path.basename(file_path))[0], []).append(file_path)
+
+    for base_name, paths in scans.items():
+        with metrics.stage('parse'):
+            # Base names follow the tag grammar, e.g. 'OCTA-004_AD3' (see tags.py)
+            tag = parse_tag_name(base_name)
+            if tag is not None and tag.instrument == INSTRUMENT:
+                # The scan size is whatever geometry the .raw was converted with
+                scans_str = scan_size(paths[0])
+        if tag is None or tag.instrument != INSTRUMENT:
+            metrics.count('unparsed')
+            print(f"[WARNING] Unable to parse '{base_name}.raw'; skipping.")
+            continue
+
+        with metrics.stage('match'):
+            new_id = label_index.lookup(tag.study_id, tag.instrument, tag.layer, tag.size_mm, scans_str)
+            duplicate = new_id is None and label_index.is_duplicate(tag.study_id, tag.instrument, tag.layer,
+                                                                    tag.size_mm, scans_str)
+        metrics.count('matched' if new_id is not None else 'ambiguous' if duplicate else 'unmatched')
+
+        if new_id is not None:
+            # A .raw stands for the images it would be converted to
+            planned = sorted({ext for path in paths for ext in
+                              (extensions if path.lower().endswith('.raw') else [path.rsplit('.', 1)[1]])})
+            for extension in planned:
+                plan.add(os.path.join(folder_path, base_name + "." + extension),
+                         os.path.join(folder_path, f"{new_id}.{extension}"), new_id)
+        elif duplicate:
+            print(f"[WARNING] '{base_name}.raw' matches more than one row in Excel; skipping.")
+        else:
+            print(f"[WARNING] No match in Excel for '{base_name}.raw'; skipping.")  # Warn if no match was found
+
+    return plan
 
 # -----------------------
-# Step 4: Rename .bmp Files
+# Pipeline
 # -----------------------
 
-def parse_bmp_filename(filename_base: str):
+def run(root: str = FOLDER_PATH, labels: Optional[LabelStore] = None, dry_run: bool = False,
+        full: bool = False, cancel: Optional[threading.Event] = None,
+        formats=OUTPUT_FORMATS, dedup: bool = DEDUPLICATE,
+        paths: Optional[List[str]] = None) -> List[Rename]:
     """
-    Parses a .bmp filename (without extension), returning:
-        (participant_id, instrument_letter, layer_letter, size_digit)
+    Removes .png files, converts .raw files and renames the results to their Image IDs.
+
+    Parameters:
+    ----------
+    root : str
+        Path to the Angiovue folder.
+    labels : LabelStore, optional
+        Already-loaded label data; by default the workbook at LABELS_XLSX is read.
+    dry_run : bool
+        Print what would be done without changing any file.
+    full : bool
+        Check every .bmp again, ignoring the history of earlier runs.
+    cancel : threading.Event, optional
+        Once set, the run stops before the next file with Cancelled.
+    formats : sequence of str
+        Output formats (see OUTPUT_FORMATS).
+    dedup : bool
+        Skip .raw files converted before and report duplicate scans (see DEDUPLICATE).
+    paths : list of str, optional
+        Only handle these .png and .raw files of the folder (see watch.py); by
+        default the whole folder is processed.
+
+    Returns:
+    ----------
+    list of Rename
+        The renames applied (planned, for a dry run).
+
+    Raises:
+    ----------
+    RuntimeError
+        If the folder does not exist, or the rename plan is refused; no file is renamed.
+    OSError
+        If a rename fails; the journal is kept (see renamer.py).
     """
-    parts = filename_base.split('_')
-    participant_id = parts[0]
-    remainder = parts[1] if len(parts) > 1 else ''
+    if not os.path.isdir(root):
+        raise RuntimeError(f"Folder not found: {root}")
+    if labels is None:
+        labels = LabelStore(LABELS_XLSX)
 
-    instrument_letter = remainder[0] if len(remainder) > 0 else ''
-    layer_letter      = remainder[1] if len(remainder) > 1 else ''
-    size_digit        = remainder[2] if len(remainder) > 2 else ''
+    pngs = raws = None
+    if paths is not None:
+        names = [os.path.basename(p) for p in paths]
+        pngs = [os.path.join(root, n) for n in names if n.lower().endswith('.png')]
+        raws = [n for n in names if n.lower().endswith('.raw')]
 
-    return participant_id, instrument_letter, layer_letter, size_digit
+    with metrics.stage('cleanup'):
+        remove_png_files(root, dry_run, pngs)
+    # A dry run only reads the history, so it leaves the folder untouched
+    with ContentStore(root, read_only=dry_run) if dedup else contextlib.nullcontext() as store:
+        converted = batch_convert(root, dry_run=dry_run, cancel=cancel, formats=formats, store=store,
+                                  filenames=raws)
 
-bmp_files = glob.glob(os.path.join(FOLDER_PATH, '*.bmp'))
+    # Only the Angiovue rows are indexed; Image IDs come back zero-padded to 4 digits.
+    # Ambiguous keys are reported here and never renamed.
+    with metrics.stage('load'):
+        label_index = labels.labels(INSTRUMENT)
+    label_index.report_duplicates()
 
-for bmp_file in bmp_files:
-    base_name = os.path.splitext(os.path.basename(bmp_file))[0]
-    participant_id, instr_letter, layer_letter, size_digit = parse_bmp_filename(base_name)
+    with ProcessedLog(root, read_only=dry_run) as history:
+        # In a dry run, .raw files that will stay unconverted are not planned either
+        left = converted['skipped'] + converted['failed'] + converted['unchanged'] if dry_run else []
+        base_names = None
+        if paths is not None:
+            base_names = [os.path.splitext(f)[0] for f in converted['converted']]
+        plan = plan_renames(root, label_index, dry_run, None if full else history, formats, left, base_names)
+        # Check the whole plan before any file is touched
+        return execute(plan, history, dry_run, cancel)
 
-    key = (participant_id, instr_letter, layer_letter, size_digit)
 
-    if key in rename_map:
-        new_id = rename_map[key]
-        new_name = f"{new_id}.bmp"
-        new_path = os.path.join(FOLDER_PATH, new_name)
-        os.rename(bmp_file, new_path)
-        print(f"'{base_name}.raw' has been changed to '{new_name}'")  # Print confirmation of the renaming
-    else:
-        print(f"[WARNING] No match in Excel for '{base_name}.raw'; skipping.")  # Warn if no match was found
\ No newline at end of file
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="angiovue.py", description="Convert and rename Angiovue exports.")
+    parser.add_argument("--dry-run", action="store_true", help="print what would be done without changing any file")
+    recovery = parser.add_mutually_exclusive_group()
+    recovery.add_argument("--resume", action="store_true", help="finish interrupted renames from their journal")
+    recovery.add_argument("--rollback", action="store_true", help="undo interrupted renames from their journal")
+    parser.add_argument("--full", action="store_true", help="check every .bmp again, ignoring the history of earlier runs")
+    parser.add_argument("--format", dest="formats", action="append", choices=sorted(OUTPUT_EXTENSIONS),
+                        help="output format; repeat for several (default: " + ", ".join(OUTPUT_FORMATS) + ")")
+    parser.add_argument("--dedup", action="store_true", default=DEDUPLICATE,
+                        help="skip .raw files converted before and report duplicate scans")
+    parser.add_argument("--quiet", action="store_true", help="only print warnings, errors and the summary, not one line per file")
+    parser.add_argument("--metrics", metavar="FILE", help="write the stage timings and counts to FILE as JSON")
+    parser.add_argument("--check", action="store_true", help="check the folder and workbook without converting or renaming any file")
+    parser.add_argument("--version", action="version", version="%(prog)s " + preflight.__version__)
+    args = parser.parse_args(argv)
+
+    if args.check:
+        if not preflight.report(preflight.check_folder('angiovue', FOLDER_PATH, LABELS_XLSX)):
+            sys.exit(1)
+        return
+
+    with metrics.collect(quiet=args.quiet) as run_metrics:
+        if (args.resume or args.rollback) and not os.path.exists(journal_path(FOLDER_PATH)):
+            print(f"[INFO] No unfinished rename journal in {FOLDER_PATH}")
+            return
+        if args.resume:
+            with ProcessedLog(FOLDER_PATH) as history:
+                history.record(resume(FOLDER_PATH))
+            return
+        if args.rollback:
+            rollback(FOLDER_PATH)
+            return
+
+        failed = False
+        try:
+            run(FOLDER_PATH, dry_run=args.dry_run, full=args.full, formats=tuple(args.formats or OUTPUT_FORMATS),
+                dedup=args.dedup)
+        except (RuntimeError, OSError) as e:
+            print(f"[ERROR] {e}")
+            failed = True
+
+    print(run_metrics.summary())
+    if args.metrics:
+        run_metrics.write_json(args.metrics, instrument='angiovue', root=FOLDER_PATH, dry_run=args.dry_run,
+                               failed=failed)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
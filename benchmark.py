@@ -0,0 +1,253 @@
+"""
+Benchmark of the Revo, Spectralis and Angiovue pipelines on a synthetic dataset.
+
+A scratch folder is filled with a dataset shaped like the real exports:
+    REVO/OCTAxxx/<mm>_<scans>/<GIVEN SURNAME>_<layer>_..._<date>.tiff
+    Spectralis/<Surname Given> OD <date> OCTA  <nn>_<layer> PARoff v6.16.7.0.tif
+    AVANTI/OCTA-xxx_A<layer><size>.raw   (float32, with the .png exports)
+    2025_OCTA_HARMONISATION_LABELS.xlsx  (one row per scan, all unique)
+    2024_PartialData.xlsx                (one name per participant)
+Every stage (label loading, scanning, matching, conversion and renaming) is
+then timed on its own and reported as files per second.
+
+Usage:
+    python benchmark.py [--participants 50] [--trace-memory] [--keep DIR] [--output bench_output.txt]
+
+Note:
+    - Per-file output of the scripts is discarded while timing.
+    - Peak memory per stage needs --trace-memory (tracemalloc), which slows
+      Python code down; without it only the process's peak RSS is reported.
+    - Each participant adds about 3 MB of .raw data to the scratch folder.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import angiovue
+import relabel
+from labels import (COL_IMAGE_ID, COL_INSTRUMENT, COL_LAYER, COL_PARTICIPANT_ID, COL_SCANS, COL_SIZE,
+                    load_labels, load_name_index)
+from renamer import execute
+from scanner import scan_revo
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+# Scans generated per participant
+REVO_FOLDERS = ['3_320', '3_400', '6_400']
+REVO_LAYERS = ['Retina', 'Superficial', 'Deep', 'SVC', 'DCP']
+SPECTRALIS_LAYERS = ['03_Retina', '04_SVC', '06_SVP', '07_DVC', '09_DCP']
+ANGIOVUE_LAYERS = {'R': 'Retina', 'S': 'Superficial', 'D': 'Deep'}
+ANGIOVUE_SIZES = {'3': 304, '6': 400}
+
+
+class Stage(NamedTuple):
+    name: str
+    files: int
+    seconds: float
+    peak: Optional[int]     # bytes traced by tracemalloc; None without --trace-memory
+
+    @property
+    def rate(self) -> float:
+        return self.files / self.seconds if self.seconds > 0 else float('inf')
+
+
+# -----------------------
+# Synthetic dataset
+# -----------------------
+
+def _names(i: int):
+    """Returns (given name, surname, study ID) of participant i."""
+    return f"Given{i:04d}", f"Surname{i:04d}", f"OCTA-{i:03d}"
+
+def generate_dataset(root: str, participants: int, seed: int = 0) -> None:
+    """
+    Writes the synthetic exports and the two workbooks into `root`.
+
+    Parameters:
+    ----------
+    root : str
+        Empty scratch folder.
+    participants : int
+        Number of participants; every participant gets every scan type.
+    seed : int
+        Seed of the random .raw pixel data.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+
+    def label(study_id, instrument, layer, size, scans):
+        rows.append({COL_IMAGE_ID: len(rows) + 1, COL_PARTICIPANT_ID: study_id, COL_INSTRUMENT: instrument,
+                     COL_LAYER: layer, COL_SIZE: f"{size}x{size}", COL_SCANS: f"{scans}x{scans}"})
+
+    # One real 8-bit RGBA .png, reused for every Angiovue preview export
+    buffer = io.BytesIO()
+    Image.new('RGBA', (8, 8)).save(buffer, format='PNG')
+    png_export = buffer.getvalue()
+
+    for i in range(1, participants + 1):
+        given, surname, study_id = _names(i)
+
+        for folder in REVO_FOLDERS:
+            path = os.path.join(root, 'REVO', study_id.replace('-', ''), folder)
+            os.makedirs(path, exist_ok=True)
+            size, scans = folder.split('_')
+            for layer in REVO_LAYERS:
+                name = f"{given.upper()} {surname.upper()}_{layer}_ILM_0_IPL_INL_-15_20240906_193545.tiff"
+                with open(os.path.join(path, name), 'wb') as f:
+                    f.write(b'II*\0')
+                label(study_id, 'Revo', layer, size, scans)
+
+        path = os.path.join(root, 'Spectralis')
+        os.makedirs(path, exist_ok=True)
+        for token in SPECTRALIS_LAYERS:
+            name = f"{surname} {given} OD 2024-09-06T161513 OCTA  {token} PARoff v6.16.7.0.tif"
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(b'II*\0')
+            label(study_id, 'Spectralis', token.split('_')[1], '3', '512')
+
+        path = os.path.join(root, 'AVANTI')
+        os.makedirs(path, exist_ok=True)
+        for code, layer in ANGIOVUE_LAYERS.items():
+            for size, scans in ANGIOVUE_SIZES.items():
+                base_name = f"{study_id}_A{code}{size}"
+                rng.random((scans, scans), dtype=np.float32).tofile(os.path.join(path, base_name + '.raw'))
+                for suffix in ('.png', '_OCT.png'):
+                    with open(os.path.join(path, base_name + suffix), 'wb') as f:
+                        f.write(png_export)
+                label(study_id, 'Angiovue', layer, size, scans)
+
+    pd.DataFrame(rows).to_excel(os.path.join(root, os.path.basename(angiovue.LABELS_XLSX)), index=False)
+    names = [dict(zip(('Name', 'Surname', 'Study ID'), _names(i))) for i in range(1, participants + 1)]
+    pd.DataFrame(names).to_excel(os.path.join(root, '2024_PartialData.xlsx'), index=False)
+
+
+# -----------------------
+# Timing
+# -----------------------
+
+def timed(stages: List[Stage], name: str, func: Callable, files: Callable = len, trace: bool = False):
+    """
+    Runs `func` with its output discarded and appends its Stage to `stages`.
+
+    `files` turns the result into the number of files handled (default: len).
+    """
+    if trace:
+        tracemalloc.reset_peak()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if trace else None
+    stages.append(Stage(name, files(result), seconds, peak))
+    return result
+
+def run_benchmark(root: str, trace: bool = False) -> List[Stage]:
+    """Times every stage on the dataset in `root`; the dataset is renamed and converted in the process."""
+    labels_xlsx = os.path.join(root, os.path.basename(angiovue.LABELS_XLSX))
+    names_xlsx = os.path.join(root, '2024_PartialData.xlsx')
+    revo_root = os.path.join(root, 'REVO')
+    spectralis_root = os.path.join(root, 'Spectralis')
+    avanti_root = os.path.join(root, 'AVANTI')
+    stages: List[Stage] = []
+
+    # Labels: a full parse, then the first run that writes the sidecar, then a cached run
+    timed(stages, "labels: parse workbook", lambda: load_labels(labels_xlsx, use_cache=False), trace=trace)
+    load_labels(labels_xlsx)
+    timed(stages, "labels: cached", lambda: load_labels(labels_xlsx), trace=trace)
+    timed(stages, "names: parse workbook", lambda: load_name_index(names_xlsx, use_cache=False), trace=trace)
+    name_index = load_name_index(names_xlsx)
+
+    # Revo and Spectralis: matching is timed on the records scanned above, so scan and match are separate rows
+    records = timed(stages, "revo: scan", lambda: scan_revo(revo_root), trace=trace)
+    revo_labels = load_labels(labels_xlsx, 'Revo')
+    plan = timed(stages, "revo: match", lambda: relabel.revo(revo_labels, None, revo_root, records),
+                 files=lambda _: len(records), trace=trace)
+    timed(stages, "revo: rename", lambda: execute(plan), trace=trace)
+
+    spectralis_files = timed(stages, "spectralis: scan",
+                             lambda: [os.path.join(spectralis_root, f) for f in os.listdir(spectralis_root)],
+                             trace=trace)
+    spectralis_labels = load_labels(labels_xlsx, 'Spectralis')
+    plan = timed(stages, "spectralis: match",
+                 lambda: relabel.spectralis(name_index, spectralis_labels, None, spectralis_root, spectralis_files),
+                 files=lambda _: len(spectralis_files), trace=trace)
+    timed(stages, "spectralis: rename", lambda: execute(plan), trace=trace)
+
+    # Angiovue
+    pngs = len([f for f in os.listdir(avanti_root) if f.endswith('.png')])
+    timed(stages, "angiovue: remove .png", lambda: angiovue.remove_png_files(avanti_root),
+          files=lambda _: pngs, trace=trace)
+    timed(stages, "angiovue: convert", lambda: angiovue.batch_convert(avanti_root),
+          files=lambda summary: len(summary['converted']), trace=trace)
+    angiovue_labels = load_labels(labels_xlsx, 'Angiovue')
+    plan = timed(stages, "angiovue: plan (scan + match)",
+                 lambda: angiovue.plan_renames(avanti_root, angiovue_labels), trace=trace)
+    timed(stages, "angiovue: rename", lambda: execute(plan), trace=trace)
+
+    return stages
+
+def format_report(stages: List[Stage], participants: int, setup_seconds: float) -> str:
+    lines = [f"Synthetic dataset: {participants} participants (generated in {setup_seconds:.1f} s)",
+             "",
+             f"{'stage':<34}{'files':>8}{'seconds':>10}{'files/s':>12}{'peak MB':>10}"]
+    for stage in stages:
+        peak = f"{stage.peak / 2**20:.1f}" if stage.peak is not None else "-"
+        lines.append(f"{stage.name:<34}{stage.files:>8}{stage.seconds:>10.3f}{stage.rate:>12.0f}{peak:>10}")
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        maxrss_mb = maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+        lines += ["", f"Peak RSS of the process: {maxrss_mb:.1f} MB"]
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="Time each pipeline stage on synthetic data.")
+    parser.add_argument("--participants", type=int, default=50, help="participants in the synthetic dataset")
+    parser.add_argument("--trace-memory", action="store_true", help="report the peak traced memory of each stage")
+    parser.add_argument("--keep", metavar="DIR", help="generate the dataset in DIR and keep it")
+    parser.add_argument("--output", metavar="FILE", help="also write the report to FILE")
+    args = parser.parse_args(argv)
+
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=False)
+        root = args.keep
+    else:
+        root = tempfile.mkdtemp(prefix="relabel_bench_")
+
+    try:
+        start = time.perf_counter()
+        generate_dataset(root, args.participants)
+        setup_seconds = time.perf_counter() - start
+
+        if args.trace_memory:
+            tracemalloc.start()
+        stages = run_benchmark(root, args.trace_memory)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = format_report(stages, args.participants, setup_seconds)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Persistent history of relabelled files, used to make re-runs incremental.
+
+Every file that receives its Image ID is recorded in a SQLite database in the
+instrument folder (.relabel_history.sqlite) with its original name, final
+name, size and mtime. On the next run, files whose final name is in the
+history with the same size and mtime are skipped before any parsing or label
+lookup, so a re-run only works on new or changed files.
+
+The same database holds a ContentStore: the hash of every .raw file that
+angiovue.py converted, so redelivered exports can be recognised after the
+original .raw has been deleted.
+
+Note:
+    - Renaming a file does not change its mtime, so the recorded stat stays valid.
+    - Dry runs open the database read-only, and only if it already exists, so
+      they never create or change it.
+    - Deleting the database is always safe; the next run simply checks every file again.
+"""
+
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+HISTORY_NAME = '.relabel_history.sqlite'
+
+# Bytes read at a time when hashing a file
+DIGEST_CHUNK = 1 << 20
+
+
+def history_path(root: str) -> str:
+    """Returns the path of the history database for an instrument folder."""
+    return os.path.join(root, HISTORY_NAME)
+
+
+def _connect(root: str, read_only: bool) -> Optional[sqlite3.Connection]:
+    """Opens the history database of `root`; read-only, returns None if there is none yet."""
+    path = history_path(root)
+    if not read_only:
+        return sqlite3.connect(path)
+    if not os.path.exists(path):
+        return None
+    return sqlite3.connect(Path(os.path.abspath(path)).as_uri() + '?mode=ro', uri=True)
+
+
+def _has_table(db: Optional[sqlite3.Connection], name: str) -> bool:
+    return db is not None and db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+class ProcessedLog:
+    """
+    Files already relabelled in one instrument folder.
+
+    The whole table is read once when the log is opened, so `is_processed`
+    costs a dictionary lookup and a stat.
+
+    Parameters:
+    ----------
+    root : str
+        Instrument folder (e.g. './REVO').
+    read_only : bool
+        Only read an existing history (for a dry run); nothing is created or recorded.
+    """
+
+    def __init__(self, root: str, read_only: bool = False) -> None:
+        self.root = root
+        self.read_only = read_only
+        self._db = _connect(root, read_only)
+        if not read_only:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS processed ("
+                " path TEXT PRIMARY KEY,"       # final path, relative to root
+                " original TEXT NOT NULL,"      # name the file had before relabelling
+                " image_id TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " processed_at TEXT NOT NULL)"
+            )
+        self._stats: Dict[str, Tuple[int, int]] = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in (self._db.execute("SELECT path, size, mtime_ns FROM processed")
+                                         if _has_table(self._db, 'processed') else ())
+        }
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    def __enter__(self) -> 'ProcessedLog':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _key(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+
+    def is_processed(self, path: str) -> bool:
+        """
+        Returns True if `path` was relabelled by an earlier run and has not changed since.
+
+        A recorded file whose size or mtime differs is reported and treated as new.
+        """
+        key = self._key(path)
+        recorded = self._stats.get(key)
+        if recorded is None:
+            return False
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) == recorded:
+            return True
+        print(f"[WARNING] {key} has changed since it was relabelled; checking it again.")
+        return False
+
+    def record(self, renames: Iterable) -> int:
+        """
+        Records the renames that gave a file its Image ID.
+
+        Parameters:
+        ----------
+        renames : iterable of renamer.Rename
+            Applied renames; those without an image_id (intermediate names) are ignored.
+
+        Returns:
+        ----------
+        int
+            Number of files recorded (always 0 for a read-only log).
+        """
+        if self.read_only:
+            return 0
+        now = datetime.now().isoformat(timespec='seconds')
+        rows = []
+        for rename in renames:
+            if rename.image_id is None:
+                continue
+            stat = os.stat(rename.dst)
+            key = self._key(rename.dst)
+            rows.append((key, os.path.basename(rename.src), rename.image_id, stat.st_size, stat.st_mtime_ns, now))
+            self._stats[key] = (stat.st_size, stat.st_mtime_ns)
+
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+
+
+def file_digest(path: str) -> str:
+    """Returns the BLAKE2b hash of a file's content as 32 hex digits."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentStore:
+    """
+    Content hashes of the files converted in one instrument folder.
+
+    Each hash maps to the name of the file it was first converted from. The
+    Image ID that file's outputs received is looked up in the rename history.
+
+    Parameters:
+    ----------
+    root : str
+        Instrument folder (e.g. './AVANTI').
+    read_only : bool
+        Only read an existing history (for a dry run); nothing is created or recorded.
+    """
+
+    def __init__(self, root: str, read_only: bool = False) -> None:
+        self.root = root
+        self.read_only = read_only
+        self._db = _connect(root, read_only)
+        if not read_only:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS contents ("
+                " digest TEXT PRIMARY KEY,"     # file_digest() of the input
+                " name TEXT NOT NULL,"          # input file name, e.g. 'OCTA-004_AD3.raw'
+                " size INTEGER NOT NULL,"
+                " converted_at TEXT NOT NULL)"
+            )
+        self._names: Dict[str, str] = dict(self._db.execute("SELECT digest, name FROM contents")
+                                           if _has_table(self._db, 'contents') else ())
+        # Base name an output had before relabelling ('OCTA-004_AD3') -> its Image ID
+        self._image_ids: Dict[str, str] = {
+            os.path.splitext(original)[0]: image_id
+            for original, image_id in (self._db.execute("SELECT original, image_id FROM processed")
+                                       if _has_table(self._db, 'processed') else ())
+        }
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __enter__(self) -> 'ContentStore':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def lookup(self, digest: str) -> Optional[str]:
+        """Returns the name of the file first converted with this content, or None if it is new."""
+        return self._names.get(digest)
+
+    def image_id(self, name: str) -> Optional[str]:
+        """Returns the Image ID given to the outputs of input file `name`, or None if they were not renamed."""
+        return self._image_ids.get(os.path.splitext(name)[0])
+
+    def record(self, files: Iterable[Tuple[str, str, int]]) -> int:
+        """
+        Records converted inputs.
+
+        Parameters:
+        ----------
+        files : iterable of (digest, name, size)
+            One entry per converted input file; a known digest keeps its first name.
+
+        Returns:
+        ----------
+        int
+            Number of new digests recorded (always 0 for a read-only store).
+        """
+        if self.read_only:
+            return 0
+        now = datetime.now().isoformat(timespec='seconds')
+        rows = []
+        for digest, name, size in files:
+            if digest not in self._names:
+                self._names[digest] = name
+                rows.append((digest, name, size, now))
+        with self._db:
+            self._db.executemany("INSERT OR IGNORE INTO contents VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
@@ -0,0 +1,548 @@
+"""
+Label index shared by relabel.py and angiovue.py, and the participant name
+index used to match Spectralis exports.
+
+The harmonisation workbook (2025_OCTA_HARMONISATION_LABELS.xlsx) assigns one
+Image ID to every combination of
+    (Study participant ID, Instrument, Retinal Layer, Image size [mm], Image size [scans]).
+The index is built once from the workbook rows so that each file can be resolved
+with a single dictionary lookup instead of a scan over the whole sheet.
+
+Prerequisites:
+    - openpyxl installed to read Excel. pandas is only needed for read_label_table.
+
+Cache:
+    Parsing a workbook through openpyxl takes seconds, so the normalised rows are
+    stored in a JSON sidecar next to it (e.g. .2025_OCTA_HARMONISATION_LABELS.xlsx.cache.json).
+    The sidecar is reused while the workbook's size and mtime are unchanged, or
+    while its SHA-256 still matches (e.g. after a copy that reset the mtime).
+    Any other change to the workbook re-parses it and rewrites the sidecar.
+
+Note:
+    - Rows with an empty key column (e.g. the unassigned Image IDs at the end of
+      the sheet) are ignored.
+    - A key that appears on more than one row is ambiguous. It is kept out of the
+      index and reported, so a file is never renamed twice.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from typing import TYPE_CHECKING, Dict, Hashable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+LabelKey = Tuple[str, str, str, str, str]
+
+# -----------------------
+# Configuration
+# -----------------------
+
+LABELS_XLSX = './2025_OCTA_HARMONISATION_LABELS.xlsx'
+NAMES_XLSX  = './2024_PartialData.xlsx'
+
+COL_IMAGE_ID       = 'Image ID'
+COL_PARTICIPANT_ID = 'Study participant ID'
+COL_INSTRUMENT     = 'Instrument'
+COL_LAYER          = 'Retinal Layer'
+COL_SIZE           = 'Image size [mm]'
+COL_SCANS          = 'Image size [scans]'
+
+KEY_COLUMNS   = [COL_PARTICIPANT_ID, COL_INSTRUMENT, COL_LAYER, COL_SIZE, COL_SCANS]
+LABEL_COLUMNS = [COL_IMAGE_ID] + KEY_COLUMNS
+
+CACHE_VERSION = 1
+
+_WHITESPACE = re.compile(r'\s+')
+_DIGITS = re.compile(r'\d+')
+
+# Cell texts that pandas.read_excel treats as empty (its default na_values), plus
+# Excel's error values; the rows read here match what pandas would return
+_MISSING = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>',
+    'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+    '#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!',
+])
+
+
+def _is_blank(value) -> bool:
+    """Returns True for None, NaN and empty strings (the ways Excel leaves a cell empty)."""
+    if value is None:
+        return True
+    if isinstance(value, float) and value != value:
+        return True
+    return isinstance(value, str) and not value.strip()
+
+
+def _normalise(value) -> str:
+    """
+    Converts a cell value to the string used in a label key.
+
+    Participant IDs typed as numbers come back from Excel as 7 or 7.0; both become '7'.
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _normalise_size(value) -> str:
+    """Converts an image size to the form used in a label key: '3 X 3' becomes '3x3'."""
+    return _WHITESPACE.sub('', _normalise(value)).lower()
+
+
+def make_key(study_id, instrument, layer, size_mm, size_scans) -> LabelKey:
+    """
+    Builds a normalised label key.
+
+    Parameters:
+    ----------
+    study_id : str
+        Study participant ID, e.g. 'OCTA-004'.
+    instrument : str
+        Instrument name as written in the workbook ('Revo', 'Spectralis', 'Angiovue').
+    layer : str
+        Retinal layer as written in the workbook ('Retina', 'Superficial', 'SVC', ...).
+    size_mm : str
+        Image size in millimetres, e.g. '3x3'.
+    size_scans : str
+        Image size in scans, e.g. '320x320'.
+
+    Returns:
+    ----------
+    LabelKey
+        Tuple of normalised strings.
+    """
+    return (_normalise(study_id), _normalise(instrument), _normalise(layer),
+            _normalise_size(size_mm), _normalise_size(size_scans))
+
+
+class LabelIndex:
+    """
+    Maps a label key to its Image ID.
+
+    Parameters:
+    ----------
+    rows : iterable of sequences
+        Rows shaped as (Image ID, Study participant ID, Instrument, Retinal Layer,
+        Image size [mm], Image size [scans]).
+    """
+
+    def __init__(self, rows: Iterable[Sequence]) -> None:
+        found: Dict[LabelKey, List[Hashable]] = {}
+
+        for image_id, study_id, instrument, layer, size_mm, size_scans in rows:
+            if any(_is_blank(v) for v in (image_id, study_id, instrument, layer, size_mm, size_scans)):
+                continue
+            key = make_key(study_id, instrument, layer, size_mm, size_scans)
+            found.setdefault(key, []).append(image_id)
+
+        self._index: Dict[LabelKey, Hashable] = {k: ids[0] for k, ids in found.items() if len(ids) == 1}
+        self.duplicates: Dict[LabelKey, List[Hashable]] = {k: ids for k, ids in found.items() if len(ids) > 1}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: LabelKey) -> bool:
+        return key in self._index
+
+    def lookup(self, study_id, instrument, layer, size_mm, size_scans) -> Optional[Hashable]:
+        """
+        Returns the Image ID for the given label fields, or None when there is no
+        unambiguous match.
+        """
+        return self._index.get(make_key(study_id, instrument, layer, size_mm, size_scans))
+
+    def is_duplicate(self, study_id, instrument, layer, size_mm, size_scans) -> bool:
+        """Returns True if the label fields match more than one row of the workbook."""
+        return make_key(study_id, instrument, layer, size_mm, size_scans) in self.duplicates
+
+    def report_duplicates(self, instrument: Optional[str] = None) -> None:
+        """
+        Prints one warning per ambiguous key. Files with these keys will not be renamed.
+
+        Parameters:
+        ----------
+        instrument : str, optional
+            Only report keys for this instrument (e.g. 'Revo'). Reports all keys if omitted.
+        """
+        for key, image_ids in self.duplicates.items():
+            if instrument is not None and key[1] != instrument:
+                continue
+            ids = ", ".join(str(i) for i in image_ids)
+            print(f"[WARNING] Duplicate label {key} for Image IDs {ids}; matching files will be skipped.")
+
+
+def normalise_name(name: str) -> str:
+    """
+    Normalises a patient name for matching: accents stripped, case-folded and
+    whitespace collapsed, so 'Ong  Élaine ' and 'ong elaine' are the same name.
+    """
+    decomposed = unicodedata.normalize('NFKD', str(name))
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+class NameIndex:
+    """
+    Maps a normalised "Surname Givenname" to its Study ID.
+
+    A name listed with more than one Study ID is ambiguous: it is kept out of the
+    index and listed in `ambiguous`.
+
+    Parameters:
+    ----------
+    rows : iterable of sequences
+        Rows shaped as (Givenname, Surname, Study ID), as returned by `load_names`.
+    """
+
+    def __init__(self, rows: Iterable[Sequence]) -> None:
+        found: Dict[str, List[str]] = {}
+
+        for givenname, surname, study_id in rows:
+            if any(_is_blank(v) for v in (givenname, surname, study_id)):
+                continue
+            key = normalise_name(f"{surname} {givenname}")
+            study_id = _normalise(study_id)
+            ids = found.setdefault(key, [])
+            if study_id not in ids:
+                ids.append(study_id)
+
+        self._index: Dict[str, str] = {k: ids[0] for k, ids in found.items() if len(ids) == 1}
+        self.ambiguous: Dict[str, List[str]] = {k: ids for k, ids in found.items() if len(ids) > 1}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def lookup(self, name: str) -> Optional[str]:
+        """Returns the Study ID for a "Surname Givenname", or None when there is no unambiguous match."""
+        return self._index.get(normalise_name(name))
+
+    def is_ambiguous(self, name: str) -> bool:
+        """Returns True if the name is listed with more than one Study ID."""
+        return normalise_name(name) in self.ambiguous
+
+    def report_ambiguous(self) -> None:
+        """Prints one warning per ambiguous name. Files for these patients will not be renamed."""
+        for name, study_ids in self.ambiguous.items():
+            print(f"[WARNING] Name '{name}' is listed for Study IDs {', '.join(study_ids)}; matching files will be skipped.")
+
+
+# -----------------------
+# Loading from Excel
+# -----------------------
+
+def _sheet_rows(xlsx_path: str) -> Iterator[tuple]:
+    """Yields the rows of the first sheet as tuples of cell values, header row first."""
+    # Imported here: openpyxl takes a third of a second to import, and a fresh cache never needs it
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _cell_text(row: tuple, column: int) -> Optional[str]:
+    """Returns a cell as text, as pandas.read_excel(dtype=str) would, or None if it is empty."""
+    value = row[column] if column < len(row) else None
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value)
+    return None if text in _MISSING else text
+
+
+def _strip_cell(text: str) -> str:
+    """Strips a cell and turns a number typed as '7.0' back into '7'."""
+    text = text.strip()
+    return text[:-2] if text.endswith('.0') else text
+
+
+def read_label_rows(xlsx_path: str = LABELS_XLSX) -> List[List[str]]:
+    """
+    Reads the label columns of the harmonisation workbook with openpyxl.
+
+    Only the six label columns are kept, as strings:
+    - Image IDs are zero-padded to 4 digits ('509' -> '0509'); non-numeric IDs are kept as-is.
+    - Participant IDs, instruments and layers are stripped.
+    - Image sizes lose whitespace and are lower-cased ('3 X 3' -> '3x3').
+    - Rows with an empty label column are dropped.
+
+    Parameters:
+    ----------
+    xlsx_path : str
+        Path to the harmonisation workbook.
+
+    Returns:
+    ----------
+    list of lists
+        Rows shaped as LABEL_COLUMNS.
+
+    Raises:
+    ----------
+    ValueError
+        If a label column is missing from the header row.
+    """
+    rows = _sheet_rows(xlsx_path)
+    header = [str(value).strip() if value is not None else '' for value in next(rows, ())]
+    missing = [col for col in LABEL_COLUMNS if col not in header]
+    if missing:
+        raise ValueError(f"{xlsx_path} has no column {', '.join(repr(col) for col in missing)}")
+    columns = [header.index(col) for col in LABEL_COLUMNS]
+
+    table = []
+    for row in rows:
+        cells = [_cell_text(row, column) for column in columns]
+        if None in cells:
+            continue
+        image_id, study_id, instrument, layer, size_mm, size_scans = cells
+        image_id = _strip_cell(image_id)
+        if _DIGITS.fullmatch(image_id):
+            image_id = image_id.zfill(4)
+        cells = [image_id, _strip_cell(study_id), _strip_cell(instrument), _strip_cell(layer),
+                 _WHITESPACE.sub('', size_mm).lower(), _WHITESPACE.sub('', size_scans).lower()]
+        if '' not in cells:
+            table.append(cells)
+    return table
+
+
+def read_label_table(xlsx_path: str = LABELS_XLSX, instrument: Optional[str] = None,
+                     use_cache: bool = False) -> 'pd.DataFrame':
+    """
+    Reads the label columns of the harmonisation workbook into a pandas table.
+
+    The rows are those of read_label_rows; pandas is imported only here.
+
+    Parameters:
+    ----------
+    xlsx_path : str
+        Path to the harmonisation workbook.
+    instrument : str, optional
+        Keep only rows for this instrument (e.g. 'Revo').
+    use_cache : bool
+        Read and refresh the JSON sidecar instead of always parsing the workbook (see load_labels).
+
+    Returns:
+    ----------
+    pd.DataFrame
+        Table with columns LABEL_COLUMNS.
+    """
+    import pandas as pd
+
+    rows = _cached_rows(xlsx_path, read_label_rows, use_cache)
+    if instrument is not None:
+        rows = [row for row in rows if row[2] == instrument]
+    return pd.DataFrame(rows, columns=LABEL_COLUMNS)
+
+
+def load_labels(xlsx_path: str = LABELS_XLSX, instrument: Optional[str] = None,
+                use_cache: bool = True) -> LabelIndex:
+    """
+    Returns the LabelIndex of the harmonisation workbook.
+
+    Parameters:
+    ----------
+    xlsx_path : str
+        Path to the harmonisation workbook.
+    instrument : str, optional
+        Only index rows for this instrument (e.g. 'Revo').
+    use_cache : bool
+        Read and refresh the JSON sidecar instead of always parsing the workbook.
+    """
+    rows = _cached_rows(xlsx_path, read_label_rows, use_cache)
+    if instrument is not None:
+        rows = [row for row in rows if row[2] == instrument]
+    return LabelIndex(rows)
+
+
+def load_names(xlsx_path: str = NAMES_XLSX, use_cache: bool = True) -> List[List[str]]:
+    """
+    Reads the participant name sheet (2024_PartialData.xlsx).
+
+    Parameters:
+    ----------
+    xlsx_path : str
+        Path to the name workbook.
+    use_cache : bool
+        Read and refresh the JSON sidecar instead of always parsing the workbook.
+
+    Returns:
+    ----------
+    list of [Givenname, Surname, Study ID]
+        One entry per row with all three cells filled.
+    """
+    return _cached_rows(xlsx_path, _read_name_rows, use_cache)
+
+
+def load_name_index(xlsx_path: str = NAMES_XLSX, use_cache: bool = True) -> NameIndex:
+    """Returns the NameIndex of the participant name sheet (2024_PartialData.xlsx)."""
+    return NameIndex(load_names(xlsx_path, use_cache))
+
+
+class LabelStore:
+    """
+    Label and name indexes kept loaded between runs in one process.
+
+    The GUI and pipeline.py run several jobs in a row; each job asks the store
+    for its index instead of reading the workbooks again. A workbook whose
+    size or mtime has changed since it was loaded is read again.
+
+    Parameters:
+    ----------
+    labels_xlsx : str
+        Path to the harmonisation workbook.
+    names_xlsx : str
+        Path to the participant name sheet.
+    use_cache : bool
+        Read and refresh the JSON sidecars (see load_labels).
+    shared : LabelStore, optional
+        Share the indexes loaded by this store, e.g. when several folders use
+        the same harmonisation workbook with different name sheets.
+    """
+
+    def __init__(self, labels_xlsx: str = LABELS_XLSX, names_xlsx: str = NAMES_XLSX,
+                 use_cache: bool = True, shared: Optional['LabelStore'] = None) -> None:
+        self.labels_xlsx = labels_xlsx
+        self.names_xlsx = names_xlsx
+        self.use_cache = use_cache
+        # Indexes are kept per workbook, so stores sharing them never mix up two workbooks
+        if shared is None:
+            self._loaded: Dict[Tuple[str, Optional[str]], Tuple[Tuple[int, int], object]] = {}
+            self._lock = threading.Lock()
+        else:
+            self._loaded = shared._loaded
+            self._lock = shared._lock
+
+    def _get(self, slot: Optional[str], xlsx_path: str, load):
+        stat = os.stat(xlsx_path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        key = (os.path.abspath(xlsx_path), slot)
+        with self._lock:
+            loaded = self._loaded.get(key)
+            if loaded is None or loaded[0] != stamp:
+                loaded = self._loaded[key] = (stamp, load())
+            return loaded[1]
+
+    def labels(self, instrument: Optional[str] = None) -> LabelIndex:
+        """Returns the LabelIndex for one instrument (e.g. 'Revo'), or for all rows."""
+        return self._get(instrument, self.labels_xlsx,
+                         lambda: load_labels(self.labels_xlsx, instrument, self.use_cache))
+
+    def names(self) -> NameIndex:
+        """Returns the NameIndex of the participant name sheet."""
+        # Instrument names are never empty, so '' cannot clash with a label slot
+        return self._get('', self.names_xlsx, lambda: load_name_index(self.names_xlsx, self.use_cache))
+
+
+def _read_name_rows(xlsx_path: str) -> List[List[str]]:
+    rows = _sheet_rows(xlsx_path)
+    next(rows, None)    # header
+    table = []
+    for row in rows:
+        cells = [_cell_text(row, column) for column in range(3)]
+        if None not in cells:
+            table.append(cells)
+    return table
+
+
+# -----------------------
+# Parsed-workbook cache
+# -----------------------
+
+def cache_path(xlsx_path: str) -> str:
+    """Returns the path of the JSON sidecar for a workbook."""
+    folder, name = os.path.split(xlsx_path)
+    return os.path.join(folder, f".{name}.cache.json")
+
+
+def _content_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_is_fresh(xlsx_path: str) -> bool:
+    """Returns True if the workbook's sidecar is up to date, i.e. loading it will not parse the workbook."""
+    try:
+        stat = os.stat(xlsx_path)
+        with open(cache_path(xlsx_path), 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (cached.get('version') == CACHE_VERSION and cached.get('size') == stat.st_size
+            and cached.get('mtime_ns') == stat.st_mtime_ns)
+
+
+def _cached_rows(xlsx_path: str, reader, use_cache: bool) -> List[List[str]]:
+    """
+    Returns the rows parsed from a workbook by `reader`, using the sidecar when it is fresh.
+
+    Parameters:
+    ----------
+    xlsx_path : str
+        Path to the workbook.
+    reader : callable
+        Parses the workbook into a list of rows of strings.
+    use_cache : bool
+        If False, the workbook is always parsed and the sidecar is left untouched.
+    """
+    if not use_cache:
+        return reader(xlsx_path)
+
+    sidecar = cache_path(xlsx_path)
+    stat = os.stat(xlsx_path)
+
+    try:
+        with open(sidecar, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+
+    if cached is not None and cached.get('version') == CACHE_VERSION:
+        if cached.get('size') == stat.st_size and cached.get('mtime_ns') == stat.st_mtime_ns:
+            return cached['rows']
+        sha256 = _content_hash(xlsx_path)
+        if cached.get('sha256') == sha256:
+            # Same content with a new mtime: keep the rows, refresh the stamp
+            _write_cache(sidecar, stat, sha256, cached['rows'])
+            return cached['rows']
+    else:
+        sha256 = _content_hash(xlsx_path)
+
+    rows = reader(xlsx_path)
+    _write_cache(sidecar, stat, sha256, rows)
+    return rows
+
+
+def _write_cache(sidecar: str, stat: os.stat_result, sha256: str, rows: List[List[str]]) -> None:
+    payload = {
+        'version': CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256,
+        'rows': rows,
+    }
+    # A temporary file of its own, so two processes refreshing the same sidecar never share one
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(sidecar) + '.', suffix='.tmp',
+                                        dir=os.path.dirname(sidecar) or '.')
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump(payload, f)
+        # mkstemp makes the file private; other users of a shared folder read the sidecar too
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, sidecar)
+    except OSError as e:
+        # A read-only share still works, it just parses the workbook every time
+        print(f"[WARNING] Unable to write label cache {sidecar}: {e}")
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
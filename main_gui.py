@@ -1,38 +1,161 @@
 import tkinter as tk
-from tkinter import messagebox
-import subprocess
+from tkinter import messagebox, ttk
+from tkinter.scrolledtext import ScrolledText
+import contextlib
+import threading
+import traceback
+import queue
+import time
+import glob
+import io
 import os
+import metrics
+import pipeline
+from labels import LabelStore
+from renamer import Cancelled
 
 # Suppress macOS Tkinter deprecation warning
 os.environ['TK_SILENCE_DEPRECATION'] = '1'
 
-# Define button action functions
-def run_angiovue():
-    try:
-        subprocess.run(["python", "angiovue.py"], check=True)
-        messagebox.showinfo("Success", "Successfully ran angiovue.py!")
-    except subprocess.CalledProcessError:
-        messagebox.showerror("Error", "Failed to run angiovue.py.")
+# Counters (see metrics.py) bumped once per processed file; they drive the progress bar
+PROGRESS_COUNTERS = ("deleted", "converted", "convert_skipped", "convert_failed", "convert_unchanged", "renamed")
 
-def run_revo():
-    try:
-        subprocess.run(["python3", "relabel.py", "revo"], check=True)
-        messagebox.showinfo("Success", "Successfully ran relabel.py revo!")
-    except subprocess.CalledProcessError:
-        messagebox.showerror("Error", "Failed to run relabel.py revo.")
+# Keep the log widget small on 10k-file runs
+MAX_LOG_LINES = 2000
 
-def run_spectralis():
-    try:
-        subprocess.run(["python3", "relabel.py", "spectralis"], check=True)
-        messagebox.showinfo("Success", "Successfully ran relabel.py spectralis!")
-    except subprocess.CalledProcessError:
-        messagebox.showerror("Error", "Failed to run relabel.py spectralis.")
+# -----------------------
+# Jobs
+# -----------------------
+
+# Count the files a job will process, so the progress bar has a maximum
+def count_angiovue():
+    raws = glob.glob(os.path.join("AVANTI", "*.raw"))
+    pngs = glob.glob(os.path.join("AVANTI", "*.png"))
+    bmps = glob.glob(os.path.join("AVANTI", "*.bmp"))
+    # .png deleted, .raw converted then renamed, leftover .bmp renamed
+    return len(pngs) + 2 * len(raws) + len(bmps)
+
+def count_revo():
+    return sum(1 for path in glob.glob(os.path.join("REVO", "*", "*", "*")) if os.path.isfile(path))
+
+def count_spectralis():
+    return sum(1 for path in glob.glob(os.path.join("Spectralis", "*")) if os.path.isfile(path))
+
+COUNTERS = {
+    "Angiovue": count_angiovue,
+    "Revo": count_revo,
+    "Spectralis": count_spectralis,
+}
+
+class LineWriter(io.TextIOBase):
+    """Text stream that hands each complete line to `emit`; used to capture the scripts' print output."""
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.partial = ""
+
+    def write(self, text):
+        *lines, self.partial = (self.partial + text).split("\n")
+        for line in lines:
+            self.emit(line)
+        return len(text)
+
+    def flush(self):
+        if self.partial:
+            self.emit(self.partial)
+            self.partial = ""
+
+class JobRunner:
+    """
+    Runs queued jobs one at a time on a worker thread, in this process.
+
+    All jobs share one LabelStore, so the Excel files are read by the first
+    job only. The worker never touches Tk widgets. It puts (kind, job name,
+    payload) events on `events`, and the window polls them from the main thread:
+        ('start', name, expected file count)
+        ('line', name, output line)
+        ('done', name, (0 on success, 1 on failure or None if cancelled, final counters))
+    The counters of the running job are read from `metrics` (see metrics.py);
+    with `quiet` set, jobs print warnings, errors and their summary only.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.events = queue.Queue()
+        self.pending = []          # job names waiting to run, for display
+        self.running = None
+        self.cancel_event = threading.Event()
+        self.labels = LabelStore()
+        self.metrics = None        # Metrics of the running job
+        self.quiet = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, name):
+        with self.lock:
+            self.pending.append(name)
+        self.jobs.put(name)
+
+    def cancel(self):
+        # Drop queued jobs and stop the running one
+        with self.lock:
+            self.pending.clear()
+            self.cancel_event.set()
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                break
+
+    def _work(self):
+        while True:
+            name = self.jobs.get()
+            with self.lock:
+                # cancel() empties pending, so a job taken off the queue just before it was cancelled
+                if name not in self.pending:
+                    continue
+                self.pending.remove(name)
+                # Any Cancel pressed from here on stops this job; an older one was meant for the jobs before it
+                self.cancel_event.clear()
+                self.running = name
+            self.events.put(("start", name, COUNTERS[name]()))
+
+            # Only this thread prints while a job runs, so its output can be redirected
+            writer = LineWriter(lambda line: self.events.put(("line", name, line)))
+            result = 0
+            with contextlib.redirect_stdout(writer), metrics.collect(quiet=self.quiet) as job_metrics:
+                with self.lock:
+                    self.metrics = job_metrics
+                try:
+                    pipeline.run(name, labels=self.labels, cancel=self.cancel_event)
+                except Cancelled:
+                    result = None
+                except (RuntimeError, OSError) as e:
+                    print(f"[ERROR] {e}")
+                    result = 1
+                except Exception:
+                    # Keep the worker alive for the next job
+                    print(traceback.format_exc())
+                    result = 1
+                print(job_metrics.summary())
+            writer.flush()
+
+            with self.lock:
+                self.running = None
+                self.metrics = None
+            self.events.put(("done", name, (result, job_metrics.snapshot())))
+
+runner = JobRunner()
+
+# -----------------------
+# Window
+# -----------------------
 
 # Create main window
 window = tk.Tk()
 window.title("OCTA Relabel Utility (LEI)")
-window.geometry("400x440")
-window.resizable(False, False)
+window.geometry("520x820")
+window.resizable(False, True)
 window.configure(bg="#f5f5f5")  # Light background
 
 # Title label
@@ -51,16 +174,48 @@ button_style = {
     "relief": "flat"
 }
 
-# Add buttons
-btn1 = tk.Button(window, text="Run Angiovue", command=run_angiovue, **button_style)
+# Add buttons; each press queues a job, so several instruments can be run back to back
+btn1 = tk.Button(window, text="Run Angiovue", command=lambda: queue_job("Angiovue"), **button_style)
 btn1.pack(pady=5)
 
-btn2 = tk.Button(window, text="Run Revo", command=run_revo, **button_style)
+btn2 = tk.Button(window, text="Run Revo", command=lambda: queue_job("Revo"), **button_style)
 btn2.pack(pady=5)
 
-btn3 = tk.Button(window, text="Run Spectralis", command=run_spectralis, **button_style)
+btn3 = tk.Button(window, text="Run Spectralis", command=lambda: queue_job("Spectralis"), **button_style)
 btn3.pack(pady=5)
 
+# Progress of the running job
+status_var = tk.StringVar(value="Idle")
+status = tk.Label(window, textvariable=status_var, font=("Helvetica", 11), bg="#f5f5f5", fg="#333", anchor="w")
+status.pack(fill="x", padx=10, pady=(10, 0))
+
+progress = ttk.Progressbar(window, orient="horizontal", mode="determinate")
+progress.pack(fill="x", padx=10, pady=5)
+
+# Counters of the running job, then of the last one
+counts_var = tk.StringVar(value="")
+counts_label = tk.Label(window, textvariable=counts_var, font=("Helvetica", 10), bg="#f5f5f5", fg="#666",
+                        anchor="w", justify="left", wraplength=500)
+counts_label.pack(fill="x", padx=10)
+
+queue_var = tk.StringVar(value="Queue: empty")
+queue_label = tk.Label(window, textvariable=queue_var, font=("Helvetica", 10), bg="#f5f5f5", fg="#666", anchor="w")
+queue_label.pack(fill="x", padx=10)
+
+btn_cancel = tk.Button(window, text="Cancel", command=lambda: cancel_jobs(), state="disabled",
+                       font=("Helvetica", 11, "bold"), bd=0, relief="flat")
+btn_cancel.pack(pady=5)
+
+# Quiet: only warnings, errors and the summary reach the log; the progress bar still moves
+quiet_var = tk.BooleanVar(value=False)
+quiet_check = tk.Checkbutton(window, text="Quiet log (warnings, errors and summary only)", variable=quiet_var,
+                             command=lambda: setattr(runner, "quiet", quiet_var.get()), bg="#f5f5f5")
+quiet_check.pack()
+
+# Live output of the running job
+log = ScrolledText(window, height=10, font=("Courier", 10), state="disabled")
+log.pack(fill="both", expand=True, padx=10, pady=5)
+
 # Reminder label at the bottom
 reminder_text = (
     "Before using this tool, please ensure:\n\n"
@@ -82,8 +237,109 @@ reminder_label = tk.Label(
     fg="#444",
     justify="left",
     anchor="w",
-    wraplength=360
+    wraplength=480
 )
 reminder_label.pack(padx=10, pady=(10, 15))
+
+# -----------------------
+# Event handling (main thread only)
+# -----------------------
+
+state = {"name": None, "done": 0, "expected": 0, "started": 0.0, "results": []}
+
+def append_log(lines):
+    log.configure(state="normal")
+    log.insert("end", "\n".join(lines) + "\n")
+    # Trim old lines so the widget stays responsive
+    excess = int(log.index("end-1c").split(".")[0]) - MAX_LOG_LINES
+    if excess > 0:
+        log.delete("1.0", f"{excess + 1}.0")
+    log.see("end")
+    log.configure(state="disabled")
+
+def show_counts(counters):
+    counts_var.set(", ".join(f"{counter} {value}" for counter, value in sorted(counters.items())))
+
+def update_status():
+    name = state["name"]
+    with runner.lock:
+        job_metrics = runner.metrics
+    if name is not None and job_metrics is not None:
+        counters = job_metrics.snapshot()
+        state["done"] = sum(counters.get(counter, 0) for counter in PROGRESS_COUNTERS)
+        progress.configure(value=min(state["done"], state["expected"]))
+        show_counts(counters)
+    if name is None:
+        status_var.set("Idle")
+    else:
+        elapsed = max(time.monotonic() - state["started"], 1e-6)
+        rate = state["done"] / elapsed
+        status_var.set(f"{name}: {state['done']} / {state['expected']} files ({rate:.1f} files/s)")
+    with runner.lock:
+        pending = list(runner.pending)
+    queue_var.set("Queue: " + (", ".join(pending) if pending else "empty"))
+
+def queue_job(name):
+    runner.submit(name)
+    btn_cancel.configure(state="normal")
+    update_status()
+
+def cancel_jobs():
+    runner.cancel()
+    append_log(["[INFO] Cancel requested; the job stops before its next file. "
+                "If renaming was interrupted, run the script with --resume or --rollback."])
+    update_status()
+
+def finish_queue():
+    btn_cancel.configure(state="disabled")
+    results = state["results"]
+    state["results"] = []
+    failed = [name for name, ok in results if not ok]
+    # Result message
+    if failed:
+        messagebox.showerror("Error", "Failed or cancelled: " + ", ".join(failed))
+    elif results:
+        messagebox.showinfo("Success", "Successfully ran " + ", ".join(name for name, _ in results) + "!")
+
+def poll_events():
+    lines = []
+    try:
+        # Handle a bounded batch per tick so the window never stalls on a burst of output
+        for _ in range(500):
+            kind, name, payload = runner.events.get_nowait()
+            if kind == "start":
+                state.update(name=name, done=0, expected=max(payload, 1), started=time.monotonic())
+                progress.configure(maximum=state["expected"], value=0)
+                lines.append(f"===== {name} =====")
+            elif kind == "line":
+                lines.append(payload)
+            elif kind == "done":
+                result, counters = payload
+                show_counts(counters)
+                if result is None:
+                    lines.append(f"[INFO] {name} cancelled.")
+                else:
+                    lines.append(f"[INFO] {name} {'finished' if result == 0 else 'failed'}.")
+                    # Files skipped by the history bump no counter, so fill the bar once the job is done
+                    if result == 0:
+                        progress.configure(value=state["expected"])
+                state["results"].append((name, result == 0))
+                state["name"] = None
+    except queue.Empty:
+        pass
+
+    if lines:
+        append_log(lines)
+    update_status()
+
+    with runner.lock:
+        idle = runner.running is None and not runner.pending
+    if idle and state["name"] is None and runner.jobs.empty() and state["results"]:
+        finish_queue()
+
+    window.after(100, poll_events)
+
+window.after(100, poll_events)
+
 # Start the main event loop
 window.mainloop()
@@ -0,0 +1,171 @@
+"""
+Per-stage timers and counters for a pipeline run.
+
+A run is wrapped in `collect()`; the pipeline code then reports into the
+active Metrics through the module functions:
+
+    with metrics.stage('match'):         # adds the block's duration to the 'match' timer
+        imageID = labelIndex.lookup(...)
+    metrics.count('matched')             # increments a counter
+    metrics.progress(line)               # per-file output, suppressed in quiet mode
+
+Stages:
+    load      reading the Excel workbooks
+    cleanup   removing Angiovue .png exports
+    hash      hashing .raw files to find ones converted before (angiovue.py --dedup)
+    convert   .raw conversion
+    walk      listing the instrument folder
+    parse     reading tags and sizes from file names and headers
+    match     Study ID and Image ID lookups
+    rename    applying the rename plan
+
+Note:
+    - A run belongs to the thread that called `collect()`, so several runs can
+      be collected at once on different threads (see pipeline.run_manifest).
+      Report from that thread only.
+    - Outside `collect()` a process-wide Metrics still records everything; it is
+      simply never reported.
+    - Warnings and errors are always printed; quiet mode only drops the one
+      line per file.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+# Report order of the stages; stages not listed here follow in the order they were first timed
+STAGES = ('load', 'cleanup', 'hash', 'convert', 'walk', 'parse', 'match', 'rename')
+
+
+class _Timer:
+    """Context manager adding its duration to one timer; lighter than @contextmanager in per-file loops."""
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """
+    Timers and counters of one run.
+
+    Parameters:
+    ----------
+    quiet : bool
+        Drop per-file output (see `progress`).
+    """
+
+    def __init__(self, quiet: bool = False) -> None:
+        self.quiet = quiet
+        self.started = datetime.now()
+        self.timers: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        self._start = time.perf_counter()
+        self._end: Optional[float] = None       # set when the run is over (see collect)
+        self._lock = threading.Lock()
+
+    def stage(self, name: str) -> _Timer:
+        """Returns a context manager that times its block into stage `name`."""
+        return _Timer(self, name)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def progress(self, message: str) -> None:
+        """Prints a per-file line unless quiet."""
+        if not self.quiet:
+            print(message)
+
+    def finish(self) -> None:
+        """Stops the run's clock; `seconds` in as_dict then stays fixed."""
+        self._end = time.perf_counter()
+
+    def snapshot(self) -> Dict[str, int]:
+        """Returns a copy of the counters, safe to read while the run is going on."""
+        with self._lock:
+            return dict(self.counters)
+
+    def as_dict(self, **extra) -> dict:
+        """
+        Returns the run as a JSON-serialisable dict.
+
+        Parameters:
+        ----------
+        **extra
+            Added at the top level, e.g. instrument='revo'.
+        """
+        with self._lock:
+            ordered = sorted(self.timers, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES))
+            return {
+                **extra,
+                'started': self.started.isoformat(timespec='seconds'),
+                'seconds': round((self._end or time.perf_counter()) - self._start, 6),
+                'timers': {name: round(self.timers[name], 6) for name in ordered},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def summary(self) -> str:
+        """Returns the timers and counters as two [INFO] lines."""
+        data = self.as_dict()
+        timers = ", ".join(f"{name} {seconds:.3f} s" for name, seconds in data['timers'].items())
+        counters = ", ".join(f"{name} {value}" for name, value in data['counters'].items())
+        return (f"[INFO] Timings: {timers or 'none'} (total {data['seconds']:.3f} s)\n"
+                f"[INFO] Counts: {counters or 'none'}")
+
+    def write_json(self, path: str, **extra) -> None:
+        """Writes `as_dict(**extra)` to a JSON file."""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.as_dict(**extra), f, indent=2)
+            f.write("\n")
+
+
+_default = Metrics()
+_local = threading.local()
+
+
+def current() -> Metrics:
+    """Returns the Metrics of the run in progress on this thread."""
+    return getattr(_local, 'metrics', _default)
+
+
+@contextmanager
+def collect(quiet: bool = False) -> Iterator[Metrics]:
+    """Starts a new Metrics on this thread for the duration of the block and yields it."""
+    previous = current()
+    _local.metrics = Metrics(quiet)
+    try:
+        yield _local.metrics
+    finally:
+        _local.metrics.finish()
+        _local.metrics = previous
+
+
+def stage(name: str) -> _Timer:
+    """Times a block into stage `name` of the active run."""
+    return current().stage(name)
+
+
+def count(name: str, n: int = 1) -> None:
+    """Increments counter `name` of the active run."""
+    current().count(name, n)
+
+
+def progress(message: str) -> None:
+    """Prints a per-file line unless the active run is quiet."""
+    current().progress(message)
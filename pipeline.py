@@ -0,0 +1,401 @@
+"""
+Common in-process entry point for the Angiovue, Revo and Spectralis pipelines.
+
+    run(instrument, root, labels)
+
+runs one instrument folder in the current process. Pass the same LabelStore
+to every call and the label workbook and name sheet are read only once, so
+the GUI and the command line below can run several jobs without starting a
+new interpreter or parsing Excel again.
+
+Usage:
+    python pipeline.py revo spectralis angiovue [--dry-run] [--full] [--quiet] [--metrics FILE]
+    python pipeline.py --manifest sites.csv [--workers 4] [--report report.csv] [...]
+    python pipeline.py revo spectralis angiovue --check    (or --manifest sites.csv --check)
+
+--metrics writes one JSON record per instrument with its stage timings and
+counts (see metrics.py). --check only looks over the folders and workbooks
+(see preflight.py) and exits with 1 if a run would stop.
+
+A manifest lists instrument folders from any number of sites, one per row:
+
+    site,instrument,root,labels,names
+    Leeds,revo,/data/leeds/REVO,/data/leeds/2025_OCTA_HARMONISATION_LABELS.xlsx,
+    Leeds,spectralis,/data/leeds/Spectralis,/data/leeds/2025_OCTA_HARMONISATION_LABELS.xlsx,/data/leeds/2024_PartialData.xlsx
+    Perth,angiovue,/data/perth/AVANTI,/data/perth/2025_OCTA_HARMONISATION_LABELS.xlsx,
+
+Only instrument and root are required; labels and names default to the
+workbooks in the working directory, and relative paths are read from the
+manifest's folder. The folders are run concurrently on --workers threads
+(run_manifest). Folders sharing a workbook share one LabelStore, so each
+workbook is read once. The output of each folder is printed as one block
+when it finishes, followed by a table of all folders; --report also writes
+the table as CSV.
+
+Note:
+    - --resume and --rollback stay on angiovue.py and relabel.py, which work on
+      one folder's journal at a time.
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Optional, TextIO, Tuple
+
+import metrics
+import preflight
+import relabel
+from labels import LABELS_XLSX, NAMES_XLSX, LabelStore
+from renamer import Cancelled, Rename
+
+# Default folder of each instrument, relative to the working directory
+# angiovue.py is only imported for an Angiovue run, so Revo and Spectralis runs never load NumPy and PIL
+ROOTS = {
+    'angiovue': './AVANTI',     # angiovue.FOLDER_PATH
+    'revo': relabel.ROOTS['revo'],
+    'spectralis': relabel.ROOTS['spectralis'],
+}
+
+# Instrument folders run at once by run_manifest
+MANIFEST_WORKERS = 4
+
+# Counters shown in the consolidated report, in this order
+REPORT_COUNTERS = ('matched', 'unmatched', 'ambiguous', 'unparsed', 'skipped', 'converted', 'renamed', 'errors')
+
+
+class Site(NamedTuple):
+    """One row of a manifest."""
+    site: str
+    instrument: str
+    root: str
+    labels: str         # harmonisation workbook
+    names: str          # participant name sheet (Spectralis)
+
+
+class SiteResult(NamedTuple):
+    site: Site
+    status: str         # 'ok', 'failed' or 'cancelled'
+    metrics: metrics.Metrics
+    output: str         # everything the run printed
+
+
+def run(instrument: str, root: Optional[str] = None, labels: Optional[LabelStore] = None,
+        dry_run: bool = False, full: bool = False,
+        cancel: Optional[threading.Event] = None, paths: Optional[List[str]] = None) -> List[Rename]:
+    """
+    Runs the pipeline of one instrument.
+
+    Parameters:
+    ----------
+    instrument : str
+        'angiovue', 'revo' or 'spectralis' (case-insensitive).
+    root : str, optional
+        Instrument folder; defaults to ROOTS[instrument].
+    labels : LabelStore, optional
+        Label data shared between runs; a new store is created if omitted.
+    dry_run : bool
+        Print what would be done without changing any file.
+    full : bool
+        Check every file again, ignoring the history of earlier runs.
+    cancel : threading.Event, optional
+        Once set, the run stops before the next file with renamer.Cancelled.
+    paths : list of str, optional
+        Only handle these files of the folder (see watch.py); by default the
+        whole folder is processed.
+
+    Returns:
+    ----------
+    list of Rename
+        The renames applied (planned, for a dry run).
+
+    Raises:
+    ----------
+    ValueError
+        If the instrument is unknown.
+    RuntimeError, OSError
+        If the rename plan is refused or a rename fails (see renamer.py).
+    """
+    instrument = instrument.lower()
+    if instrument not in ROOTS:
+        raise ValueError(f"Unknown instrument: {instrument}")
+    root = root or ROOTS[instrument]
+    if labels is None:
+        labels = LabelStore()
+
+    if instrument == 'angiovue':
+        import angiovue
+        return angiovue.run(root, labels, dry_run, full, cancel, paths=paths)
+    return relabel.run(instrument, root, labels, dry_run, full, cancel, paths)
+
+
+def load_manifest(path: str) -> List[Site]:
+    """
+    Reads a manifest CSV (see the module docstring).
+
+    Raises:
+    ----------
+    ValueError
+        If a row has an unknown instrument or no root, or two rows share a root.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(value: str, default: str) -> str:
+        return os.path.normpath(os.path.join(base, value)) if value else default
+
+    sites = []
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+            instrument = row.get('instrument', '').lower()
+            if instrument not in ROOTS:
+                raise ValueError(f"{path}, line {line}: unknown instrument '{instrument}'")
+            if not row.get('root'):
+                raise ValueError(f"{path}, line {line}: no root given")
+            sites.append(Site(row.get('site', ''), instrument, resolve(row['root'], ''),
+                              resolve(row.get('labels', ''), LABELS_XLSX), resolve(row.get('names', ''), NAMES_XLSX)))
+
+    # Two runs in one folder would fight over its journal and history
+    roots = [os.path.realpath(site.root) for site in sites]
+    for root in roots:
+        if roots.count(root) > 1:
+            raise ValueError(f"{path}: {root} is listed more than once")
+    return sites
+
+
+class _ThreadOutput(io.TextIOBase):
+    """Stand-in for sys.stdout that sends each thread's writes to the stream set in `capture`."""
+
+    def __init__(self, fallback: TextIO) -> None:
+        self.fallback = fallback
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        return getattr(self.local, 'stream', self.fallback).write(text)
+
+    def flush(self) -> None:
+        getattr(self.local, 'stream', self.fallback).flush()
+
+    @contextmanager
+    def capture(self, stream: TextIO) -> Iterator[None]:
+        self.local.stream = stream
+        try:
+            yield
+        finally:
+            del self.local.stream
+
+
+def run_site(site: Site, labels: LabelStore, output: _ThreadOutput, dry_run: bool = False,
+             full: bool = False, quiet: bool = False,
+             cancel: Optional[threading.Event] = None) -> SiteResult:
+    """Runs one manifest row, capturing what it prints; never raises."""
+    buffer = io.StringIO()
+    status = 'ok'
+    with output.capture(buffer), metrics.collect(quiet=quiet) as run_metrics:
+        try:
+            run(site.instrument, site.root, labels, dry_run, full, cancel)
+        except Cancelled:
+            status = 'cancelled'
+        except (RuntimeError, OSError, ValueError) as e:
+            print(f"[ERROR] {e}")
+            status = 'failed'
+        except Exception:
+            # One site's bug must not stop the others
+            print(traceback.format_exc())
+            status = 'failed'
+        print(run_metrics.summary())
+    return SiteResult(site, status, run_metrics, buffer.getvalue())
+
+
+def run_manifest(sites: List[Site], workers: int = MANIFEST_WORKERS, dry_run: bool = False,
+                 full: bool = False, quiet: bool = False,
+                 cancel: Optional[threading.Event] = None) -> List[SiteResult]:
+    """
+    Runs the instrument folders of a manifest concurrently.
+
+    Parameters:
+    ----------
+    sites : list of Site
+        Folders to run (see load_manifest).
+    workers : int
+        Folders run at once.
+    dry_run, full, quiet : bool
+        As for run() and metrics.collect().
+    cancel : threading.Event, optional
+        Once set, running folders stop before their next file and the rest are not started.
+
+    Returns:
+    ----------
+    list of SiteResult
+        One per site, in manifest order. The output of each site is printed
+        as one block as soon as it finishes.
+
+    Note:
+        sys.stdout is replaced while the folders run, so that each thread's
+        output is captured separately.
+    """
+    # One store per workbook pair, all sharing their indexes: each labels workbook
+    # and each name sheet is read once, whatever it is paired with
+    stores: Dict[Tuple[str, str], LabelStore] = {}
+    for site in sites:
+        key = (os.path.abspath(site.labels), os.path.abspath(site.names))
+        if key not in stores:
+            stores[key] = LabelStore(site.labels, site.names, shared=next(iter(stores.values()), None))
+
+    output = _ThreadOutput(sys.stdout)
+    results: Dict[int, SiteResult] = {}
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {
+                pool.submit(run_site, site, stores[(os.path.abspath(site.labels), os.path.abspath(site.names))],
+                            output, dry_run, full, quiet, cancel): i
+                for i, site in enumerate(sites)
+            }
+            for future in as_completed(futures):
+                result = results[futures[future]] = future.result()
+                site = result.site
+                print(f"===== {site.site or '-'} / {site.instrument} ({site.root}): {result.status} =====")
+                print(result.output, end="")
+    finally:
+        sys.stdout = output.fallback
+    return [results[i] for i in range(len(sites))]
+
+
+def format_report(results: List[SiteResult]) -> str:
+    """Returns one table row per site with its status, time and counters, plus a total row."""
+    header = ['site', 'instrument', 'status', 'seconds', *REPORT_COUNTERS]
+    rows = [header]
+    totals = dict.fromkeys(REPORT_COUNTERS, 0)
+    for result in results:
+        data = result.metrics.as_dict()
+        counters = data['counters']
+        for name in REPORT_COUNTERS:
+            totals[name] += counters.get(name, 0)
+        rows.append([result.site.site or '-', result.site.instrument, result.status, f"{data['seconds']:.2f}",
+                     *(str(counters.get(name, 0)) for name in REPORT_COUNTERS)])
+    failed = sum(1 for result in results if result.status != 'ok')
+    rows.append(['total', str(len(results)), f"{failed} not ok", '', *(str(totals[name]) for name in REPORT_COUNTERS)])
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def write_report(results: List[SiteResult], path: str) -> None:
+    """Writes one CSV row per site: site, instrument, root, status, seconds, stage times and all counters."""
+    records = [result.metrics.as_dict() for result in results]
+    stages = sorted({stage for record in records for stage in record['timers']},
+                    key=lambda s: metrics.STAGES.index(s) if s in metrics.STAGES else len(metrics.STAGES))
+    counters = sorted({name for record in records for name in record['counters']})
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['site', 'instrument', 'root', 'status', 'seconds',
+                         *(stage + '_seconds' for stage in stages), *counters])
+        for result, record in zip(results, records):
+            writer.writerow([result.site.site, result.site.instrument, result.site.root, result.status,
+                             record['seconds'], *(record['timers'].get(stage, 0) for stage in stages),
+                             *(record['counters'].get(name, 0) for name in counters)])
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="pipeline.py", description="Run several instruments in one process.")
+    parser.add_argument("instruments", nargs="*", metavar="instrument",
+                        help="instruments to run, in order: " + ", ".join(sorted(ROOTS)))
+    parser.add_argument("--manifest", metavar="CSV", help="run the instrument folders listed in CSV concurrently")
+    parser.add_argument("--workers", type=int, default=MANIFEST_WORKERS, help="folders run at once with --manifest")
+    parser.add_argument("--report", metavar="FILE", help="write the consolidated table of a --manifest run to FILE as CSV")
+    parser.add_argument("--dry-run", action="store_true", help="print what would be done without changing any file")
+    parser.add_argument("--full", action="store_true", help="check every file again, ignoring the history of earlier runs")
+    parser.add_argument("--quiet", action="store_true", help="only print warnings, errors and summaries, not one line per file")
+    parser.add_argument("--metrics", metavar="FILE", help="write the stage timings and counts to FILE as JSON")
+    parser.add_argument("--check", action="store_true", help="check the folders and workbooks without reading or changing any file")
+    parser.add_argument("--version", action="version", version="%(prog)s " + preflight.__version__)
+    args = parser.parse_args(argv)
+    if bool(args.instruments) == bool(args.manifest):
+        parser.error("give either instruments or --manifest")
+    for instrument in args.instruments:
+        if instrument not in ROOTS:
+            parser.error(f"unknown instrument '{instrument}' (choose from {', '.join(sorted(ROOTS))})")
+    if args.check:
+        main_check(args)
+        return
+    if args.manifest:
+        main_manifest(args)
+        return
+
+    labels = LabelStore()
+    failed = []
+    records = []
+    for instrument in args.instruments:
+        print(f"[INFO] Running {instrument}")
+        with metrics.collect(quiet=args.quiet) as run_metrics:
+            try:
+                run(instrument, labels=labels, dry_run=args.dry_run, full=args.full)
+            except (RuntimeError, OSError) as e:
+                print(f"[ERROR] {e}")
+                failed.append(instrument)
+        print(run_metrics.summary())
+        records.append(run_metrics.as_dict(instrument=instrument, root=ROOTS[instrument], dry_run=args.dry_run,
+                                           failed=instrument in failed))
+
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            json.dump({'runs': records}, f, indent=2)
+            f.write("\n")
+
+    if failed:
+        print(f"[ERROR] Failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+def main_check(args: argparse.Namespace) -> None:
+    if args.manifest:
+        try:
+            sites = load_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] {e}")
+            sys.exit(1)
+    else:
+        sites = [Site('', instrument, ROOTS[instrument], LABELS_XLSX, NAMES_XLSX) for instrument in args.instruments]
+
+    passed = True
+    for site in sites:
+        print(f"[INFO] Checking {site.instrument} in {site.root}" + (f" ({site.site})" if site.site else ""))
+        passed = preflight.report(preflight.check_folder(site.instrument, site.root, site.labels, site.names)) and passed
+    if not passed:
+        sys.exit(1)
+
+
+def main_manifest(args: argparse.Namespace) -> None:
+    try:
+        sites = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+
+    print(f"[INFO] Running {len(sites)} folders from {args.manifest} on {max(1, min(args.workers, len(sites)))} threads")
+    results = run_manifest(sites, args.workers, args.dry_run, args.full, args.quiet)
+    print()
+    print(format_report(results))
+
+    if args.report:
+        write_report(results, args.report)
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            json.dump({'runs': [result.metrics.as_dict(site=result.site.site, instrument=result.site.instrument,
+                                                       root=result.site.root, dry_run=args.dry_run,
+                                                       failed=result.status != 'ok')
+                                for result in results]}, f, indent=2)
+            f.write("\n")
+    if any(result.status != 'ok' for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
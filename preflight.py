@@ -0,0 +1,189 @@
+"""
+Quick check of an instrument folder and its workbooks before a run.
+
+    python relabel.py revo --check
+    python angiovue.py --check
+    python pipeline.py revo spectralis angiovue --check
+
+Only names, sizes and stats are looked at: no workbook is parsed, no image is
+read and no file is written, so a check takes milliseconds even on folders
+with thousands of exports. It reports what a run would stop on (a missing
+folder or workbook, a folder that cannot be written, an unfinished rename
+journal) as errors, and files that a run would leave alone as warnings.
+
+Note:
+    - Matching against the workbook is not checked here; a --dry-run does that.
+"""
+
+import os
+import re
+from typing import List, NamedTuple, Optional
+
+from history import history_path
+from labels import LABELS_XLSX, NAMES_XLSX, cache_is_fresh
+from rawgeometry import find_geometries
+from renamer import journal_path
+from tags import INSTRUMENTS, find_layer, parse_tag_name, revo_size
+
+# Reported by --version on every command line
+__version__ = '1.1.0'
+
+# Participant folders of a REVO export, e.g. 'OCTA004' (see scanner.py)
+_STUDY_FOLDER = re.compile(r'^[A-Za-z]{4}\d+$')
+
+# Files named in one warning before the rest are only counted
+EXAMPLES = 3
+
+
+class Finding(NamedTuple):
+    level: str      # 'ERROR', 'WARNING' or 'INFO'
+    message: str
+
+    def __str__(self) -> str:
+        return f"[{self.level}] {self.message}"
+
+
+def _visible(folder: str) -> List[os.DirEntry]:
+    with os.scandir(folder) as entries:
+        return sorted((e for e in entries if not e.name.startswith(".")), key=lambda e: e.name)
+
+
+def _files_warning(findings: List[Finding], paths: List[str], problem: str) -> None:
+    """Adds one warning for all `paths`, naming the first few."""
+    if not paths:
+        return
+    examples = ", ".join(os.path.basename(p) for p in paths[:EXAMPLES])
+    more = f" and {len(paths) - EXAMPLES} more" if len(paths) > EXAMPLES else ""
+    findings.append(Finding('WARNING', f"{len(paths)} {problem}: {examples}{more}"))
+
+
+def _check_revo(root: str, findings: List[Finding]) -> None:
+    exports, relabelled, misplaced, unknown, layers = 0, 0, [], [], []
+    studies = 0
+    for study in _visible(root):
+        if not study.is_dir():
+            misplaced.append(study.path)
+            continue
+        if not _STUDY_FOLDER.match(study.name):
+            findings.append(Finding('WARNING', f"{study.path} is not named like a participant folder (e.g. OCTA004)"))
+        studies += 1
+        for size in _visible(study.path):
+            if not size.is_dir():
+                misplaced.append(size.path)
+            elif revo_size(size.name) is None:
+                unknown.append(size.path)
+            else:
+                for entry in _visible(size.path):
+                    if not entry.is_file() or "." not in entry.name:
+                        continue
+                    if " " not in entry.name:
+                        relabelled += 1
+                        continue
+                    exports += 1
+                    # Export names are '<GIVEN SURNAME>_<layer>_...'
+                    if "_" not in entry.name or find_layer(entry.name.split("_")[1]) is None:
+                        layers.append(entry.path)
+    _files_warning(findings, misplaced, "files outside a size folder will be ignored")
+    _files_warning(findings, unknown, "size folders are not in tags.REVO_SIZES; their files will not be renamed")
+    _files_warning(findings, layers, "exports have no known layer and will not be renamed")
+    findings.append(Finding('INFO', f"{root}: {studies} participant folders, {exports} exports to relabel, "
+                                    f"{relabelled} files already renamed"))
+
+
+def _check_spectralis(root: str, findings: List[Finding]) -> None:
+    exports, relabelled, folders, unknown = 0, 0, [], []
+    for entry in _visible(root):
+        if entry.is_dir():
+            folders.append(entry.path)
+        elif " " in entry.name:
+            exports += 1
+            words = entry.name.split(" ")
+            if len(words) < 3 or find_layer(words[-3]) is None:
+                unknown.append(entry.path)
+        elif "." in entry.name:
+            relabelled += 1
+    _files_warning(findings, folders, "subfolders will be ignored")
+    _files_warning(findings, unknown, "exports have no known layer and will not be renamed")
+    findings.append(Finding('INFO', f"{root}: {exports} exports to relabel, {relabelled} files already renamed"))
+
+
+def _check_angiovue(root: str, findings: List[Finding]) -> None:
+    raws, pngs, unnamed, unknown, ambiguous = 0, 0, [], [], []
+    for entry in _visible(root):
+        name = entry.name.lower()
+        if name.endswith('.png'):
+            pngs += 1
+        elif name.endswith('.raw'):
+            raws += 1
+            tag = parse_tag_name(os.path.splitext(entry.name)[0])
+            if tag is None or tag.instrument != INSTRUMENTS['A']:
+                unnamed.append(entry.path)
+            geometries = find_geometries(entry.stat().st_size)
+            if not geometries:
+                unknown.append(entry.path)
+            elif len(geometries) > 1:
+                ambiguous.append(entry.path)
+    _files_warning(findings, unnamed, ".raw names do not follow <Study ID>_A<layer><size> and will not be renamed")
+    _files_warning(findings, unknown, ".raw files have a length that is not in rawgeometry.RAW_GEOMETRIES")
+    _files_warning(findings, ambiguous, ".raw files have a length that matches more than one geometry")
+    findings.append(Finding('INFO', f"{root}: {raws} .raw files to convert, {pngs} .png files"))
+
+
+_CHECKS = {'revo': _check_revo, 'spectralis': _check_spectralis, 'angiovue': _check_angiovue}
+
+
+def check_folder(instrument: str, root: str, labels_xlsx: str = LABELS_XLSX,
+                 names_xlsx: Optional[str] = NAMES_XLSX) -> List[Finding]:
+    """
+    Checks one instrument folder and the workbooks its run reads.
+
+    Parameters:
+    ----------
+    instrument : str
+        'angiovue', 'revo' or 'spectralis'.
+    root : str
+        Instrument folder.
+    labels_xlsx : str
+        Harmonisation workbook.
+    names_xlsx : str, optional
+        Participant name sheet; only checked for Spectralis.
+
+    Returns:
+    ----------
+    list of Finding
+        Errors, warnings and one summary line; no errors means the run can start.
+    """
+    findings: List[Finding] = []
+
+    workbooks = [labels_xlsx] + ([names_xlsx] if instrument == 'spectralis' else [])
+    for workbook in workbooks:
+        if not os.path.isfile(workbook):
+            findings.append(Finding('ERROR', f"Workbook not found: {workbook}"))
+        elif not cache_is_fresh(workbook):
+            findings.append(Finding('INFO', f"{workbook} has changed since it was last read; the run will parse it"))
+
+    if not os.path.isdir(root):
+        findings.append(Finding('ERROR', f"Folder not found: {root}"))
+        return findings
+    if not os.access(root, os.W_OK | os.X_OK):
+        findings.append(Finding('ERROR', f"Folder is not writable: {root}"))
+    if os.path.exists(journal_path(root)):
+        findings.append(Finding('ERROR', f"An unfinished rename journal exists in {root}; "
+                                         "run with --resume or --rollback first"))
+    if not os.path.exists(history_path(root)):
+        findings.append(Finding('INFO', f"{root} has no history yet; every file will be checked"))
+
+    try:
+        _CHECKS[instrument](root, findings)
+    except OSError as e:
+        findings.append(Finding('ERROR', f"Unable to list {root}: {e}"))
+    return findings
+
+
+def report(findings: List[Finding]) -> bool:
+    """Prints findings, errors last; returns True if there are no errors."""
+    order = {'INFO': 0, 'WARNING': 1, 'ERROR': 2}
+    for finding in sorted(findings, key=lambda f: order[f.level]):
+        print(finding)
+    return not any(finding.level == 'ERROR' for finding in findings)
+
@@ -0,0 +1,51 @@
+"""
+Known pixel layouts of headerless Angiovue .raw exports, shared by angiovue.py and preflight.py.
+
+An export carries no header, so its geometry is identified from the file
+length alone. This module only needs the standard library, so a folder can be
+checked (python angiovue.py --check) without loading NumPy or PIL.
+"""
+
+from typing import Dict, List, NamedTuple
+
+# .raw pixel format as a NumPy type string: 32-bit float, little-endian
+RAW_DTYPE = '<f4'
+
+
+class RawGeometry(NamedTuple):
+    """Pixel layout of a headerless .raw export."""
+    width: int
+    height: int
+    dtype: str = RAW_DTYPE      # NumPy type string, '<byte order><kind><bytes per pixel>'
+
+    @property
+    def itemsize(self) -> int:
+        return int(self.dtype[2:])
+
+    @property
+    def nbytes(self) -> int:
+        return self.width * self.height * self.itemsize
+
+
+# Known Angiovue .raw geometries, one per scan protocol in the harmonisation workbook.
+# A wrong entry silently mis-decodes every file of that length, so only add a
+# geometry (e.g. for 8x8 or 12x12 mm scans) once it is checked against a real export.
+RAW_GEOMETRIES = [
+    RawGeometry(304, 304, RAW_DTYPE),   # 3x3 mm, '304x304' rows; 369 664 bytes
+    RawGeometry(400, 400, RAW_DTYPE),   # 6x6 mm, '400x400' rows; 640 000 bytes
+]
+
+# Geometries indexed by byte length, so each file is identified with one lookup
+_GEOMETRIES_BY_SIZE: Dict[int, List[RawGeometry]] = {}
+for _geometry in RAW_GEOMETRIES:
+    _GEOMETRIES_BY_SIZE.setdefault(_geometry.nbytes, []).append(_geometry)
+
+
+def find_geometries(nbytes: int) -> List[RawGeometry]:
+    """
+    Returns the registered geometries whose size is exactly `nbytes`.
+
+    More than one result means the size is ambiguous and the file cannot be
+    converted safely; no result means the size is unknown.
+    """
+    return _GEOMETRIES_BY_SIZE.get(nbytes, [])
@@ -0,0 +1,355 @@
+"""
+Reconciliation of the instrument folders against the harmonisation workbook.
+
+Every file in the REVO, Spectralis and AVANTI folders is parsed into its label
+key (participant, instrument, layer, image size) the same way relabel.py and
+angiovue.py parse it. The resulting file table is then joined with the whole
+label table, and every file and row gets one status:
+
+    matched     one file for one row
+    missing     a row with no file
+    extra       a file with no row, or a file whose name cannot be parsed
+    ambiguous   a key on more than one row, more than one file for one row,
+                or a Spectralis patient listed with more than one Study ID
+
+Files already renamed to their Image ID are matched on the Image ID. Nothing is
+renamed, converted or deleted, so the workbook can be fixed before a batch runs.
+
+Usage:
+    python reconcile.py [revo spectralis angiovue] [--csv FILE] [--html FILE]
+
+Prerequisites:
+    - pandas installed.
+
+Note:
+    - Angiovue scans are reconciled once per base name, whether they are still
+      .raw files or already converted. Angiovue's own .png exports are ignored.
+"""
+
+import argparse
+import html
+import os
+import sys
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+import metrics
+import pipeline
+import relabel
+from labels import (COL_IMAGE_ID, COL_INSTRUMENT, COL_LAYER, COL_PARTICIPANT_ID, COL_SCANS, COL_SIZE,
+                    KEY_COLUMNS, LABELS_XLSX, NAMES_XLSX, NameIndex, load_name_index, make_key,
+                    normalise_name, read_label_table)
+from scanner import scan_revo
+from tags import find_layer, parse_tag_name, revo_size
+
+# Name of each instrument in the workbook's Instrument column
+INSTRUMENTS = {'angiovue': 'Angiovue', 'revo': 'Revo', 'spectralis': 'Spectralis'}
+
+# Report order of the statuses
+STATUSES = ('ambiguous', 'extra', 'missing', 'matched')
+
+COL_STATUS = 'Status'
+COL_FILE   = 'File'
+COL_REASON = 'Reason'
+
+REPORT_COLUMNS = [COL_STATUS] + KEY_COLUMNS + [COL_IMAGE_ID, COL_FILE, COL_REASON]
+
+# Name stem of a file, matched against the Image IDs when the name cannot be parsed
+_STEM = '_stem'
+
+
+# -----------------------
+# File records
+# -----------------------
+
+def _record(instrument: str, path: str, key: Optional[tuple] = None, reason: str = '',
+            status: Optional[str] = None) -> dict:
+    """
+    Returns one row of the file table.
+
+    key is (Study ID, layer, size [mm], size [scans]); without it the file is
+    matched on its name stem, and `reason` says why it could not be parsed.
+    """
+    study_id = layer = size_mm = size_scans = None
+    if key is not None:
+        study_id, _, layer, size_mm, size_scans = make_key(key[0], instrument, *key[1:])
+    return {
+        COL_STATUS: status, COL_PARTICIPANT_ID: study_id, COL_INSTRUMENT: instrument, COL_LAYER: layer,
+        COL_SIZE: size_mm, COL_SCANS: size_scans, COL_FILE: path, COL_REASON: reason,
+        _STEM: os.path.splitext(os.path.basename(path))[0],
+    }
+
+
+def revo_records(root: str) -> List[dict]:
+    """Parses every file under REVO/OCTAxxx/<mm>_<scans>/ as relabel.revo does."""
+    records = []
+    for record in scan_revo(root):
+        key, reason = None, ''
+        if record.layer is not None:
+            layer = find_layer(record.layer)
+            size = revo_size(record.size_folder)
+            if layer is None:
+                reason = f"unknown layer '{record.layer}'"
+            elif size is None:
+                reason = f"unknown size folder '{record.size_folder}'"
+            else:
+                key = (record.study_id, layer, size[0] + "x" + size[0], record.size_scans)
+        else:
+            tag = parse_tag_name(record.filename)
+            if tag is not None:
+                key = (tag.study_id, tag.layer, tag.size_mm, record.size_scans)
+            else:
+                reason = "not an export, tag or Image ID name"
+        records.append(_record('Revo', record.path, key, reason))
+    return records
+
+
+def spectralis_records(root: str, names: NameIndex) -> List[dict]:
+    """Parses every file in the Spectralis folder as relabel.spectralis does."""
+    size_mm = relabel.SPECTRALIS_SIZE + "x" + relabel.SPECTRALIS_SIZE
+    records = []
+    with os.scandir(root) as entries:
+        files = sorted(e.path for e in entries if not e.name.startswith(".") and "." in e.name and e.is_file())
+
+    for path in files:
+        filename = os.path.basename(path)
+        if " " not in filename:
+            tag = parse_tag_name(filename)
+            if tag is not None:
+                key = (tag.study_id, tag.layer, tag.size_mm, relabel.SPECTRALIS_SCANS)
+                records.append(_record('Spectralis', path, key))
+            else:
+                records.append(_record('Spectralis', path, reason="not an export, tag or Image ID name"))
+            continue
+
+        words = filename.split(" ")
+        layer = find_layer(words[-3]) if len(words) >= 3 else None
+        eye = next((i for i, word in enumerate(words) if word in ("OD", "OS")), 2)
+        patient = " ".join(words[:eye])
+        study_id = names.lookup(patient)
+        if layer is None:
+            records.append(_record('Spectralis', path, reason="unknown layer"))
+        elif study_id is not None:
+            records.append(_record('Spectralis', path, (study_id, layer, size_mm, relabel.SPECTRALIS_SCANS)))
+        elif names.is_ambiguous(patient):
+            records.append(_record('Spectralis', path, reason=f"'{patient}' is listed for Study IDs "
+                                                               f"{', '.join(names.ambiguous[normalise_name(patient)])}",
+                                   status='ambiguous'))
+        else:
+            records.append(_record('Spectralis', path, reason=f"'{patient}' is not in the name list"))
+    return records
+
+
+def angiovue_records(root: str) -> List[dict]:
+    """Parses every .raw file and converted image in the AVANTI folder, one record per scan."""
+    # Imported here: sizes come from the .raw geometries and image headers (NumPy and PIL)
+    import angiovue
+
+    extensions = {'raw'} | {ext for fmt, ext in angiovue.OUTPUT_EXTENSIONS.items() if fmt != 'npz'}
+    scans: Dict[str, List[str]] = {}
+    with os.scandir(root) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            extension = entry.name.rsplit(".", 1)[-1].lower()
+            if entry.name.startswith(".") or extension not in extensions or not entry.is_file():
+                continue
+            if extension == 'png' and not angiovue.is_converted_png(entry.path):
+                continue
+            scans.setdefault(os.path.splitext(entry.name)[0], []).append(entry.path)
+
+    records = []
+    for base_name, paths in scans.items():
+        path = ", ".join(paths)
+        tag = parse_tag_name(base_name)
+        if tag is None or tag.instrument != angiovue.INSTRUMENT:
+            record = _record(angiovue.INSTRUMENT, path, reason="not a tag or Image ID name")
+        else:
+            size_scans = angiovue.scan_size(paths[0])
+            if size_scans:
+                record = _record(angiovue.INSTRUMENT, path, (tag.study_id, tag.layer, tag.size_mm, size_scans))
+            else:
+                record = _record(angiovue.INSTRUMENT, path, reason="unknown or ambiguous .raw length")
+        record[_STEM] = base_name
+        records.append(record)
+    return records
+
+
+# -----------------------
+# Reconciliation
+# -----------------------
+
+def reconcile(files: pd.DataFrame, labels: pd.DataFrame, instruments: List[str]) -> pd.DataFrame:
+    """
+    Joins the file table with the label table.
+
+    Parameters:
+    ----------
+    files : pd.DataFrame
+        File records (see revo_records, spectralis_records and angiovue_records).
+    labels : pd.DataFrame
+        Label table as returned by labels.read_label_table.
+    instruments : list of str
+        Workbook instrument names whose rows are reconciled, e.g. ['Revo'].
+
+    Returns:
+    ----------
+    pd.DataFrame
+        One entry per file and per missing or ambiguous row, with columns
+        REPORT_COLUMNS, sorted by status.
+    """
+    labels = labels[labels[COL_INSTRUMENT].isin(instruments)]
+    files = files.reindex(columns=REPORT_COLUMNS + [_STEM])
+
+    # Rows per key; a key on more than one row is ambiguous and never renamed
+    rows = labels.groupby(KEY_COLUMNS, as_index=False).agg(
+        **{COL_IMAGE_ID: (COL_IMAGE_ID, ", ".join), '_rows': (COL_IMAGE_ID, 'size')})
+    duplicated = rows[rows['_rows'] > 1]
+
+    # Parsed files are joined on their key
+    parsed = files[files[COL_PARTICIPANT_ID].notna() & files[COL_STATUS].isna()]
+    parsed = parsed.drop(columns=COL_IMAGE_ID).merge(rows, on=KEY_COLUMNS, how='left')
+    per_key = parsed.groupby(KEY_COLUMNS)[COL_FILE].transform('size')
+    no_row = parsed['_rows'].isna()
+    many_rows = parsed['_rows'] > 1
+    many_files = (per_key > 1) & ~no_row
+    parsed[COL_STATUS] = 'matched'
+    parsed.loc[no_row, [COL_STATUS, COL_REASON]] = ['extra', "no row in the workbook"]
+    parsed.loc[many_files, COL_STATUS] = 'ambiguous'
+    parsed.loc[many_files, COL_REASON] = per_key[many_files].astype(str) + " files for one row"
+    parsed.loc[many_rows, COL_STATUS] = 'ambiguous'
+    parsed.loc[many_rows, COL_REASON] = "key is on " + parsed.loc[many_rows, '_rows'].astype(int).astype(str) + " rows"
+
+    # Files that could not be parsed are joined on their name, in case it is already an Image ID
+    unparsed = files[files[COL_PARTICIPANT_ID].isna() & files[COL_STATUS].isna()]
+    by_image_id = labels.drop_duplicates([COL_INSTRUMENT, COL_IMAGE_ID]).rename(columns={COL_IMAGE_ID: _STEM})
+    renamed = unparsed[[COL_FILE, COL_REASON, _STEM, COL_INSTRUMENT]].merge(
+        by_image_id, on=[_STEM, COL_INSTRUMENT], how='left', indicator=True)
+    found = renamed['_merge'] == 'both'
+    renamed[COL_IMAGE_ID] = renamed[_STEM].where(found)
+    renamed[COL_STATUS] = 'extra'
+    renamed.loc[found, [COL_STATUS, COL_REASON]] = ['matched', "already renamed"]
+
+    # Rows no file was found for, and every row on an ambiguous key
+    found_keys = parsed.loc[~no_row, KEY_COLUMNS].drop_duplicates()
+    unfound = labels.merge(found_keys, on=KEY_COLUMNS, how='left', indicator=True)
+    unfound = unfound[(unfound['_merge'] == 'left_only')
+                      & ~unfound[COL_IMAGE_ID].isin(renamed.loc[found, COL_IMAGE_ID])]
+    unfound = unfound.merge(duplicated[KEY_COLUMNS], on=KEY_COLUMNS, how='left', indicator='_duplicated')
+    missing = unfound[unfound['_duplicated'] == 'left_only'].assign(**{COL_STATUS: 'missing', COL_REASON: "no file"})
+    ambiguous = labels.merge(duplicated[KEY_COLUMNS + ['_rows']], on=KEY_COLUMNS)
+    ambiguous = ambiguous.assign(**{COL_STATUS: 'ambiguous',
+                                    COL_REASON: "key is on " + ambiguous['_rows'].astype(str) + " rows"})
+
+    named = files[files[COL_STATUS].notna()]
+    report = pd.concat([table.reindex(columns=REPORT_COLUMNS) for table in (parsed, renamed, named, missing, ambiguous)],
+                       ignore_index=True)
+    report[COL_STATUS] = pd.Categorical(report[COL_STATUS], categories=STATUSES, ordered=True)
+    return report.sort_values([COL_STATUS, COL_INSTRUMENT, COL_PARTICIPANT_ID, COL_LAYER, COL_SIZE, COL_FILE],
+                              na_position='last', kind='stable').reset_index(drop=True)
+
+
+def summarise(report: pd.DataFrame) -> pd.DataFrame:
+    """Returns the number of entries per instrument and status."""
+    counts = pd.crosstab(report[COL_INSTRUMENT], report[COL_STATUS]).reindex(columns=list(STATUSES), fill_value=0)
+    counts.columns.name = None
+    return counts
+
+
+def write_html(report: pd.DataFrame, path: str, title: str = "Reconciliation report") -> None:
+    """Writes the summary and one table per status to an HTML file."""
+    sections = [f"<h1>{html.escape(title)}</h1>", summarise(report).to_html()]
+    for status in STATUSES:
+        entries = report[report[COL_STATUS] == status]
+        if len(entries):
+            sections.append(f"<h2>{status.capitalize()} ({len(entries)})</h2>")
+            sections.append(entries.drop(columns=COL_STATUS).to_html(index=False, na_rep=""))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+                f"<title>{html.escape(title)}</title>"
+                "<style>body{font-family:sans-serif} table{border-collapse:collapse} "
+                "td,th{border:1px solid #ccc;padding:2px 6px;text-align:left}</style></head><body>\n")
+        f.write("\n".join(sections))
+        f.write("\n</body></html>\n")
+
+
+def run(instruments: List[str], roots: Optional[Dict[str, str]] = None, labels_xlsx: str = LABELS_XLSX,
+        names_xlsx: str = NAMES_XLSX) -> pd.DataFrame:
+    """
+    Scans the instrument folders and reconciles them with the workbook.
+
+    Parameters:
+    ----------
+    instruments : list of str
+        'angiovue', 'revo' and/or 'spectralis'.
+    roots : dict, optional
+        Instrument -> folder; defaults to pipeline.ROOTS.
+    labels_xlsx : str
+        Harmonisation workbook.
+    names_xlsx : str
+        Participant name sheet, read for Spectralis.
+
+    Returns:
+    ----------
+    pd.DataFrame
+        The report (see reconcile).
+    """
+    roots = {**pipeline.ROOTS, **(roots or {})}
+    with metrics.stage('load'):
+        labels = read_label_table(labels_xlsx, use_cache=True)
+        names = load_name_index(names_xlsx) if 'spectralis' in instruments else None
+
+    records = []
+    with metrics.stage('parse'):
+        for instrument in instruments:
+            if instrument == 'revo':
+                records += revo_records(roots['revo'])
+            elif instrument == 'spectralis':
+                records += spectralis_records(roots['spectralis'], names)
+            elif instrument == 'angiovue':
+                records += angiovue_records(roots['angiovue'])
+            else:
+                raise ValueError(f"Unknown instrument: {instrument}")
+
+    with metrics.stage('match'):
+        report = reconcile(pd.DataFrame(records, columns=REPORT_COLUMNS + [_STEM]), labels,
+                           [INSTRUMENTS[i] for i in instruments])
+    for status, n in report[COL_STATUS].value_counts(sort=False).items():
+        metrics.count(status, int(n))
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="reconcile.py",
+                                     description="Reconcile the instrument folders with the harmonisation workbook.")
+    parser.add_argument("instruments", nargs="*", metavar="instrument",
+                        help="instruments to reconcile (default: all): " + ", ".join(sorted(INSTRUMENTS)))
+    parser.add_argument("--labels", default=LABELS_XLSX, metavar="XLSX", help="harmonisation workbook")
+    parser.add_argument("--names", default=NAMES_XLSX, metavar="XLSX", help="participant name sheet")
+    parser.add_argument("--csv", metavar="FILE", help="write every entry to FILE as CSV")
+    parser.add_argument("--html", metavar="FILE", help="write the summary and every entry to FILE as HTML")
+    args = parser.parse_args(argv)
+
+    instruments = args.instruments or sorted(INSTRUMENTS)
+    for instrument in instruments:
+        if instrument not in INSTRUMENTS:
+            parser.error(f"unknown instrument '{instrument}' (choose from {', '.join(sorted(INSTRUMENTS))})")
+
+    with metrics.collect() as run_metrics:
+        try:
+            report = run(instruments, labels_xlsx=args.labels, names_xlsx=args.names)
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] {e}")
+            sys.exit(1)
+
+    print(summarise(report).to_string())
+    if args.csv:
+        report.to_csv(args.csv, index=False)
+        print(f"[INFO] Report written to {args.csv}")
+    if args.html:
+        write_html(report, args.html)
+        print(f"[INFO] Report written to {args.html}")
+    print(run_metrics.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,260 +2,252 @@
 import os
 import sys
 import glob
-import pandas as pd
+import argparse
 from pathlib import Path
+import metrics
+import preflight
+from history import ProcessedLog
+from labels import LabelStore
+from renamer import RenamePlan, execute, journal_path, resume, rollback
+from scanner import revo_record, scan_revo
+from tags import FileTag, find_layer, parse_tag_name, revo_size
 
-def decomposeFileName(studyID, inst, layer, mm, scans, filename):
-    
-    tag = ""
-    
-    studyID = filename.split("_")[0]
-    tag = filename.split("_")[1]
-    tag = tag.split(".")[0]
-    if tag[0] == "S":
-        inst = "Spectralis"
-        mm = tag[-1]
-        mm += "x"
-        mm += tag[-1]
-        scans = "512x512"
-    elif tag[0] == "R":
-        inst = "Revo"
-        
-    if not "H" in tag:
-        if tag[1:-1] == "R":
-            layer = "Retina"
-        elif tag[1:-1] == "S":
-            layer = "Superficial"
-        elif tag[1:-1] == "SVC":
-            layer = "SVC"
-        elif tag[1:-1] == "SVP":
-            layer = "SVP"
-        elif tag[1:-1] == "DVC":
-            layer = "DVC"
-        elif tag[1:-1] == "DCP":
-            layer = "DCP"
-        elif tag[1:-1] == "D":
-            layer = "Deep"
-    else:
-        if tag[1:-2] == "R":
-            layer = "Retina"
-        elif tag[1:-2] == "S":
-            layer = "Superficial"
-        elif tag[1:-2] == "SVC":
-            layer = "SVC"
-        elif tag[1:-2] == "SVP":
-            layer = "SVP"
-        elif tag[1:-2] == "DVC":
-            layer = "DVC"
-        elif tag[1:-2] == "DCP":
-            layer = "DCP"
-        elif tag[1:-2] == "D":
-            layer = "Deep"
-        
-    return studyID, inst, layer, mm, scans
+# Instrument folders, relative to the working directory
+ROOTS = {"revo": "./REVO", "spectralis": "./Spectralis"}
 
-def ExtractFileInfo(instrument, size, tag):
-    
-    fileInfo = ""
-    
-    if instrument == "revo":
-        fileInfo += "R"
-    elif instrument == "spectralis":
-        fileInfo += "S"
-    
-    if "Retina" in tag:
-        fileInfo += "R"
-    elif "Superficial" in tag:
-        fileInfo += "S"
-    elif "SVC" in tag:
-        fileInfo += "SVC"
-    elif "SVP" in tag:
-        fileInfo += "SVP"
-    elif "DVC" in tag:
-        fileInfo += "DVC"
-    elif "DCP" in tag:
-        fileInfo += "DCP"
-    elif "Deep" in tag:
-        fileInfo += "D"
-        
-    if size == 3.3 or size == 3.5 or size == 3.6:
-        fileInfo += "3"
-    elif size == 3.4:
-        fileInfo += "3H"
-    elif size == 6.4:
-        fileInfo += "6"
-    elif size == 10.6:
-        fileInfo += "10"
-    
-    return fileInfo
+# Spectralis exports are always 3x3 mm at 512x512 scans
+SPECTRALIS_SIZE = "3"
+SPECTRALIS_SCANS = "512x512"
 
-def revo(imageID_list):
+# Plan the renames of the files exported by Revo
+# Files already relabelled by an earlier run (see history.py) are skipped
+# records limits the plan to those files (scanner.RevoFile); by default the whole folder is scanned
+def revo(labelIndex, history=None, root=ROOTS["revo"], records=None):
     print("revo")
-    filename = ""
-    fileInfo = ""
-    fileExtension = ""
-    studyID = ""
-    instrument = "Revo"
-    retinalLayer = ""
-    imageSizeMM = ""
-    imageSizeScans = ""
+    plan = RenamePlan(root)
     
-    for dirpath, dirs, files in os.walk("./REVO", topdown=False):
-        if files and not dirs:
-            for filename in files:
-                if filename and not filename.startswith(".") and "." in filename and " " in filename:            
-                    fileExtension = filename.split(".")[-1]
-                    size = dirpath.split("/")[-1]
-                    size = int(float(size.replace("_", ".")) * 10) / 10
-                    fileInfo = ExtractFileInfo("revo", size, filename.split("_")[1])
-                    #print(filename + dirpath)
-                    target = os.path.join(dirpath, filename)
-                    studyID = dirpath.split("/")[-2]
-                    studyID = studyID[:4] + "-" + studyID[4:]
-                    newFilename = studyID + "_" + fileInfo + "." + fileExtension
-                    newName = os.path.join(dirpath, newFilename)
-                    os.rename(target, newName)
-                    print(filename + " has been changed to " + newFilename)
+    # Scan ./REVO once; the intermediate and final names are both planned from these records
+    if records is None:
+        with metrics.stage("walk"):
+            records = scan_revo(root)
+    for record in records:
+        if history is not None and history.is_processed(record.path):
+            metrics.count("skipped")
+            continue
+        filename = record.filename
+        dirpath = os.path.dirname(record.path)
+        with metrics.stage("parse"):
+            if record.layer is not None:
+                # Export name: build the tag from the folders and the layer token
+                layer = find_layer(record.layer)
+                size = revo_size(record.size_folder)
+                if layer is None or size is None:
+                    print("[WARNING] Unknown layer or size folder for " + filename + "; skipping.")
+                    tag = None
                 else:
-                    continue
-                
-    for dirpath, dirs, files in os.walk("./REVO", topdown=False):
-        if files and not dirs:
-            for filename in files:
-                if filename and not filename.startswith(".") and "." in filename:
-                    fileExtension = filename.split(".")[-1]
-                    size = dirpath.split("/")[-1]
-                    imageSizeMM = size.split("_")[0] + "x" + size.split("_")[0]
-                    imageSizeScans = size.split("_")[1] + "x" + size.split("_")[1]
-                    studyID, instrument, retinalLayer, imageSizeMM, imageSizeScans = decomposeFileName(studyID, instrument, retinalLayer, imageSizeMM, imageSizeScans, filename)                    
-                    for imageID, OCTA, inst, layer, mm, scans in imageID_list:
-                        if OCTA == studyID and inst == instrument and layer == retinalLayer and mm == imageSizeMM and imageSizeScans == scans:
-                            # Set an original file name
-                            target = os.path.join(dirpath, filename)
-                            # Set a new name
-                            if int(imageID) < 1000:
-                                final = os.path.join(dirpath, "0" + str(imageID) + "." + fileExtension)
-                            else:
-                                final = os.path.join(dirpath, str(imageID) + "." + fileExtension)
-                            # Rename
-                            os.rename(target, final)
-                            # Result message
-                            if int(imageID) < 1000:
-                                print(filename + " has been changed to " + "0" + str(imageID) + "." + fileExtension)
-                            else:
-                                print(filename + " has been changed to " + str(imageID) + "." + fileExtension)
-                        else:
-                            continue
+                    tag = FileTag(record.study_id, "Revo", layer, size[0], size[1], record.extension)
+            else:
+                # Already renamed to studyID_tag.ext by an earlier run; Image ID names are left alone
+                tag = parse_tag_name(filename)
+        if tag is None:
+            metrics.count("unparsed")
+            continue
+        
+        with metrics.stage("match"):
+            imageID = labelIndex.lookup(tag.study_id, tag.instrument, tag.layer, tag.size_mm, record.size_scans)
+            duplicate = imageID is None and labelIndex.is_duplicate(tag.study_id, tag.instrument, tag.layer, tag.size_mm, record.size_scans)
+        if imageID is not None:
+            # Image IDs are already zero-padded to 4 digits
+            metrics.count("matched")
+            newFilename = imageID + "." + record.extension
+        else:
+            if duplicate:
+                metrics.count("ambiguous")
+                print("[WARNING] " + tag.filename + " matches more than one row in Excel; skipping.")
+            else:
+                metrics.count("unmatched")
+            # Files without an Image ID keep the intermediate name
+            newFilename = tag.filename
+        
+        plan.add(record.path, os.path.join(dirpath, newFilename), imageID)
+    
+    return plan
                     
             
-# Relable the file name generated by Spectralis
-def spectralis(name_list, imageID_list):
+# Plan the renames of the files exported by Spectralis
+# Files already relabelled by an earlier run (see history.py) are skipped
+# paths limits the plan to those files; by default every file in the folder is checked
+def spectralis(nameIndex, labelIndex, history=None, root=ROOTS["spectralis"], paths=None):
     print("spectralis")
-    filename = ""
-    fileInfo = ""
-    fileExtension = ""
-    studyID = ""
-    instrument = "Spectralis"
-    retinalLayer = ""
-    imageSizeMM = "3x3"
-    imageSizeScans = "512x512"
+    plan = RenamePlan(root)
     
     # Set a path
-    path = Path("./Spectralis")
-    for filenames in path.iterdir():
+    path = Path(root)
+    if paths is not None:
+        entries = [Path(p) for p in paths]
+    else:
+        with metrics.stage("walk"):
+            entries = list(path.iterdir())
+    for filenames in entries:
         # Since path.iterdir() returns entire path of file, it should be extracted
         filename = filenames.parts[-1]
         # Set a filter to remove unnecessary files (such as .dsstore or any other confiuration file/dummy)
-        if filename and not filename.startswith(".") and "." in filename and " " in filename:
-            # Extract the file extension
-            fileExtension = filename.split(".")[-1]
-            # Extract the size of photo, instrument name, and retinal layer
-            fileInfo = ExtractFileInfo("spectralis", 3.3, filename.split(" ")[-3])
-            # Combine each other's data to rename it
-            filename = filename.split(" ")[0] + " " + filename.split(" ")[1]            
-        else:
-            # Disregard it if it is not appropriate file
+        if not filename or filename.startswith(".") or "." not in filename:
             continue
-        for givenname, surname, studyID in name_list:
-            if filename.strip() == (str(surname) + " " + str(givenname)).strip():
-                #print(studyID + "_" + fileInfo + "." + fileExtension)
-                # Set an original file name
-                target = os.path.join("./Spectralis", filenames.parts[-1])
-                # Set a new name
-                newName = os.path.join("./Spectralis", studyID + "_" + fileInfo + "." + fileExtension)
-                # Rename
-                os.rename(target, newName)
-                # Result message
-                print(filenames.parts[-1] + " has been changed to " + studyID + "_" + fileInfo + "." + fileExtension)
-                
-    for filenames in path.iterdir():
-        # Since path.iterdir() returns entire path of file, it should be extracted
-        filename = filenames.parts[-1]
-        # Set a filter to remove unnecessary files (such as .dsstore or any other confiuration file/dummy)
-        if filename and not filename.startswith(".") and "." in filename:
-            studyID, instrument, retinalLayer, imageSizeMM, imageSizeScans = decomposeFileName(studyID, instrument, retinalLayer, imageSizeMM, imageSizeScans, filename)
-            # Extract the file extension
-            fileExtension = filename.split(".")[-1]
-        else:
-            # Disregard it if it is not appropriate file
+        if history is not None and history.is_processed(filenames):
+            metrics.count("skipped")
             continue
-        for imageID, OCTA, inst, layer, mm, scans in imageID_list:
-            if OCTA == studyID and inst == instrument and layer == retinalLayer and mm == imageSizeMM and imageSizeScans == scans:
-                # Set an original file name
-                target = os.path.join("./Spectralis", filename)
-                # Set a new name
-                final = os.path.join("./Spectralis", str(imageID) + "." + fileExtension)
-                # Rename
-                os.rename(target, final)
-                # Result message
-                print(filename + " has been changed to " + str(imageID) + "." + fileExtension)
-                
+        # Extract the file extension
+        fileExtension = filename.split(".")[-1]
+        
+        if " " in filename:
+            # Export name: the retinal layer is in the third token from the end ('03_Retina')
+            with metrics.stage("parse"):
+                words = filename.split(" ")
+                # Names with fewer than three words (e.g. 'Copy of.tif') are not exports
+                layer = find_layer(words[-3]) if len(words) >= 3 else None
+                # The patient name ("Surname Givenname") is everything before the eye (OD/OS)
+                eye = next((i for i, word in enumerate(words) if word in ("OD", "OS")), 2)
+                patient = " ".join(words[:eye])
+            if layer is None:
+                metrics.count("unparsed")
+                print("[WARNING] Unknown layer for " + filename + "; skipping.")
+                continue
+            with metrics.stage("match"):
+                studyID = nameIndex.lookup(patient)
+                ambiguous = studyID is None and nameIndex.is_ambiguous(patient)
+            if studyID is None:
+                if ambiguous:
+                    metrics.count("ambiguous")
+                    print("[WARNING] " + filename + " matches more than one Study ID; skipping.")
+                else:
+                    metrics.count("unmatched")
+                # Disregard it if the patient is not in the name list
+                continue
+            tag = FileTag(studyID, "Spectralis", layer, SPECTRALIS_SIZE, False, fileExtension)
+        else:
+            # Already renamed to studyID_tag.ext by an earlier run; Image ID names are left alone
+            with metrics.stage("parse"):
+                tag = parse_tag_name(filename)
+            if tag is None:
+                metrics.count("unparsed")
+                continue
+        
+        with metrics.stage("match"):
+            imageID = labelIndex.lookup(tag.study_id, tag.instrument, tag.layer, tag.size_mm, SPECTRALIS_SCANS)
+            duplicate = imageID is None and labelIndex.is_duplicate(tag.study_id, tag.instrument, tag.layer, tag.size_mm, SPECTRALIS_SCANS)
+        if imageID is not None:
+            metrics.count("matched")
+            newFilename = imageID + "." + fileExtension
+        else:
+            if duplicate:
+                metrics.count("ambiguous")
+                print("[WARNING] " + tag.filename + " matches more than one row in Excel; skipping.")
+            else:
+                metrics.count("unmatched")
+            # Files without an Image ID keep the intermediate name
+            newFilename = tag.filename
+        
+        plan.add(str(filenames), os.path.join(root, newFilename), imageID)
+    
+    return plan
+
+
+# Relabel one instrument folder in this process
+# labels is a LabelStore, so label data loaded for an earlier run is reused
+# paths limits the run to those files in the folder (see watch.py); by default every file is checked
+# Returns the renames applied (planned, for a dry run); raises RuntimeError if the folder is missing or the plan is refused
+def run(instrument, root=None, labels=None, dry_run=False, full=False, cancel=None, paths=None):
+    root = root or ROOTS[instrument]
+    labels = labels or LabelStore()
+    if not os.path.isdir(root):
+        raise RuntimeError(f"Folder not found: {root}")
+    
+    # Files relabelled by earlier runs; with full=True every file is checked again
+    # A dry run only reads the history, so it leaves the folder untouched
+    with ProcessedLog(root, read_only=dry_run) as history:
+        skip = None if full else history
+        
+        if (instrument == "revo"):
+            # Index the labels once so each file is matched with a single lookup
+            with metrics.stage("load"):
+                labelIndex = labels.labels("Revo")
+            labelIndex.report_duplicates()
+            records = None
+            if paths is not None:
+                records = [record for record in (revo_record(root, p) for p in paths) if record is not None]
+            plan = revo(labelIndex, skip, root, records)
+        elif (instrument == "spectralis"):
+            # Index the participant names once: "Surname Givenname" -> Study ID
+            with metrics.stage("load"):
+                nameIndex = labels.names()
+            nameIndex.report_ambiguous()
+            with metrics.stage("load"):
+                labelIndex = labels.labels("Spectralis")
+            labelIndex.report_duplicates()
+            plan = spectralis(nameIndex, labelIndex, skip, root, paths)
+        else:
+            raise ValueError("Unknown instrument: " + instrument)
+        
+        # Check the whole plan before any file is touched
+        applied = execute(plan, history, dry_run, cancel)
+        if not dry_run:
+            print(f"[INFO] {len([r for r in applied if r.image_id])} files relabelled; "
+                  f"{len(history)} files recorded in the history.")
+    return applied
+
 
 # Starting function
 def extractFileName():
     
-    # If user put appropriate number of argument, it will move on next step
-    if len(sys.argv) == 2:
-        # arg1 store the parametre which instrument user does want to relable
-        arg1 = sys.argv[1]  
-        print(f"First argument: {arg1}")
-    else:
-        # If user put inappropriate number of argument, it will notify the usage and exit the programme
-        print("Usage : ./relable.py {instrument name}")
-        exit()
-    
-    # Open the excel file to compare file names
-    df = pd.read_excel('2024_PartialData.xlsx')
-    df2 = pd.read_excel('2025_OCTA_HARMONISATION_LABELS.xlsx')
+    parser = argparse.ArgumentParser(prog="relabel.py", description="Rename Revo or Spectralis exports to their Image IDs.")
+    parser.add_argument("instrument", choices=sorted(ROOTS), help="instrument to relabel")
+    parser.add_argument("--dry-run", action="store_true", help="print the planned renames without changing any file")
+    recovery = parser.add_mutually_exclusive_group()
+    recovery.add_argument("--resume", action="store_true", help="finish an interrupted run from its journal")
+    recovery.add_argument("--rollback", action="store_true", help="undo an interrupted run from its journal")
+    parser.add_argument("--full", action="store_true", help="check every file again, ignoring the history of earlier runs")
+    parser.add_argument("--quiet", action="store_true", help="only print warnings, errors and the summary, not one line per file")
+    parser.add_argument("--metrics", metavar="FILE", help="write the stage timings and counts to FILE as JSON")
+    parser.add_argument("--check", action="store_true", help="check the folder and workbooks without reading or renaming any file")
+    parser.add_argument("--version", action="version", version="%(prog)s " + preflight.__version__)
+    args = parser.parse_args()
+    print(f"First argument: {args.instrument}")
+    root = ROOTS[args.instrument]
     
-    name_list = []
-    imageID_list = []
+    # Names and stats only: the workbooks are not parsed
+    if args.check:
+        if not preflight.report(preflight.check_folder(args.instrument, root)):
+            sys.exit(1)
+        return
     
-    # Extract each rows
-    # col2 : Givenname
-    # col3 : Surname
-    # col4 : Study ID
-    for index, row in df.iterrows():
-        col2 = row.iloc[0]  
-        col3 = row.iloc[1]
-        col4 = row.iloc[2]
-        name_list.append([col2, col3, col4])
-    
-    for index, row in df2.iterrows():
-        col2 = row['Image ID']  
-        col3 = row['Study participant ID']
-        col4 = row['Instrument']
-        col5 = row['Retinal Layer']
-        col6 = row['Image size [mm]']
-        col7 = row['Image size [scans]']
-        imageID_list.append([col2, col3, col4, col5, col6, col7]) 
+    with metrics.collect(quiet=args.quiet) as runMetrics:
+        # An interrupted run only needs its journal, not the Excel files
+        if (args.resume or args.rollback) and not os.path.exists(journal_path(root)):
+            print(f"[INFO] No unfinished rename journal in {root}")
+            return
+        if args.resume:
+            applied = resume(root)
+            with ProcessedLog(root) as history:
+                history.record(applied)
+            return
+        if args.rollback:
+            rollback(root)
+            return
+        
+        failed = False
+        try:
+            run(args.instrument, root, dry_run=args.dry_run, full=args.full)
+        except (RuntimeError, OSError) as e:
+            print(f"[ERROR] {e}")
+            failed = True
     
-    if (sys.argv[1] == "revo"):
-        # If the argument is revo, it will excute the function named 'revo'
-        revo(imageID_list)
-    elif (sys.argv[1] == "spectralis"):
-        # If the argument is 'spectralis', it will excute the function named 'spectralis'
-        spectralis(name_list, imageID_list)
+    print(runMetrics.summary())
+    if args.metrics:
+        runMetrics.write_json(args.metrics, instrument=args.instrument, root=root, dry_run=args.dry_run, failed=failed)
+    if failed:
+        sys.exit(1)
         
 
-extractFileName()
\ No newline at end of file
+if __name__ == "__main__":
+    extractFileName()
@@ -0,0 +1,337 @@
+"""
+Plan/apply rename engine shared by relabel.py and angiovue.py.
+
+Renames are collected into a RenamePlan first, checked as a whole, and only
+then applied. This keeps a half-finished batch recoverable:
+
+    1. Plan: every source -> target pair is recorded; nothing on disk changes.
+    2. Check: the plan is refused if two files map to the same target, a target
+       already exists and is not being moved away itself, or renames form a cycle.
+    3. Apply: the full plan is written to a JSONL journal in the instrument
+       folder (.relabel_journal.jsonl), then each rename is performed and
+       recorded. The journal is removed once every rename has succeeded.
+
+If a run stops part way, the journal is left behind. `resume()` finishes the
+remaining renames, `rollback()` undoes the ones already applied. A batch
+stopped on request (`cancel`) leaves its journal in the same way.
+
+Note:
+    - Only renames are journaled. Deleting .png files and converting .raw files
+      in angiovue.py cannot be rolled back.
+"""
+
+import json
+import os
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+import metrics
+
+JOURNAL_NAME = '.relabel_journal.jsonl'
+
+
+class Cancelled(Exception):
+    """Raised when a run is stopped at the caller's request (see the `cancel` arguments)."""
+
+
+class Rename(NamedTuple):
+    src: str
+    dst: str
+    image_id: Optional[str] = None   # set when dst is the file's final Image ID name
+
+
+def journal_path(root: str) -> str:
+    """Returns the path of the rename journal for an instrument folder."""
+    return os.path.join(root, JOURNAL_NAME)
+
+
+class RenamePlan:
+    """
+    An ordered set of renames inside one instrument folder.
+
+    Parameters:
+    ----------
+    root : str
+        Instrument folder (e.g. './REVO'); the journal is kept here.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.renames: List[Rename] = []
+
+    def __len__(self) -> int:
+        return len(self.renames)
+
+    def add(self, src: str, dst: str, image_id: Optional[str] = None) -> None:
+        """
+        Records that `src` should be renamed to `dst`. Renaming a file to itself is ignored.
+
+        Pass `image_id` when `dst` is the file's final name, so the rename can be
+        recorded in the history (see history.py).
+        """
+        if os.path.abspath(src) != os.path.abspath(dst):
+            self.renames.append(Rename(os.path.abspath(src), os.path.abspath(dst), image_id))
+
+    def problems(self) -> List[str]:
+        """
+        Checks the plan against itself and the current folder contents.
+
+        Returns:
+        ----------
+        list of str
+            One message per problem; empty if the plan is safe to apply.
+        """
+        problems = []
+        sources = set()
+        targets: Dict[str, str] = {}
+
+        for rename in self.renames:
+            if rename.src in sources:
+                problems.append(f"{rename.src} is planned to be renamed more than once")
+            sources.add(rename.src)
+
+        for rename in self.renames:
+            if rename.dst in targets:
+                problems.append(f"{targets[rename.dst]} and {rename.src} would both be renamed to {rename.dst}")
+            else:
+                targets[rename.dst] = rename.src
+            if rename.dst not in sources and os.path.exists(rename.dst):
+                problems.append(f"{rename.src} would overwrite existing file {rename.dst}")
+
+        if not problems:
+            try:
+                self._ordered()
+            except ValueError as e:
+                problems.append(str(e))
+
+        return problems
+
+    def _ordered(self) -> List[Rename]:
+        """
+        Orders renames so that a file is moved away before its name is reused
+        (A -> B is applied after B -> C).
+
+        Raises:
+        ----------
+        ValueError
+            If renames form a cycle (A -> B, B -> A).
+        """
+        pending = {rename.src: rename for rename in self.renames}
+        ordered = []
+        visiting = set()
+
+        def visit(src: str) -> None:
+            rename = pending.pop(src)
+            visiting.add(src)
+            if rename.dst in visiting:
+                raise ValueError(f"renames form a cycle through {rename.dst}")
+            if rename.dst in pending:
+                visit(rename.dst)
+            visiting.discard(src)
+            ordered.append(rename)
+
+        for rename in self.renames:
+            if rename.src in pending:
+                visit(rename.src)
+
+        return ordered
+
+    def print(self, dry_run: bool = False) -> None:
+        """Prints one line per planned rename."""
+        verb = "would be changed to" if dry_run else "will be changed to"
+        for rename in self.renames:
+            metrics.progress(f"{os.path.basename(rename.src)} {verb} {os.path.basename(rename.dst)}")
+
+    def apply(self, cancel: Optional[threading.Event] = None) -> List[Rename]:
+        """
+        Checks and applies the plan, journaling every rename.
+
+        Parameters:
+        ----------
+        cancel : threading.Event, optional
+            Checked before each rename; once set, the batch stops with Cancelled
+            and the journal is kept.
+
+        Returns:
+        ----------
+        list of Rename
+            The renames performed, in the order they were applied.
+
+        Raises:
+        ----------
+        RuntimeError
+            If the plan has problems or an unfinished journal already exists.
+        OSError
+            If a rename fails; the journal is kept so the batch can be resumed or rolled back.
+        Cancelled
+            If `cancel` was set part way; the batch can be resumed or rolled back.
+        """
+        path = journal_path(self.root)
+        if os.path.exists(path):
+            raise RuntimeError(f"An unfinished rename journal exists at {path}; resume or roll it back first.")
+
+        problems = self.problems()
+        if problems:
+            raise RuntimeError("Rename plan refused:\n  " + "\n  ".join(problems))
+
+        ordered = self._ordered()
+        if not ordered:
+            return []
+
+        with open(path, 'w', encoding='utf-8') as journal:
+            for rename in ordered:
+                journal.write(json.dumps({'op': 'plan', 'src': rename.src, 'dst': rename.dst,
+                                          'image_id': rename.image_id}) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        return _run(path, ordered, set(), cancel)
+
+
+def _run(path: str, ordered: List[Rename], done: set,
+         cancel: Optional[threading.Event] = None) -> List[Rename]:
+    """Applies every rename not in `done`, appending a 'done' record to the journal after each."""
+    applied = []
+
+    with open(path, 'a', encoding='utf-8') as journal:
+        for i, rename in enumerate(ordered):
+            if i in done:
+                continue
+            if cancel is not None and cancel.is_set():
+                print(f"[INFO] Stopped after {len(done) + len(applied)} of {len(ordered)} renames. "
+                      f"The journal was kept at {path}.")
+                raise Cancelled()
+            try:
+                os.rename(rename.src, rename.dst)
+            except OSError:
+                metrics.count('errors')
+                print(f"[ERROR] Rename failed after {len(done) + len(applied)} of {len(ordered)}: "
+                      f"{rename.src} -> {rename.dst}. The journal was kept at {path}.")
+                raise
+            journal.write(json.dumps({'op': 'done', 'index': i}) + "\n")
+            journal.flush()
+            applied.append(rename)
+            metrics.count('renamed')
+            metrics.progress(f"{os.path.basename(rename.src)} has been changed to {os.path.basename(rename.dst)}")
+
+    os.remove(path)
+    return applied
+
+
+def execute(plan: RenamePlan, history=None, dry_run: bool = False,
+            cancel: Optional[threading.Event] = None) -> List[Rename]:
+    """
+    Checks a plan and applies it, or prints it for a dry run.
+
+    Parameters:
+    ----------
+    plan : RenamePlan
+        The planned renames.
+    history : history.ProcessedLog, optional
+        Applied renames are recorded here.
+    dry_run : bool
+        Only print the plan.
+    cancel : threading.Event, optional
+        Passed to RenamePlan.apply.
+
+    Returns:
+    ----------
+    list of Rename
+        The renames applied, or the planned renames for a dry run.
+
+    Raises:
+    ----------
+    RuntimeError, OSError, Cancelled
+        As RenamePlan.apply. Problems found in the plan are printed first.
+    """
+    problems = plan.problems()
+    for problem in problems:
+        print(f"[ERROR] {problem}")
+    metrics.count('errors', len(problems))
+
+    if dry_run:
+        plan.print(dry_run=True)
+        print(f"[INFO] Dry run: {len(plan)} files would be renamed.")
+        return list(plan.renames)
+    if problems:
+        raise RuntimeError("No files were renamed.")
+
+    with metrics.stage('rename'):
+        applied = plan.apply(cancel)
+        if history is not None:
+            history.record(applied)
+    return applied
+
+
+def _read_journal(path: str):
+    """Returns (planned renames, indexes already done) from a journal file."""
+    ordered: List[Rename] = []
+    done = set()
+
+    with open(path, 'r', encoding='utf-8') as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if entry['op'] == 'plan':
+                ordered.append(Rename(entry['src'], entry['dst'], entry.get('image_id')))
+            elif entry['op'] == 'done':
+                done.add(entry['index'])
+
+    return ordered, done
+
+
+def resume(root: str) -> List[Rename]:
+    """
+    Finishes an interrupted batch from its journal.
+
+    A rename whose source is gone and whose target exists is treated as done
+    (the process stopped between the rename and the journal write).
+
+    Returns:
+    ----------
+    list of Rename
+        The renames performed by this call.
+    """
+    path = journal_path(root)
+    ordered, done = _read_journal(path)
+
+    for i, rename in enumerate(ordered):
+        if i not in done and not os.path.exists(rename.src) and os.path.exists(rename.dst):
+            done.add(i)
+
+    print(f"[INFO] Resuming {len(ordered) - len(done)} of {len(ordered)} renames from {path}")
+    return _run(path, ordered, done)
+
+
+def rollback(root: str) -> List[Rename]:
+    """
+    Undoes the renames of an interrupted batch, newest first, and removes its journal.
+
+    A rename is undone when its target exists and its source does not, so a
+    rollback that stopped part way can simply be run again.
+
+    Returns:
+    ----------
+    list of Rename
+        The renames that were undone (as target -> source).
+    """
+    path = journal_path(root)
+    ordered, _ = _read_journal(path)
+    undone = []
+
+    for i in range(len(ordered) - 1, -1, -1):
+        rename = ordered[i]
+        # Decided from the folder, not the journal's 'done' records: a rollback that
+        # stopped part way has already moved some files back, and running it again finishes it
+        if not os.path.exists(rename.dst) or os.path.exists(rename.src):
+            continue
+        os.rename(rename.dst, rename.src)
+        undone.append(Rename(rename.dst, rename.src))
+        metrics.progress(f"{os.path.basename(rename.dst)} has been changed back to {os.path.basename(rename.src)}")
+
+    os.remove(path)
+    print(f"[INFO] Rolled back {len(undone)} renames from {path}")
+    return undone
@@ -0,0 +1,130 @@
+"""
+Directory scanners for instrument export folders.
+
+REVO exports are laid out as
+    REVO/OCTAxxx/<mm>_<scans>/<export file>
+e.g. REVO/OCTA004/3_320/HOLLY CHINNERY_DCP_INL_OPL_10_OPL_ONL_-10_20240906_012216.tiff.
+
+The scanner visits each folder exactly once with os.scandir and returns one
+record per file, so renaming can be planned in memory without walking the
+tree again.
+"""
+
+import os
+import re
+from typing import List, NamedTuple, Optional
+
+REVO_ROOT = './REVO'
+
+# Size folders are named '<mm>_<scans>', e.g. '3_320', '3_400', '6_400'
+_SIZE_FOLDER = re.compile(r'^(\d+)_(\d+)$')
+
+
+class RevoFile(NamedTuple):
+    """A file found under REVO/OCTAxxx/<mm>_<scans>/."""
+    study_id: str           # 'OCTA-004'
+    size_mm: str            # '3x3'
+    size_scans: str         # '320x320'
+    layer: Optional[str]    # Layer token of an export name ('DCP', 'Superficial', ...); None for other names
+    extension: str          # 'tiff'
+    path: str
+
+    @property
+    def filename(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def size_folder(self) -> str:
+        """Name of the size folder, e.g. '3_320'."""
+        return os.path.basename(os.path.dirname(self.path))
+
+
+def _visible(entry: os.DirEntry) -> bool:
+    """Filters out .DS_Store and other hidden configuration files."""
+    return not entry.name.startswith(".")
+
+
+def _study_id(folder_name: str) -> str:
+    """'OCTA004' -> 'OCTA-004'"""
+    return folder_name[:4] + "-" + folder_name[4:]
+
+
+def _revo_file(study_id: str, mm: str, scans: str, name: str, path: str) -> RevoFile:
+    # Export names look like 'HOLLY CHINNERY_DCP_...'; the token after the first '_' is the layer
+    layer = name.split("_")[1] if " " in name and "_" in name else None
+    return RevoFile(
+        study_id=study_id,
+        size_mm=mm + "x" + mm,
+        size_scans=scans + "x" + scans,
+        layer=layer,
+        extension=name.split(".")[-1],
+        path=path,
+    )
+
+
+def scan_revo(root: str = REVO_ROOT) -> List[RevoFile]:
+    """
+    Scans a REVO export folder in a single pass.
+
+    Parameters:
+    ----------
+    root : str
+        Path to the REVO folder.
+
+    Returns:
+    ----------
+    list of RevoFile
+        One record per file, sorted by path. Folders that do not follow the
+        OCTAxxx/<mm>_<scans> layout are ignored.
+    """
+    records = []
+
+    with os.scandir(root) as studies:
+        study_dirs = [e for e in studies if _visible(e) and e.is_dir()]
+
+    for study_dir in study_dirs:
+        study_id = _study_id(study_dir.name)
+
+        with os.scandir(study_dir.path) as sizes:
+            size_dirs = [e for e in sizes if _visible(e) and e.is_dir()]
+
+        for size_dir in size_dirs:
+            match = _SIZE_FOLDER.match(size_dir.name)
+            if not match:
+                continue
+            mm, scans = match.groups()
+
+            with os.scandir(size_dir.path) as files:
+                for entry in files:
+                    if not _visible(entry) or "." not in entry.name or not entry.is_file():
+                        continue
+                    records.append(_revo_file(study_id, mm, scans, entry.name, entry.path))
+
+    records.sort(key=lambda r: r.path)
+    return records
+
+
+def revo_record(root: str, path: str) -> Optional[RevoFile]:
+    """
+    Returns the record of one file, as scan_revo would, without scanning the folder.
+
+    Parameters:
+    ----------
+    root : str
+        Path to the REVO folder.
+    path : str
+        A file at <root>/OCTAxxx/<mm>_<scans>/<name>.
+
+    Returns:
+    ----------
+    RevoFile or None
+        None if the file is hidden, has no extension or is not in the layout above.
+    """
+    parts = os.path.relpath(path, root).split(os.sep)
+    if len(parts) != 3 or any(part.startswith(".") for part in parts) or "." not in parts[2]:
+        return None
+    match = _SIZE_FOLDER.match(parts[1])
+    if not match:
+        return None
+    mm, scans = match.groups()
+    return _revo_file(_study_id(parts[0]), mm, scans, parts[2], os.path.join(root, *parts))
@@ -0,0 +1,124 @@
+"""
+Tag grammar for relabelled file names, shared by relabel.py and angiovue.py.
+
+Before a file receives its Image ID it is renamed to
+    <Study participant ID>_<tag>.<extension>        e.g. OCTA-004_RDCP3H.tiff
+where the tag is
+    <instrument code><layer code><size>[H]
+
+    instrument : R = Revo, S = Spectralis, A = Angiovue
+    layer      : R = Retina, S = Superficial, D = Deep, SVC, SVP, DVC, DCP
+    size       : scan width in mm (3, 6, 8, 10, 12)
+    H          : high-density scan (Revo 3x3 mm at 400x400)
+
+The grammar is a single precompiled regular expression built from the code
+tables below, so adding an instrument or layer only means adding a table entry.
+"""
+
+import re
+from typing import NamedTuple, Optional, Tuple
+
+INSTRUMENT_CODES = {'Revo': 'R', 'Spectralis': 'S', 'Angiovue': 'A'}
+LAYER_CODES = {
+    'Retina': 'R',
+    'Superficial': 'S',
+    'Deep': 'D',
+    'SVC': 'SVC',
+    'SVP': 'SVP',
+    'DVC': 'DVC',
+    'DCP': 'DCP',
+}
+INSTRUMENTS = {code: name for name, code in INSTRUMENT_CODES.items()}
+LAYERS = {code: name for name, code in LAYER_CODES.items()}
+
+# Revo size folders '<mm>_<scans>' -> (size, high density)
+REVO_SIZES = {
+    '3_320': ('3', False),
+    '3_400': ('3', True),
+    '3_512': ('3', False),
+    '3_640': ('3', False),
+    '6_400': ('6', False),
+    '10_640': ('10', False),
+}
+
+
+def _alternation(codes) -> str:
+    # Longest codes first, so 'SVC' is preferred over 'S' followed by 'VC'
+    return "|".join(re.escape(c) for c in sorted(codes, key=len, reverse=True))
+
+
+_TAG_NAME = re.compile(
+    r'^(?P<study>[^_]+)_'
+    rf'(?P<instrument>{_alternation(INSTRUMENTS)})'
+    rf'(?P<layer>{_alternation(LAYERS)})'
+    r'(?P<size>\d+)(?P<hd>H?)'
+    r'(?:\.(?P<ext>[^.]+))?$'
+)
+
+# Layer names as they appear inside export names ('..._DCP_...', '03_Retina')
+_LAYER_NAME = re.compile(_alternation(LAYER_CODES))
+
+
+class FileTag(NamedTuple):
+    """The fields encoded in a <study>_<tag>.<ext> file name."""
+    study_id: str           # 'OCTA-004'
+    instrument: str         # 'Revo'
+    layer: str              # 'DCP'
+    size: str               # '3'
+    high_density: bool
+    extension: str = ''     # 'tiff'; empty for a base name
+
+    @property
+    def size_mm(self) -> str:
+        """Image size as written in the label workbook, e.g. '3x3'."""
+        return self.size + "x" + self.size
+
+    @property
+    def code(self) -> str:
+        """The tag, e.g. 'RDCP3H'."""
+        return (INSTRUMENT_CODES[self.instrument] + LAYER_CODES[self.layer] + self.size
+                + ("H" if self.high_density else ""))
+
+    @property
+    def filename(self) -> str:
+        """The tagged file name, e.g. 'OCTA-004_RDCP3H.tiff'."""
+        name = self.study_id + "_" + self.code
+        return name + "." + self.extension if self.extension else name
+
+
+def parse_tag_name(name: str) -> Optional[FileTag]:
+    """
+    Parses a tagged file name ('OCTA-004_RDCP3H.tiff') or base name ('OCTA-004_AD3').
+
+    Returns:
+    ----------
+    FileTag or None
+        None if the name does not follow the grammar (export names, Image ID names,
+        unknown layers).
+    """
+    match = _TAG_NAME.match(name)
+    if match is None:
+        return None
+    return FileTag(
+        study_id=match.group('study'),
+        instrument=INSTRUMENTS[match.group('instrument')],
+        layer=LAYERS[match.group('layer')],
+        size=match.group('size'),
+        high_density=bool(match.group('hd')),
+        extension=match.group('ext') or '',
+    )
+
+
+def find_layer(token: str) -> Optional[str]:
+    """
+    Returns the layer name found in part of an export name, e.g. '03_Retina' -> 'Retina'.
+
+    Returns None for layers without a code (e.g. ICP).
+    """
+    match = _LAYER_NAME.search(token)
+    return match.group(0) if match else None
+
+
+def revo_size(size_folder: str) -> Optional[Tuple[str, bool]]:
+    """Returns (size, high density) for a Revo size folder such as '3_400', or None if unknown."""
+    return REVO_SIZES.get(size_folder)
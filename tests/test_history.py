@@ -0,0 +1,125 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import angiovue
+from history import ContentStore, file_digest
+
+
+def write_raw(folder, name, seed):
+    data = np.random.default_rng(seed).random((304, 304), dtype=np.float32)
+    path = os.path.join(folder, name)
+    data.astype('<f4').tofile(path)
+    return path
+
+
+def convert(folder, formats=('bmp',)):
+    with ContentStore(str(folder)) as store:
+        return angiovue.batch_convert(str(folder), workers=1, formats=formats, store=store)
+
+
+def test_identical_redelivery_is_unchanged(tmp_path):
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    assert convert(tmp_path)['converted'] == ['OCTA-004_AD3.raw']
+    bmp = tmp_path / 'OCTA-004_AD3.bmp'
+    stat = os.stat(bmp)
+
+    # The same export delivered again, after its .raw was deleted by the conversion
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    summary = convert(tmp_path)
+    assert summary['unchanged'] == ['OCTA-004_AD3.raw']
+    assert summary['converted'] == []
+    assert not os.path.exists(tmp_path / 'OCTA-004_AD3.raw')
+    assert os.stat(bmp).st_mtime_ns == stat.st_mtime_ns
+
+
+def test_changed_file_is_converted_again(tmp_path):
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    convert(tmp_path)
+    before = (tmp_path / 'OCTA-004_AD3.bmp').read_bytes()
+
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=2)
+    summary = convert(tmp_path)
+    assert summary['converted'] == ['OCTA-004_AD3.raw']
+    assert summary['unchanged'] == []
+    assert (tmp_path / 'OCTA-004_AD3.bmp').read_bytes() != before
+
+
+def test_redelivery_without_its_outputs_is_converted_again(tmp_path):
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    convert(tmp_path)
+    os.remove(tmp_path / 'OCTA-004_AD3.bmp')
+
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    assert convert(tmp_path)['converted'] == ['OCTA-004_AD3.raw']
+    assert os.path.exists(tmp_path / 'OCTA-004_AD3.bmp')
+
+
+def test_same_content_under_another_name_is_skipped(tmp_path, capsys):
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    write_raw(tmp_path, 'OCTA-006_AD3.raw', seed=1)
+    summary = convert(tmp_path)
+    assert summary['converted'] == ['OCTA-004_AD3.raw']
+    assert summary['skipped'] == ['OCTA-006_AD3.raw']
+    assert os.path.exists(tmp_path / 'OCTA-006_AD3.raw')
+    assert "same content as OCTA-004_AD3.raw" in capsys.readouterr().out
+
+
+def test_npz_redelivery_is_unchanged(tmp_path):
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    write_raw(tmp_path, 'OCTA-004_AD6.raw', seed=3)
+    assert len(convert(tmp_path, ('npz',))['converted']) == 2
+
+    write_raw(tmp_path, 'OCTA-004_AD6.raw', seed=3)
+    assert convert(tmp_path, ('npz',))['unchanged'] == ['OCTA-004_AD6.raw']
+
+
+def test_store_records_each_digest_once(tmp_path):
+    path = write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    digest = file_digest(path)
+    with ContentStore(str(tmp_path)) as store:
+        assert store.record([(digest, 'OCTA-004_AD3.raw', 10), (digest, 'OCTA-006_AD3.raw', 10)]) == 1
+    with ContentStore(str(tmp_path)) as store:
+        assert len(store) == 1
+        assert store.lookup(digest) == 'OCTA-004_AD3.raw'
+        assert store.lookup('0' * 32) is None
+
+
+def write_png(folder, name, mode):
+    from PIL import Image
+
+    path = os.path.join(folder, name)
+    Image.new(mode, (8, 8)).save(path)
+    return path
+
+
+def test_converted_png_is_told_by_name(tmp_path):
+    # Not images at all: a name that decides is never opened
+    (tmp_path / '0143.png').write_bytes(b'')
+    (tmp_path / 'OCTA-004_AD3_OCT.png').write_bytes(b'')
+    assert angiovue.is_converted_png(str(tmp_path / '0143.png'))
+    assert not angiovue.is_converted_png(str(tmp_path / 'OCTA-004_AD3_OCT.png'))
+
+    export = write_png(tmp_path, 'OCTA-004_AD3.png', 'RGBA')
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    assert not angiovue.is_converted_png(export)
+    # Without its .raw the name is ambiguous, so the mode decides
+    output = write_png(tmp_path, 'OCTA-004_AD6.png', 'I;16')
+    assert angiovue.is_converted_png(output)
+    assert not angiovue.is_converted_png(write_png(tmp_path, 'OCTA-004_AS6.png', 'RGBA'))
+
+
+def test_npz_outputs_are_found_from_the_member_list(tmp_path):
+    write_raw(tmp_path, 'OCTA-004_AD3.raw', seed=1)
+    convert(tmp_path, ('npz',))
+    assert angiovue.outputs_exist(str(tmp_path), 'OCTA-004_AD3.raw', formats=('npz',))
+    assert not angiovue.outputs_exist(str(tmp_path), 'OCTA-004_AD6.raw', formats=('npz',))
+    assert not angiovue.outputs_exist(str(tmp_path), 'OCTA-006_AD3.raw', formats=('npz',))
+
+    (tmp_path / angiovue.archive_name('OCTA-004_AD3')).write_bytes(b'damaged')
+    assert not angiovue.outputs_exist(str(tmp_path), 'OCTA-004_AD3.raw', formats=('npz',))
@@ -0,0 +1,216 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import labels
+from labels import (LABEL_COLUMNS, LabelIndex, NameIndex, cache_is_fresh, cache_path, load_labels, make_key,
+                    normalise_name, read_label_rows)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_workbook(path, rows):
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+    return str(path)
+
+
+ROWS = [
+    ['0001', 'OCTA-004', 'Revo', 'DCP', '3x3', '400x400'],
+    ['0002', 'OCTA-004', 'Revo', 'DCP', '6x6', '400x400'],
+    ['0003', 'OCTA-006', 'Revo', 'DCP', '3x3', '400x400'],
+    ['0004', 'OCTA-006', 'Revo', 'DCP', '3x3', '400x400'],   # same key as 0003
+]
+
+
+def test_lookup():
+    index = LabelIndex(ROWS)
+    assert index.lookup('OCTA-004', 'Revo', 'DCP', '3x3', '400x400') == '0001'
+    assert index.lookup('OCTA-004', 'Revo', 'DCP', '6x6', '400x400') == '0002'
+    assert index.lookup('OCTA-004', 'Revo', 'Deep', '3x3', '400x400') is None
+
+
+def test_duplicate_keys_are_reported_not_overwritten(capsys):
+    index = LabelIndex(ROWS)
+    key = make_key('OCTA-006', 'Revo', 'DCP', '3x3', '400x400')
+    assert index.duplicates == {key: ['0003', '0004']}
+    assert index.lookup(*key) is None
+    assert index.is_duplicate(*key)
+    assert not index.is_duplicate('OCTA-004', 'Revo', 'DCP', '3x3', '400x400')
+    assert len(index) == 2
+
+    index.report_duplicates()
+    out = capsys.readouterr().out
+    assert out.count("[WARNING]") == 1
+    assert "0003, 0004" in out
+    index.report_duplicates('Spectralis')
+    assert capsys.readouterr().out == ""
+
+
+def test_keys_are_normalised():
+    index = LabelIndex([['0509', ' OCTA-004 ', 'Revo ', 'DCP', '3 X 3', '400 x 400']])
+    assert make_key('OCTA-004', 'Revo', 'DCP', '3 X 3', '400X400') == ('OCTA-004', 'Revo', 'DCP', '3x3', '400x400')
+    assert index.lookup('OCTA-004', 'Revo', 'DCP', '3x3', '400x400') == '0509'
+    # Participant IDs typed as numbers
+    assert make_key(7.0, 'Revo', 'DCP', '3x3', '400x400')[0] == '7'
+
+
+def test_blank_rows_are_skipped():
+    index = LabelIndex([['0001', 'OCTA-004', 'Revo', 'DCP', '3x3', None],
+                        ['0002', 'OCTA-004', 'Revo', 'DCP', '3x3', float('nan')],
+                        ['0003', 'OCTA-004', 'Revo', '  ', '3x3', '400x400']])
+    assert len(index) == 0
+    assert index.duplicates == {}
+
+
+def test_workbook_rows_are_normalised(tmp_path):
+    path = write_workbook(tmp_path / 'labels.xlsx', [
+        LABEL_COLUMNS + ['Notes'],
+        [509, 'OCTA-004', 'Revo', 'DCP', '3 X 3', '400 X 400', 'typed as a number'],
+        ['12', ' OCTA-006 ', 'Spectralis ', 'SVC', '3x3', '512x512', None],
+        ['A7', 'OCTA-007', 'Angiovue', 'Deep', '6x6', '400x400', None],
+        [13.0, 7.0, 'Revo', 'Retina', '3x3', '320x320', None],
+        [14, 'OCTA-008', 'Revo', None, '3x3', '320x320', 'no layer'],
+    ])
+    assert read_label_rows(path) == [
+        ['0509', 'OCTA-004', 'Revo', 'DCP', '3x3', '400x400'],
+        ['0012', 'OCTA-006', 'Spectralis', 'SVC', '3x3', '512x512'],
+        ['A7', 'OCTA-007', 'Angiovue', 'Deep', '6x6', '400x400'],
+        ['0013', '7', 'Revo', 'Retina', '3x3', '320x320'],
+    ]
+
+
+def test_missing_column_is_reported(tmp_path):
+    path = write_workbook(tmp_path / 'labels.xlsx', [LABEL_COLUMNS[:-1], ['1', 'OCTA-004', 'Revo', 'DCP', '3x3']])
+    with pytest.raises(ValueError, match='Image size'):
+        read_label_rows(path)
+
+
+def test_names_fold_accents_case_and_whitespace():
+    assert normalise_name('Ong  Élaine ') == normalise_name('ong elaine') == 'ong elaine'
+    index = NameIndex([['Élaine', 'Ong', 'OCTA-010'], ['Holly', 'CHINNERY', 'OCTA-004']])
+    assert index.lookup('ONG Elaine') == 'OCTA-010'
+    assert index.lookup('ong   élaine') == 'OCTA-010'
+    assert index.lookup('Chinnery Holly') == 'OCTA-004'
+    assert index.lookup('Holly Chinnery') is None
+
+
+def test_ambiguous_names_are_reported(capsys):
+    index = NameIndex([['Holly', 'Chinnery', 'OCTA-004'],
+                       ['holly', 'Chinnery', 'OCTA-004'],       # same person listed twice
+                       ['Anna', 'Lee', 'OCTA-011'],
+                       ['Anna', 'Lée', 'OCTA-012']])
+    assert index.lookup('Chinnery Holly') == 'OCTA-004'
+    assert index.lookup('Lee Anna') is None
+    assert index.is_ambiguous('LEE anna')
+    assert index.ambiguous == {'lee anna': ['OCTA-011', 'OCTA-012']}
+    index.report_ambiguous()
+    assert "OCTA-011, OCTA-012" in capsys.readouterr().out
+
+
+def counting_reader(monkeypatch):
+    """Counts the workbook parses done through load_labels."""
+    parses = []
+    real = labels.read_label_rows
+
+    def reader(path):
+        parses.append(path)
+        return real(path)
+
+    monkeypatch.setattr(labels, 'read_label_rows', reader)
+    return parses
+
+
+def test_cache_matches_a_fresh_parse(tmp_path, monkeypatch):
+    path = write_workbook(tmp_path / 'labels.xlsx', [LABEL_COLUMNS] + ROWS[:3])
+    parses = counting_reader(monkeypatch)
+
+    fresh = load_labels(path, use_cache=False)
+    assert not os.path.exists(cache_path(path))
+    first = load_labels(path)
+    assert cache_is_fresh(path)
+    cached = load_labels(path)
+    assert len(parses) == 2
+    for index in (first, cached):
+        assert index._index == fresh._index
+        assert index.duplicates == fresh.duplicates
+
+
+def test_touched_workbook_keeps_its_rows(tmp_path, monkeypatch):
+    path = write_workbook(tmp_path / 'labels.xlsx', [LABEL_COLUMNS] + ROWS[:3])
+    load_labels(path)
+    parses = counting_reader(monkeypatch)
+
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not cache_is_fresh(path)
+    assert load_labels(path).lookup('OCTA-004', 'Revo', 'DCP', '3x3', '400x400') == '0001'
+    # Same content: the sha256 matched, so only the stamp was refreshed
+    assert parses == []
+    assert cache_is_fresh(path)
+
+
+def test_edited_workbook_invalidates_the_cache(tmp_path, monkeypatch):
+    path = write_workbook(tmp_path / 'labels.xlsx', [LABEL_COLUMNS] + ROWS[:3])
+    assert load_labels(path).lookup('OCTA-004', 'Revo', 'DCP', '6x6', '400x400') == '0002'
+    parses = counting_reader(monkeypatch)
+
+    write_workbook(path, [LABEL_COLUMNS, ['0042', 'OCTA-004', 'Revo', 'DCP', '6x6', '400x400']])
+    assert not cache_is_fresh(path)
+    index = load_labels(path)
+    assert parses == [path]
+    assert index.lookup('OCTA-004', 'Revo', 'DCP', '6x6', '400x400') == '0042'
+    assert index.lookup('OCTA-004', 'Revo', 'DCP', '3x3', '400x400') is None
+    assert load_labels(path, use_cache=False)._index == index._index
+
+
+def test_stale_cache_version_is_ignored(tmp_path, monkeypatch):
+    path = write_workbook(tmp_path / 'labels.xlsx', [LABEL_COLUMNS] + ROWS[:3])
+    load_labels(path)
+    with open(cache_path(path), 'r+', encoding='utf-8') as f:
+        payload = f.read().replace('"version": %d' % labels.CACHE_VERSION, '"version": 0')
+        f.seek(0)
+        f.write(payload)
+        f.truncate()
+    parses = counting_reader(monkeypatch)
+    load_labels(path)
+    assert parses == [path]
+
+
+def pandas_label_rows(xlsx_path):
+    """The pandas reader used before labels.py switched to openpyxl (user-022)."""
+    pd = pytest.importorskip('pandas')
+    table = pd.read_excel(xlsx_path, usecols=LABEL_COLUMNS, dtype=str).dropna(subset=LABEL_COLUMNS)
+    for col in LABEL_COLUMNS[1:4]:
+        table[col] = table[col].str.strip().str.replace(r'\.0$', '', regex=True)
+    for col in LABEL_COLUMNS[4:]:
+        table[col] = table[col].str.replace(r'\s+', '', regex=True).str.lower()
+    image_ids = table[LABEL_COLUMNS[0]].str.strip().str.replace(r'\.0$', '', regex=True)
+    numeric = image_ids.str.fullmatch(r'\d+')
+    table[LABEL_COLUMNS[0]] = image_ids.where(~numeric, image_ids.str.zfill(4))
+    blank = (table[LABEL_COLUMNS] == '').any(axis=1)
+    return table.loc[~blank, LABEL_COLUMNS].values.tolist()
+
+
+@pytest.mark.parametrize('name', [os.path.basename(labels.LABELS_XLSX), None])
+def test_openpyxl_rows_match_pandas(tmp_path, name):
+    if name is None:
+        path = write_workbook(tmp_path / 'labels.xlsx', [
+            LABEL_COLUMNS,
+            [509, 'OCTA-004', 'Revo', 'DCP', '3 X 3', '400 X 400'],
+            ['12', ' OCTA-006 ', 'Spectralis ', 'SVC', '3x3', '512x512'],
+            [13.0, 7.0, 'Revo', 'Retina', '3x3', '320x320'],
+            ['N/A', 'OCTA-009', 'Revo', 'Retina', '3x3', '320x320'],
+            [14, 'OCTA-008', 'Revo', None, '3x3', '320x320'],
+        ])
+    else:
+        path = os.path.join(ROOT, name)
+    assert read_label_rows(path) == pandas_label_rows(path)
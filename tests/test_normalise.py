@@ -0,0 +1,91 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import angiovue
+from angiovue import normalise, normalise_stack
+
+
+def random_stack(n=5, height=150, width=120, seed=0):
+    # More rows than NORMALISE_CHUNK_ROWS, so the chunked scaling is exercised
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal((n, height, width)) * rng.uniform(1, 100, (n, 1, 1))).astype(np.float32)
+
+
+def test_matches_the_straightforward_formula():
+    image = random_stack(1)[0]
+    expected = ((image - image.min()) / (image.max() - image.min()) * 255).astype(np.uint8)
+    result = normalise(image)
+    assert result.dtype == np.uint8
+    assert np.array_equal(result, expected)
+    assert result.min() == 0 and result.max() == 255
+
+
+def test_uint16_uses_the_full_range():
+    image = random_stack(1)[0]
+    result = normalise(image, dtype=np.uint16)
+    assert result.dtype == np.uint16
+    assert result.min() == 0 and result.max() == 65535
+    out = np.empty(image.shape, np.uint16)
+    assert normalise(image, out=out) is out
+    assert np.array_equal(out, result)
+
+
+@pytest.mark.parametrize('value', [0.0, 7.5, -3.0])
+def test_flat_image_becomes_zero(value):
+    image = np.full((80, 90), value, np.float32)
+    assert not normalise(image).any()
+
+
+def test_all_nan_image_becomes_zero():
+    image = np.full((80, 90), np.nan, np.float32)
+    with np.errstate(all='raise'):
+        result = normalise(image)
+    assert not result.any()
+
+
+def test_nan_pixels_become_zero():
+    image = random_stack(1)[0]
+    image[3, 4] = np.nan
+    result = normalise(image)
+    assert result[3, 4] == 0
+    finite = np.isfinite(image)
+    assert result[finite].max() == 255
+
+
+def test_percentile_window_clips_outliers():
+    image = random_stack(1)[0]
+    image[0, 0] = 1e6
+    image[0, 1] = -1e6
+    lo, hi = np.percentile(image, (1, 99))
+    result = normalise(image, percentiles=(1, 99))
+    assert result[0, 0] == 255 and result[0, 1] == 0
+    inside = (image > lo) & (image < hi)
+    # Without the window the outliers squeeze everything else into a few grey levels
+    assert len(np.unique(result[inside])) > len(np.unique(normalise(image)[inside]))
+
+
+@pytest.mark.parametrize('percentiles', [None, (0.5, 99.5)])
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+def test_stack_equals_each_image(percentiles, dtype):
+    stack = random_stack()
+    stack[1] = 4.0                      # flat
+    stack[2] = np.nan                   # all NaN
+    stack[3, 10, 10] = np.nan           # one NaN pixel
+    scaled = normalise_stack(stack, percentiles=percentiles, dtype=dtype)
+    assert scaled.dtype == dtype
+    for i in range(len(stack)):
+        assert np.array_equal(scaled[i], normalise(stack[i], percentiles=percentiles, dtype=dtype))
+    assert not scaled[1].any() and not scaled[2].any()
+
+
+def test_chunk_size_does_not_change_the_result(monkeypatch):
+    image = random_stack(1)[0]
+    expected = normalise(image)
+    monkeypatch.setattr(angiovue, 'NORMALISE_CHUNK_ROWS', 7)
+    assert np.array_equal(normalise(image), expected)
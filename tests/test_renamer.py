@@ -0,0 +1,133 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import renamer
+from renamer import Cancelled, RenamePlan, journal_path, resume, rollback
+
+
+def touch(folder, *names):
+    for name in names:
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(name)
+
+
+def listing(folder):
+    return sorted(name for name in os.listdir(folder) if name != renamer.JOURNAL_NAME)
+
+
+def plan_of(folder, *pairs):
+    plan = RenamePlan(str(folder))
+    for src, dst in pairs:
+        plan.add(os.path.join(folder, src), os.path.join(folder, dst))
+    return plan
+
+
+def test_chain_is_applied_in_order(tmp_path):
+    touch(tmp_path, 'a', 'b')
+    plan = plan_of(tmp_path, ('a', 'b'), ('b', 'c'))
+    assert plan.problems() == []
+    plan.apply()
+    assert listing(tmp_path) == ['b', 'c']
+    assert open(tmp_path / 'c').read() == 'b'
+    assert open(tmp_path / 'b').read() == 'a'
+    assert not os.path.exists(journal_path(str(tmp_path)))
+
+
+def test_cycle_is_refused(tmp_path):
+    touch(tmp_path, 'a', 'b')
+    plan = plan_of(tmp_path, ('a', 'b'), ('b', 'a'))
+    assert any('cycle' in problem for problem in plan.problems())
+    with pytest.raises(RuntimeError):
+        plan.apply()
+    assert listing(tmp_path) == ['a', 'b']
+
+
+def test_collisions_are_refused(tmp_path):
+    touch(tmp_path, 'a', 'b', 'c')
+    plan = plan_of(tmp_path, ('a', 'x'), ('b', 'x'), ('c', 'a'))
+    problems = plan.problems()
+    assert any('would both be renamed to' in problem for problem in problems)
+
+    plan = plan_of(tmp_path, ('a', 'c'))
+    assert any('would overwrite existing file' in problem for problem in plan.problems())
+
+
+class CancelAfter(threading.Event):
+    """Becomes set after it has been checked `n` times."""
+
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+
+    def is_set(self):
+        self.n -= 1
+        return self.n < 0
+
+
+def interrupted(folder):
+    touch(folder, 'a', 'b', 'c')
+    plan = plan_of(folder, ('a', 'a2'), ('b', 'b2'), ('c', 'c2'))
+    with pytest.raises(Cancelled):
+        plan.apply(CancelAfter(1))
+    assert listing(folder) == ['a2', 'b', 'c']
+    assert os.path.exists(journal_path(str(folder)))
+
+
+def test_resume_after_interruption(tmp_path):
+    interrupted(tmp_path)
+    applied = resume(str(tmp_path))
+    assert [os.path.basename(r.dst) for r in applied] == ['b2', 'c2']
+    assert listing(tmp_path) == ['a2', 'b2', 'c2']
+    assert not os.path.exists(journal_path(str(tmp_path)))
+
+
+def test_rollback_after_interruption(tmp_path):
+    interrupted(tmp_path)
+    undone = rollback(str(tmp_path))
+    assert [os.path.basename(r.dst) for r in undone] == ['a']
+    assert listing(tmp_path) == ['a', 'b', 'c']
+    assert not os.path.exists(journal_path(str(tmp_path)))
+
+
+def test_resume_treats_unjournaled_rename_as_done(tmp_path):
+    interrupted(tmp_path)
+    # Stopped between the rename and its journal record
+    os.rename(tmp_path / 'b', tmp_path / 'b2')
+    applied = resume(str(tmp_path))
+    assert [os.path.basename(r.dst) for r in applied] == ['c2']
+    assert listing(tmp_path) == ['a2', 'b2', 'c2']
+
+
+def test_rollback_can_be_run_again_after_it_stops(tmp_path, monkeypatch):
+    touch(tmp_path, 'a', 'b', 'c')
+    plan = plan_of(tmp_path, ('a', 'a2'), ('b', 'b2'), ('c', 'c2'))
+    with pytest.raises(Cancelled):
+        plan.apply(CancelAfter(2))
+    assert listing(tmp_path) == ['a2', 'b2', 'c']
+
+    # The second rename back fails, as if the rollback were stopped there
+    calls = []
+    real_rename = os.rename
+
+    def failing_rename(src, dst):
+        calls.append(src)
+        if len(calls) == 2:
+            raise PermissionError(src)
+        real_rename(src, dst)
+
+    monkeypatch.setattr(renamer.os, 'rename', failing_rename)
+    with pytest.raises(PermissionError):
+        rollback(str(tmp_path))
+    monkeypatch.undo()
+    assert listing(tmp_path) == ['a2', 'b', 'c']
+    assert os.path.exists(journal_path(str(tmp_path)))
+
+    undone = rollback(str(tmp_path))
+    assert [os.path.basename(r.dst) for r in undone] == ['a']
+    assert listing(tmp_path) == ['a', 'b', 'c']
+    assert not os.path.exists(journal_path(str(tmp_path)))
@@ -0,0 +1,100 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tags import FileTag, find_layer, parse_tag_name, revo_size
+
+
+# Revo exports: '<GIVEN SURNAME>_<layer>_..._<date>_<time>.tiff'; the layer is the token after the first '_'
+@pytest.mark.parametrize('name, layer', [
+    ("HOLLY CHINNERY_DCP_INL_OPL_10_OPL_ONL_-10_20240906_012216.tiff", 'DCP'),
+    ("HOLLY CHINNERY_DVC_IPL_INL_10_OPL_ONL_-10_20240906_012216.tiff", 'DVC'),
+    ("HOLLY CHINNERY_Deep_IPL_INL_-15_IPL_INL_-70_20240906_012216.tiff", 'Deep'),
+    ("HOLLY CHINNERY_Retina_ILM_0_OPL_ONL_-10_20240906_012216.tiff", 'Retina'),
+    ("HOLLY CHINNERY_SVC_ILM_0_IPL_INL_10_20240906_012216.tiff", 'SVC'),
+    ("HOLLY CHINNERY_Superficial_ILM_0_IPL_INL_-15_20240906_012216.tiff", 'Superficial'),
+    ("HOLLY CHINNERY_ICP_IPL_INL_10_INL_OPL_10_20240906_012216.tiff", None),
+])
+def test_revo_export_layer(name, layer):
+    assert find_layer(name.split("_")[1]) == layer
+
+
+# Spectralis exports: '<Surname> <Givenname> <eye> <date> OCTA  <nn>_<layer> PAR<on|off> <version>.tif'
+@pytest.mark.parametrize('name, layer', [
+    ("Chinnery Holly OD 2024-09-06T161513 OCTA  03_Retina PARoff v6.16.7.0.tif", 'Retina'),
+    ("Chinnery Holly OD 2024-09-06T161513 OCTA  04_SVC PARoff v6.16.7.0.tif", 'SVC'),
+    ("Chinnery Holly OD 2024-09-06T161513 OCTA  06_SVP PARoff v6.16.7.0.tif", 'SVP'),
+    ("Chinnery Holly OD 2024-09-06T161513 OCTA  07_DVC PARon v6.16.7.0.tif", 'DVC'),
+    ("Chinnery Holly OD 2024-09-06T161513 OCTA  09_DCP PARon v6.16.7.0.tif", 'DCP'),
+    ("Chinnery Holly OD 2024-09-06T161513 OCTA  08_ICP PARon v6.16.7.0.tif", None),
+])
+def test_spectralis_export_layer(name, layer):
+    assert find_layer(name.split(" ")[-3]) == layer
+
+
+@pytest.mark.parametrize('name, expected', [
+    # Angiovue base names: <Study ID>_A<layer><size>
+    ('OCTA-004_AD3', FileTag('OCTA-004', 'Angiovue', 'Deep', '3', False)),
+    ('OCTA-004_AR6', FileTag('OCTA-004', 'Angiovue', 'Retina', '6', False)),
+    ('OCTA-044_AS3.raw', FileTag('OCTA-044', 'Angiovue', 'Superficial', '3', False, 'raw')),
+    # Names given by relabel.py before the Image ID
+    ('OCTA-004_RDCP3H.tiff', FileTag('OCTA-004', 'Revo', 'DCP', '3', True, 'tiff')),
+    ('OCTA-006_RSVC10.tiff', FileTag('OCTA-006', 'Revo', 'SVC', '10', False, 'tiff')),
+    ('OCTA-004_SRetina3.tif', None),          # layers are written as codes, not names
+    ('OCTA-004_SR3.tif', FileTag('OCTA-004', 'Spectralis', 'Retina', '3', False, 'tif')),
+    ('OCTA-004_SDVC3.tif', FileTag('OCTA-004', 'Spectralis', 'DVC', '3', False, 'tif')),
+])
+def test_parse_tag_name(name, expected):
+    assert parse_tag_name(name) == expected
+
+
+@pytest.mark.parametrize('name', [
+    'OCTA-004_AD3_OCT',                 # Angiovue's OCT preview
+    'OCTA-004_AD3_OCT.png',
+    '0143.bmp',                         # Image ID name
+    '0143',
+    'OCTA-004_AX3',                     # unknown layer
+    'OCTA-004_AD',                      # no size
+    'OCTA-004_QD3',                     # unknown instrument
+    'OCTA-004AD3',                      # no separator
+    "HOLLY CHINNERY_DCP_INL_OPL_10_OPL_ONL_-10_20240906_012216.tiff",
+    "Chinnery Holly OD 2024-09-06T161513 OCTA  03_Retina PARoff v6.16.7.0.tif",
+    '.DS_Store',
+    '',
+])
+def test_names_that_do_not_parse(name):
+    assert parse_tag_name(name) is None
+
+
+@pytest.mark.parametrize('tag', [
+    FileTag('OCTA-004', 'Revo', 'DCP', '3', True, 'tiff'),
+    FileTag('OCTA-004', 'Revo', 'Superficial', '6', False, 'tiff'),
+    FileTag('OCTA-006', 'Spectralis', 'SVP', '3', False, 'tif'),
+    FileTag('OCTA-004', 'Angiovue', 'Deep', '12', False),
+])
+def test_tag_round_trip(tag):
+    assert parse_tag_name(tag.filename) == tag
+
+
+def test_tag_fields():
+    tag = parse_tag_name('OCTA-004_RDCP3H.tiff')
+    assert tag.code == 'RDCP3H'
+    assert tag.size_mm == '3x3'
+    assert tag.filename == 'OCTA-004_RDCP3H.tiff'
+
+
+def test_longest_layer_code_wins():
+    # 'SVC' must not be read as Superficial followed by 'VC'
+    assert parse_tag_name('OCTA-004_RSVC3.tiff').layer == 'SVC'
+    assert parse_tag_name('OCTA-004_RS3.tiff').layer == 'Superficial'
+
+
+def test_revo_size_folders():
+    assert revo_size('3_400') == ('3', True)
+    assert revo_size('3_320') == ('3', False)
+    assert revo_size('10_640') == ('10', False)
+    assert revo_size('4_400') is None
+    assert revo_size('OCTA004') is None
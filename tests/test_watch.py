@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from watch import is_export
+
+
+def write_png(folder, name, mode):
+    Image = pytest.importorskip('PIL.Image')
+    path = os.path.join(folder, name)
+    Image.new(mode, (8, 8)).save(path)
+    return path
+
+
+def test_revo_and_spectralis_exports_have_a_space(tmp_path):
+    root = str(tmp_path)
+    revo = os.path.join(root, 'OCTA004', '3_400', "HOLLY CHINNERY_DCP_INL_OPL_10_OPL_ONL_-10_20240906_012216.tiff")
+    assert is_export('revo', root, revo)
+    assert not is_export('revo', root, os.path.join(root, 'OCTA004', '3_400', 'OCTA-004_RDCP3H.tiff'))
+    assert not is_export('revo', root, os.path.join(root, "HOLLY CHINNERY_DCP.tiff"))     # wrong depth
+    assert is_export('spectralis', root, os.path.join(root, "Chinnery Holly OD OCTA  09_DCP PARon v6.tif"))
+    assert not is_export('spectralis', root, os.path.join(root, '0143.tif'))
+    assert not is_export('spectralis', root, os.path.join(root, ".Chinnery Holly.tif"))
+
+
+def test_angiovue_outputs_do_not_trigger_a_run(tmp_path):
+    root = str(tmp_path)
+    assert is_export('angiovue', root, os.path.join(root, 'OCTA-004_AD3.raw'))
+    assert is_export('angiovue', root, write_png(root, 'OCTA-004_AD3_OCT.png', 'RGBA'))
+    assert is_export('angiovue', root, write_png(root, 'OCTA-004_AD6.png', 'RGBA'))
+    assert not is_export('angiovue', root, os.path.join(root, 'OCTA-004_AD3.bmp'))
+    # 'png16' outputs, under the scan's name and after renaming
+    assert not is_export('angiovue', root, write_png(root, 'OCTA-004_AS3.png', 'I;16'))
+    assert not is_export('angiovue', root, write_png(root, '0143.png', 'I;16'))
@@ -0,0 +1,350 @@
+"""
+Watch-folder mode: relabel and convert new exports as they land.
+
+Each instrument folder is processed once on start, to catch up. After that
+only the files that appear are handled. A file is picked up once it has
+been closed (or moved in) and its size and mtime have stayed the same for
+WATCH_SETTLE seconds, so exports still being written are left alone. Ready
+files are passed to pipeline.run(..., paths=...) in batches, and a single
+LabelStore stays loaded for the whole session. The per-file cost of a batch
+therefore does not grow with the size of the folder.
+
+Usage:
+    python watch.py [revo spectralis angiovue] [--settle 2] [--interval 1] [--poll] [--quiet]
+
+Note:
+    - On Linux the folders are watched with inotify; elsewhere, or with --poll,
+      they are listed every --interval seconds instead.
+    - Only export names are picked up (REVO and Spectralis names with a space,
+      Angiovue .raw and 8-bit .png files; the 16-bit 'png16' outputs are left
+      out, see angiovue.is_converted_png), so the files this script renames or
+      writes never trigger another run.
+    - Stop with Ctrl+C. A batch stopped part way can be finished with --resume
+      or undone with --rollback on relabel.py or angiovue.py.
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+import pipeline
+from labels import LabelStore
+from renamer import Cancelled
+
+# Seconds a file's size and mtime must stay unchanged before it is processed
+WATCH_SETTLE = 2.0
+
+# Seconds between checks for settled files, and between folder listings when polling
+WATCH_INTERVAL = 1.0
+
+# Folder levels below the instrument folder that hold exports: REVO/OCTAxxx/<mm>_<scans>/<file>
+DEPTHS = {'angiovue': 0, 'revo': 2, 'spectralis': 0}
+
+# inotify constants (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+_EVENT = struct.Struct('iIII')      # wd, mask, cookie, len; followed by a NUL-padded name
+
+
+def is_export(instrument: str, root: str, path: str) -> bool:
+    """Returns True if `path` looks like a file exported by the instrument rather than one written by this tool."""
+    relative = os.path.relpath(path, root).split(os.sep)
+    name = relative[-1]
+    if len(relative) != DEPTHS[instrument] + 1 or any(part.startswith(".") for part in relative):
+        return False
+    if instrument == 'angiovue':
+        if name.lower().endswith('.png'):
+            # Imported here, as in pipeline.py
+            import angiovue
+            return not angiovue.is_converted_png(path)
+        return name.lower().endswith('.raw')
+    # REVO and Spectralis exports start with the patient's name; renamed files have no space
+    return " " in name and "." in name
+
+
+def _list_files(folder: str, depth: int) -> List[str]:
+    """Returns the visible files `depth` folder levels below `folder`."""
+    try:
+        with os.scandir(folder) as entries:
+            entries = [e for e in entries if not e.name.startswith(".")]
+    except OSError:
+        return []
+    if depth == 0:
+        return [e.path for e in entries if e.is_file()]
+    return [path for e in entries if e.is_dir() for path in _list_files(e.path, depth - 1)]
+
+
+class PollWatcher:
+    """
+    Finds new and changed files by listing the folders at every call.
+
+    Parameters:
+    ----------
+    roots : dict
+        Instrument -> folder to watch.
+    """
+
+    def __init__(self, roots: Dict[str, str]) -> None:
+        self.roots = roots
+        self._stats: Dict[str, Tuple[int, int]] = dict(self._snapshot())
+
+    def _snapshot(self):
+        for instrument, root in self.roots.items():
+            for path in _list_files(root, DEPTHS[instrument]):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, (stat.st_size, stat.st_mtime_ns)
+
+    def changes(self, timeout: float) -> List[str]:
+        """Waits `timeout` seconds, then returns the files added or modified since the last call."""
+        time.sleep(timeout)
+        stats = dict(self._snapshot())
+        changed = [path for path, stat in stats.items() if self._stats.get(path) != stat]
+        self._stats = stats
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """
+    Finds new files with Linux inotify: files closed after writing or moved into a watched folder.
+
+    Folders created below a root (e.g. a new REVO/OCTAxxx) are watched as they appear.
+
+    Parameters:
+    ----------
+    roots : dict
+        Instrument -> folder to watch.
+
+    Raises:
+    ----------
+    OSError
+        If inotify is not available.
+    """
+
+    def __init__(self, roots: Dict[str, str]) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError("inotify is not available on this system")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = roots
+        self._folders: Dict[int, Tuple[str, int]] = {}    # watch descriptor -> (folder, levels left below it)
+        for instrument, root in roots.items():
+            self._watch(root, DEPTHS[instrument])
+
+    @classmethod
+    def available(cls) -> bool:
+        return sys.platform.startswith('linux')
+
+    def _watch(self, folder: str, depth: int) -> List[str]:
+        """Watches `folder` and the folders below it; returns the files already in them."""
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            print(f"[WARNING] Unable to watch {folder}: {os.strerror(ctypes.get_errno())}")
+            return []
+        self._folders[wd] = (folder, depth)
+        if depth == 0:
+            return _list_files(folder, 0)
+        found = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir() and not entry.name.startswith("."):
+                    found += self._watch(entry.path, depth - 1)
+        return found
+
+    def changes(self, timeout: float) -> List[str]:
+        """Waits up to `timeout` seconds for events and returns the files they name."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = b''
+        while True:
+            try:
+                data += os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0'))
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost; fall back to everything in the folders
+                print("[WARNING] Too many file events at once; checking every file.")
+                changed += [p for instrument, root in self.roots.items() for p in _list_files(root, DEPTHS[instrument])]
+                continue
+            if wd not in self._folders or not name:
+                continue
+            folder, depth = self._folders[wd]
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if depth > 0 and mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have landed before the watch was in place
+                    changed += self._watch(path, depth - 1)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.append(path)
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Debouncer:
+    """
+    Holds changed files back until they have settled.
+
+    Parameters:
+    ----------
+    settle : float
+        Seconds a file's size and mtime must stay the same.
+    """
+
+    def __init__(self, settle: float = WATCH_SETTLE) -> None:
+        self.settle = settle
+        self._pending: Dict[str, Tuple[Tuple[int, int], float]] = {}   # path -> (stat, when it last changed)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def touch(self, path: str) -> None:
+        """Marks `path` as changed just now."""
+        self._pending[path] = ((-1, -1), time.monotonic())
+
+    def ready(self) -> List[str]:
+        """Returns (and forgets) the files that have settled; files that disappeared are dropped."""
+        now = time.monotonic()
+        settled = []
+        for path, (previous, changed_at) in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != previous:
+                self._pending[path] = (current, now)
+            elif now - changed_at >= self.settle:
+                del self._pending[path]
+                settled.append(path)
+        return sorted(settled)
+
+
+def process(instrument: str, root: str, labels: LabelStore, paths: Optional[List[str]], quiet: bool = False,
+            stop: Optional[threading.Event] = None) -> None:
+    """Runs one instrument on `paths` (all files if None), reporting errors instead of raising them."""
+    with metrics.collect(quiet=quiet) as run_metrics:
+        try:
+            pipeline.run(instrument, root, labels, cancel=stop, paths=paths)
+        except Cancelled:
+            pass
+        except (RuntimeError, OSError, ValueError) as e:
+            print(f"[ERROR] {e}")
+        except Exception:
+            # One bad export must not stop the watcher
+            print(traceback.format_exc())
+    print(run_metrics.summary())
+
+
+def watch(instruments: List[str], settle: float = WATCH_SETTLE, interval: float = WATCH_INTERVAL,
+          poll: bool = False, quiet: bool = False, stop: Optional[threading.Event] = None) -> None:
+    """
+    Processes the instrument folders, then keeps processing new exports until `stop` is set.
+
+    Parameters:
+    ----------
+    instruments : list of str
+        Instruments to watch, e.g. ['revo', 'angiovue'].
+    settle : float
+        Seconds a file must stay unchanged before it is processed.
+    interval : float
+        Seconds between checks.
+    poll : bool
+        List the folders instead of using inotify.
+    quiet : bool
+        Only print warnings, errors and summaries.
+    stop : threading.Event, optional
+        Set it (from another thread) to stop watching.
+    """
+    roots = {instrument: pipeline.ROOTS[instrument] for instrument in instruments}
+    labels = LabelStore()
+    stop = stop or threading.Event()
+
+    # Watch before catching up, so nothing landing meanwhile is missed
+    watcher = None
+    if not poll and InotifyWatcher.available():
+        try:
+            watcher = InotifyWatcher(roots)
+        except OSError as e:
+            print(f"[WARNING] {e}; polling instead.")
+    if watcher is None:
+        watcher = PollWatcher(roots)
+    print(f"[INFO] Watching {', '.join(roots.values())} ({type(watcher).__name__}, settle {settle:g} s)")
+
+    debouncer = Debouncer(settle)
+    try:
+        for instrument, root in roots.items():
+            print(f"[INFO] Catching up on {root}")
+            process(instrument, root, labels, None, quiet, stop)
+
+        while not stop.is_set():
+            for path in watcher.changes(interval):
+                debouncer.touch(path)
+            ready = debouncer.ready()
+            for instrument, root in roots.items():
+                paths = [p for p in ready if is_export(instrument, root, p)]
+                if paths and not stop.is_set():
+                    print(f"[INFO] {len(paths)} new files in {root}")
+                    process(instrument, root, labels, paths, quiet, stop)
+    finally:
+        watcher.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="watch.py", description="Relabel and convert new exports as they land.")
+    parser.add_argument("instruments", nargs="*", metavar="instrument",
+                        help="instruments to watch (default: all): " + ", ".join(sorted(pipeline.ROOTS)))
+    parser.add_argument("--settle", type=float, default=WATCH_SETTLE,
+                        help="seconds a file must stay unchanged before it is processed")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="seconds between checks")
+    parser.add_argument("--poll", action="store_true", help="list the folders instead of using inotify")
+    parser.add_argument("--quiet", action="store_true", help="only print warnings, errors and summaries")
+    args = parser.parse_args(argv)
+
+    instruments = args.instruments or sorted(pipeline.ROOTS)
+    for instrument in instruments:
+        if instrument not in pipeline.ROOTS:
+            parser.error(f"unknown instrument '{instrument}' (choose from {', '.join(sorted(pipeline.ROOTS))})")
+    missing = [pipeline.ROOTS[i] for i in instruments if not os.path.isdir(pipeline.ROOTS[i])]
+    if missing:
+        print(f"[ERROR] Folder not found: {', '.join(missing)}")
+        sys.exit(1)
+
+    try:
+        watch(instruments, args.settle, args.interval, args.poll, args.quiet)
+    except KeyboardInterrupt:
+        print("[INFO] Stopped watching.")
+
+
+if __name__ == "__main__":
+    main()